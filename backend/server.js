@@ -704,7 +704,7 @@ app.use((err, req, res, next) => {
 //Start Python prediction service
 const startPredictionService = () => {
     const pythonPath = path.join(__dirname, '..', 'ml_service', 'venv', 'Scripts', 'python.exe');
-    const scriptPath = path.join(__dirname, '..', 'ml_service', 'app.py');
+    const scriptPath = path.join(__dirname, '..', 'ml_service', 'serve.py');
     
     console.log('Starting Python service with:');
     console.log('Python path:', pythonPath);
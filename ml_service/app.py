@@ -1,54 +1,285 @@
+# Imported first so the startup report covers every later import
+from startup import timed_stage, log_startup_report, startup_report
+
 import os
-from flask import Flask, request, jsonify
-from flask_cors import CORS
-import joblib
-import numpy as np
+import sys
+import hmac
+import json
 import logging
-from dotenv import load_dotenv
-import pandas as pd
-from datetime import datetime, timedelta
+import time
+import threading
+from datetime import datetime, timedelta, timezone
+
+with timed_stage('import flask'):
+    from flask import Flask, Response, g, has_request_context, request, jsonify
+    from flask_cors import CORS
+with timed_stage('import numpy'):
+    import numpy as np
+
+from forecast_cache import ForecastCache
+from compiled_model import CompiledModel, load_artifact
+from compact_model import CompactModel, load_compact_artifact
+from features import (
+    DRUG_TYPES, DRUG_TYPE_CODES, FEATURE_COLUMNS, build_input_features, build_series_features,
+    predict_feature_matrix
+)
+from importance_table import ImportanceTable
+from model_registry import ModelRegistry, ModelSwapper
+from micro_batcher import MicroBatcher
+from precompute import DEFAULT_TABLE_PATH, load_or_build_table, parse_horizons
+from serialization import ARROW, FormatError, arrow_response, decode_body, document_response, negotiate
+from simulation import DEFAULT_PATHS, DEFAULT_SERVICE_LEVEL, load_residuals, simulate
+import telemetry
+from telemetry import Counter, Gauge, SamplingProfiler, stage
 
-# Configure logging
+# Configure logging; ML_LOG_LEVEL=DEBUG also logs every request and response payload
 logging.basicConfig(
-    level=logging.INFO,
+    level=os.getenv('ML_LOG_LEVEL', 'INFO').upper(),
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 logger = logging.getLogger(__name__)
 
-# Load environment variables
+def find_dotenv_file():
+    # Same lookup as python-dotenv: walk up from this file's directory
+    directory = os.path.dirname(os.path.abspath(__file__))
+    while True:
+        candidate = os.path.join(directory, '.env')
+        if os.path.isfile(candidate):
+            return candidate
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            return None
+        directory = parent
+
+# Load environment variables, only importing python-dotenv when there is a .env file
 logger.info("Loading environment variables...")
-load_dotenv()
+with timed_stage('load environment'):
+    dotenv_file = find_dotenv_file()
+    if dotenv_file:
+        from dotenv import load_dotenv
+        load_dotenv(dotenv_file)
 
 # Initialize Flask app
 logger.info("Initializing Flask application...")
 app = Flask(__name__)
 CORS(app)
 
-# Initialize model and preprocessor
-logger.info("Initializing model and preprocessor...")
 model_path = os.path.join(os.path.dirname(__file__), 'models', 'best_model_combined.pkl')
 
-try:
-    logger.info(f"Loading model from: {model_path}")
-    model = joblib.load(model_path)
-    logger.info("Model loaded successfully")
-except Exception as e:
-    logger.error(f"Error initializing model or preprocessor: {str(e)}")
-    raise
-
-# Drug types data with additional information
-DRUG_TYPES = [
-    { 'code': 'M01AB', 'name': 'Anti-inflammatory and antirheumatic products (Acetic acid derivatives)' },
-    { 'code': 'M01AE', 'name': 'Anti-inflammatory and antirheumatic products (Propionic acid derivatives)' },
-    { 'code': 'N02BA', 'name': 'Other analgesics and antipyretics (Salicylic acid derivatives)' },
-    { 'code': 'N02BE/B', 'name': 'Other analgesics and antipyretics (Pyrazolones and Anilides)' },
-    { 'code': 'N05B', 'name': 'Psycholeptics drugs (Anxiolytic)' },
-    { 'code': 'N05C', 'name': 'Psycholeptics drugs (Hypnotics and sedatives)' },
-    { 'code': 'R03', 'name': 'Drugs for obstructive airway diseases' },
-    { 'code': 'R06', 'name': 'Antihistamines for systemic use' }
-]
-
-DRUG_TYPE_CODES = [drug['code'].replace('/', '') for drug in DRUG_TYPES]
+# Inference backend: 'sklearn' runs the pickled pipeline, 'compiled' evaluates
+# the same trees from flat NumPy arrays without sklearn's per-call overhead,
+# 'compact' from float32/int16 arrays (see compact_model.py) and 'auto' uses
+# the exported compiled artifact when it matches the pickle
+INFERENCE_BACKEND = os.getenv('ML_INFERENCE_BACKEND', 'auto').lower()
+if INFERENCE_BACKEND not in ('auto', 'compiled', 'compact', 'sklearn'):
+    raise ValueError(f"Unknown ML_INFERENCE_BACKEND: {INFERENCE_BACKEND}")
+
+# Concurrent cache misses are coalesced into one model call of up to ML_MICROBATCH_MAX_ROWS
+# rows, waiting at most ML_MICROBATCH_WAIT_MS for more requests; ML_MICROBATCH=0 disables it
+MICROBATCH_ENABLED = os.getenv('ML_MICROBATCH', '1') == '1'
+MICROBATCH_WAIT = float(os.getenv('ML_MICROBATCH_WAIT_MS', 2)) / 1000
+MICROBATCH_MAX_ROWS = int(os.getenv('ML_MICROBATCH_MAX_ROWS', 256))
+# Longest a request waits for its batched result before failing
+MICROBATCH_TIMEOUT = float(os.getenv('ML_MICROBATCH_TIMEOUT_S', 30))
+
+# Optional precomputed forecast table: 'off', 'load' an existing table or build it at 'startup'
+PRECOMPUTE_MODE = os.getenv('ML_PRECOMPUTE', 'off').lower()
+
+def get_feature_importances(active, get_pipeline):
+    """Return (feature names, per-drug importance rows), preferring the compiled artifact"""
+    if isinstance(active, CompiledModel) and active.feature_importances is not None:
+        return active.feature_names_out, active.feature_importances
+
+    # Get feature names from preprocessor
+    pipeline = get_pipeline()
+    feature_names = pipeline.named_steps['preprocessor'].get_feature_names_out()
+    feature_importances = [est.feature_importances_ for est in pipeline.named_steps['model'].estimators_]
+    return feature_names, feature_importances
+
+class ServedModel:
+    """One model version and everything derived from it.
+
+    Requests hold on to the instance they started with, so a version swap
+    never mixes outputs, cached values or importances of two models.
+    """
+
+    def __init__(self, resolved):
+        self.version = resolved.version
+        self.key = resolved.key
+        self.model_path = resolved.model_path
+        self.model = None
+        self.predictor = None
+        self.importance_table = None
+        self.model_type = None
+        self.backend = None
+        self.forecast_table = None
+        self.residuals = None
+        self._lock = threading.RLock()
+
+        # Cache of raw model outputs keyed on the engineered feature vector
+        self.forecast_cache = ForecastCache(
+            self.key,
+            maxsize=int(os.getenv('ML_CACHE_SIZE', 4096)),
+            ttl=float(os.getenv('ML_CACHE_TTL', 3600))
+        )
+        self.batcher = None
+        if MICROBATCH_ENABLED:
+            self.batcher = MicroBatcher(
+                self.predict_matrix,
+                max_wait=MICROBATCH_WAIT,
+                max_rows=MICROBATCH_MAX_ROWS,
+                concurrency=lambda: telemetry.IN_FLIGHT.get(),
+                result_timeout=MICROBATCH_TIMEOUT
+            )
+
+    def get_model(self):
+        """Return the sklearn pipeline, unpickling it on first use"""
+        if self.model is None:
+            with self._lock:
+                if self.model is None:
+                    try:
+                        logger.info(f"Loading model from: {self.model_path}")
+                        # Imported separately so the report tells import and unpickling time apart
+                        with timed_stage('import sklearn/joblib'):
+                            import joblib
+                            import sklearn.pipeline
+                        with timed_stage('unpickle pipeline'):
+                            self.model = joblib.load(self.model_path)
+                        logger.info("Model loaded successfully")
+                    except Exception as e:
+                        logger.error(f"Error initializing model or preprocessor: {str(e)}")
+                        raise
+        return self.model
+
+    def load(self):
+        """Load the object used for inference and the tables derived from the model"""
+        load_start = time.perf_counter()
+        compiled = None
+        if INFERENCE_BACKEND == 'compact':
+            with timed_stage('load compact model artifact'):
+                compiled = load_compact_artifact(self.model_path)
+            if compiled is not None:
+                logger.info("Loaded memory-mapped compact model artifact")
+        if INFERENCE_BACKEND in ('auto', 'compiled') or (compiled is None and INFERENCE_BACKEND == 'compact'):
+            with timed_stage('load model artifact'):
+                compiled = load_artifact(self.model_path)
+            if compiled is not None:
+                logger.info("Loaded memory-mapped model artifact")
+        if compiled is None and INFERENCE_BACKEND in ('compiled', 'compact'):
+            logger.info("Compiling model trees into flat arrays...")
+            with timed_stage('compile model'):
+                compiled = CompiledModel.from_pipeline(self.get_model())
+        if INFERENCE_BACKEND == 'compact' and not isinstance(compiled, CompactModel):
+            # Without an exported compact artifact, narrow the compiled arrays in memory
+            logger.info("No compact artifact, converting the compiled model (export it with compact_model.py --export)")
+            compiled = CompactModel.from_compiled(compiled)
+        self.predictor = compiled if compiled is not None else self.get_model()
+        self.backend = 'sklearn' if compiled is None else 'compact' if isinstance(compiled, CompactModel) else 'compiled'
+        # Only gradient boosting compiles; tuning.py may publish other learners
+        estimator = 'GradientBoostingRegressor' if compiled is not None else \
+            type(self.get_model().named_steps['model'].estimators_[0]).__name__
+        self.model_type = f'MultiOutput {estimator}'
+
+        # Sorted once per load so /model/info never ranks importances per request
+        self.importance_table = ImportanceTable(*get_feature_importances(self.predictor, self.get_model), DRUG_TYPE_CODES)
+        telemetry.MODEL_LOAD_SECONDS.clear()
+        telemetry.MODEL_LOAD_SECONDS.set(time.perf_counter() - load_start,
+                                         backend=self.backend)
+        telemetry.MODEL_LOADED_AT.set(time.time())
+
+        if PRECOMPUTE_MODE in ('load', 'startup'):
+            self.load_forecast_table()
+        # Training residuals for /simulate/stock; the endpoint answers 503 without them
+        self.residuals = load_residuals(self.model_path)
+        return self
+
+    def load_forecast_table(self):
+        # Registry versions keep their table next to the model, the legacy pickle uses ML_FORECAST_TABLE
+        if self.version == 'legacy':
+            table_path = os.getenv('ML_FORECAST_TABLE', DEFAULT_TABLE_PATH)
+        else:
+            table_path = os.path.join(os.path.dirname(self.model_path), 'forecast_table.npy')
+        try:
+            horizons = parse_horizons(os.getenv('ML_PRECOMPUTE_HORIZONS', '1-90'))
+            start_date = os.getenv('ML_PRECOMPUTE_START')
+            start_date = datetime.strptime(start_date, '%Y-%m-%d') if start_date else datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+            with timed_stage('load forecast table'):
+                self.forecast_table = load_or_build_table(
+                    self.predictor,
+                    self.model_path,
+                    table_path,
+                    start_date,
+                    int(os.getenv('ML_PRECOMPUTE_DAYS', 730)) + max(horizons),
+                    horizons,
+                    build=PRECOMPUTE_MODE == 'startup'
+                )
+        except Exception as e:
+            logger.error(f"Error loading precomputed forecast table: {str(e)}", exc_info=True)
+
+    def predict_matrix(self, X):
+        """Run the predictor on an (n, len(FEATURE_COLUMNS)) feature matrix"""
+        telemetry.MODEL_ROWS.observe(len(X))
+        return predict_feature_matrix(self.predictor, X)
+
+    def warm_up(self):
+        """Run a few predictions so the first requests do not pay for page faults and lazy setup"""
+        today = datetime.now()
+        rows = [build_input_features(today + timedelta(days=offset), 30) for offset in (0, 30, 90, 180)]
+        # Bypasses the micro-batcher so no thread is started before serve.py forks
+        self.predict_matrix(np.array([[row[name] for name in FEATURE_COLUMNS] for row in rows]))
+        return self
+
+def load_served_model(resolved):
+    logger.info(f"Loading model version {resolved.version}...")
+    served = ServedModel(resolved).load().warm_up()
+    telemetry.MODEL_VERSION.clear()
+    telemetry.MODEL_VERSION.set(1, version=served.version)
+    return served
+
+# Serves the newest (or pinned) registry version, falling back to model_path;
+# ML_MODEL_WATCH_INTERVAL seconds between checks for a new version, 0 disables hot swapping
+model_registry = ModelRegistry(legacy_model_path=model_path)
+model_swapper = ModelSwapper(model_registry, load_served_model,
+                             interval=float(os.getenv('ML_MODEL_WATCH_INTERVAL', 5)))
+
+def served_model():
+    """The model version of the current request, or the one being served outside requests"""
+    if has_request_context():
+        served = g.get('served_model')
+        if served is not None:
+            return served
+    return model_swapper.current()
+
+def get_model():
+    """Return the sklearn pipeline of the served version"""
+    return served_model().get_model()
+
+def get_predictor():
+    """Return the object used for inference, loading it on first use"""
+    return served_model().predictor
+
+def reload_model():
+    """Load the resolved model version again with fresh caches and tables"""
+    model_swapper.refresh(force=True)
+
+def run_model(rows, served=None):
+    """Run the predictor on a list of feature dicts, batched with concurrent requests when enabled"""
+    with stage('build_input'):
+        X = np.array([[row[name] for name in FEATURE_COLUMNS] for row in rows], dtype=np.float64)
+    return predict_features(X, served)
+
+def predict_features(X, served=None):
+    """Run the predictor on a FEATURE_COLUMNS matrix, batched with concurrent requests when enabled"""
+    served = served or served_model()
+    with stage('predict'):
+        if served.batcher is not None:
+            return served.batcher.submit(X)
+        return served.predict_matrix(X)
+
+# ML_LAZY_LOAD=1 defers loading the model to the first request
+if os.getenv('ML_LAZY_LOAD', '0') != '1':
+    logger.info("Initializing model and preprocessor...")
+    get_predictor()
 
 @app.route('/drugs/types', methods=['GET'])
 def get_drug_types():
@@ -60,122 +291,720 @@ def get_drug_types():
 @app.route('/model/info', methods=['GET'])
 def get_model_info():
     try:
-        # Get feature names from preprocessor
-        feature_names = model.named_steps['preprocessor'].get_feature_names_out()
-        
-        # Get feature importance for each drug type
-        importances = []
-        for i, drug_type in enumerate(DRUG_TYPE_CODES):
-            base_model = model.named_steps['model'].estimators_[i]
-            importance = base_model.feature_importances_
-            for feat, imp in zip(feature_names, importance):
-                importances.append({
-                    'name': f"{feat} ({drug_type})",
-                    'importance': float(imp)
-                })
-        
-        # Sort by importance
-        importances.sort(key=lambda x: x['importance'], reverse=True)
-        
-        return jsonify({
-            'model_type': 'MultiOutput GradientBoostingRegressor',
-            'feature_importance': importances[:10]  # Return top 10 most important features
-        })
+        served = served_model()
+        table = served.importance_table
+
+        # ?top_k=N changes the number of features, ?drug_type=CODE ranks one drug's
+        # estimator and ?per_drug=true ranks every drug's estimator separately
+        top_k = request.args.get('top_k', 10)
+        try:
+            top_k = int(top_k)
+        except (TypeError, ValueError):
+            return jsonify({'error': 'Parameter top_k must be an integer'}), 400
+        if top_k <= 0:
+            return jsonify({'error': 'Parameter top_k must be positive'}), 400
+
+        drug_type = request.args.get('drug_type')
+        per_drug = request.args.get('per_drug', 'false').lower() in ('1', 'true', 'yes')
+        try:
+            fmt = negotiate(request)
+        except FormatError as e:
+            return jsonify({'error': str(e)}), e.status
+        body = {'model_type': served.model_type}
+        if drug_type is not None:
+            code = drug_type.upper().replace('/', '')
+            if code not in DRUG_TYPE_CODES:
+                return jsonify({'error': f'Invalid drug type: {drug_type}'}), 400
+            body['drug_type'] = code
+            body['feature_importance'] = table.top_for_drug(DRUG_TYPE_CODES.index(code), top_k)
+        elif per_drug:
+            body['feature_importance_by_drug'] = {
+                code: table.top_for_drug(i, top_k) for i, code in enumerate(DRUG_TYPE_CODES)
+            }
+        else:
+            body['feature_importance'] = table.top(top_k)  # Top 10 most important features by default
+
+        if fmt == ARROW:
+            # One row per feature; per-drug rankings add a drug_type column
+            if per_drug and drug_type is None:
+                rows = [dict(item, drug_type=code)
+                        for code, items in body.pop('feature_importance_by_drug').items() for item in items]
+            else:
+                rows = body.pop('feature_importance')
+            columns = {key: [row[key] for row in rows] for key in rows[0]}
+            response = arrow_response(columns, body)
+        else:
+            response = document_response(fmt, body)
+
+        # The table only changes when the model does, so clients can revalidate cheaply
+        response.set_etag(f"{table.etag}-{top_k}-{drug_type or ''}-{int(per_drug)}-{fmt}")
+        if os.path.exists(served.model_path):
+            response.last_modified = datetime.fromtimestamp(int(os.path.getmtime(served.model_path)), timezone.utc)
+        response.cache_control.no_cache = True
+        return response.make_conditional(request)
     except Exception as e:
         logger.error(f"Error getting model info: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+# Maximum number of forecasts accepted by a single batch request
+MAX_BATCH_SIZE = int(os.getenv('ML_MAX_BATCH_SIZE', 10000))
+
+FORECAST_FIELDS = ['drug_type', 'date', 'days', 'stock_level']
+
+def parse_forecast_request(data):
+    """Validate a forecast request and return its parsed fields.
+
+    Raises ValueError with a client-facing message when the request is invalid.
+    """
+    # Batch items may be sent as [drug_type, date, days, stock_level] tuples
+    if isinstance(data, (list, tuple)):
+        data = dict(zip(FORECAST_FIELDS, data))
+    if not isinstance(data, dict):
+        raise ValueError('Request must be a JSON object')
+
+    # Validate required fields
+    for field in FORECAST_FIELDS:
+        if field not in data:
+            raise ValueError(f'Missing required field: {field}')
+
+    # Parse the full date (YYYY-MM-DD)
+    try:
+        date = datetime.strptime(data['date'], '%Y-%m-%d')
+    except (TypeError, ValueError):
+        raise ValueError('Invalid date format. Use YYYY-MM-DD')
+
+    try:
+        days = int(data['days'])
+        stock_level = float(data['stock_level'])
+    except (TypeError, ValueError):
+        raise ValueError('Fields days and stock_level must be numeric')
+    if days <= 0:
+        raise ValueError('Field days must be a positive integer')
+
+    # Get the index of the requested drug type
+    drug_type = str(data['drug_type']).upper().replace('/', '')
+    try:
+        drug_index = DRUG_TYPE_CODES.index(drug_type)
+    except ValueError:
+        raise ValueError(f'Invalid drug type: {data["drug_type"]}')
+
+    return {
+        'drug_type': drug_type,
+        'drug_index': drug_index,
+        'date': date,
+        'end_date': date + timedelta(days=days),
+        'days': days,
+        'stock_level': stock_level
+    }
+
+def predict_forecasts(parsed_requests):
+    """Predict start and end date outputs for many forecasts with one model call.
+
+    Returns an array of shape (n_requests, 2, n_drug_types).
+    """
+    predictions = np.empty((len(parsed_requests), 2, len(DRUG_TYPE_CODES)))
+    served = served_model()
+    forecast_table = served.forecast_table
+
+    # Answer from the precomputed table when both dates fall inside its window
+    pending = []
+    with stage('table_lookup'):
+        for i, parsed in enumerate(parsed_requests):
+            if forecast_table is not None:
+                start_pred = forecast_table.lookup(parsed['date'], parsed['days'])
+                end_pred = forecast_table.lookup(parsed['end_date'], parsed['days'])
+                if start_pred is not None and end_pred is not None:
+                    predictions[i, 0] = start_pred
+                    predictions[i, 1] = end_pred
+                    continue
+            pending.append(i)
+
+    if pending:
+        # Create input features for both start and end dates of every remaining request
+        rows = []
+        with stage('features'):
+            for i in pending:
+                parsed = parsed_requests[i]
+                rows.append(build_input_features(parsed['date'], parsed['days']))
+                rows.append(build_input_features(parsed['end_date'], parsed['days']))
+        predictions[pending] = predict_feature_rows(rows, served).reshape(len(pending), 2, -1)
+
+    return predictions
+
+def predict_feature_rows(rows, served=None):
+    """Return model outputs for feature rows, only running the model for cache misses"""
+    served = served or served_model()
+    forecast_cache = served.forecast_cache
+    with stage('cache_lookup'):
+        keys = [forecast_cache.make_key(row.values()) for row in rows]
+        results = [forecast_cache.get(key) for key in keys]
+
+    # Predict every distinct missing feature vector once
+    missing = {}
+    for key, row, result in zip(keys, rows, results):
+        if result is None and key not in missing:
+            missing[key] = row
+    if missing:
+        predictions = run_model(list(missing.values()), served)
+        computed = dict(zip(missing.keys(), predictions))
+        for key, prediction in computed.items():
+            forecast_cache.put(key, prediction)
+        results = [computed[key] if result is None else result for key, result in zip(keys, results)]
+
+    return np.vstack(results)
+
+def format_forecast(parsed, predictions):
+    drug_index = parsed['drug_index']
+    days = parsed['days']
+
+    # Calculate average prediction between start and end dates
+    start_pred = float(predictions[0][drug_index])
+    end_pred = float(predictions[1][drug_index])
+    avg_prediction = (start_pred + end_pred) / 2
+
+    # Calculate quantities
+    predicted_quantity = int(avg_prediction * parsed['stock_level'])
+    average_daily = predicted_quantity / days
+
+    # Format the response with proper date
+    return {
+        'prediction': avg_prediction,
+        'date': parsed['date'].strftime('%Y-%m-%d'),
+        'end_date': parsed['end_date'].strftime('%Y-%m-%d'),
+        'predicted_quantity': predicted_quantity,
+        'average_daily': average_daily,
+        'drug_type': parsed['drug_type'],
+        'days': days
+    }
+
+def forecast_columns(parsed_requests, predictions):
+    """The fields of format_forecast as column arrays, computed for all forecasts at once"""
+    n = len(parsed_requests)
+    drug_indices = np.fromiter((parsed['drug_index'] for parsed in parsed_requests), dtype=np.intp, count=n)
+    days = np.fromiter((parsed['days'] for parsed in parsed_requests), dtype=np.int64, count=n)
+    stock_levels = np.fromiter((parsed['stock_level'] for parsed in parsed_requests), dtype=np.float64, count=n)
+    dates = np.array([parsed['date'] for parsed in parsed_requests], dtype='datetime64[D]')
+
+    # Same arithmetic as format_forecast; astype truncates toward zero like int()
+    rows = np.arange(n)
+    avg_prediction = (predictions[rows, 0, drug_indices] + predictions[rows, 1, drug_indices]) / 2
+    predicted_quantity = (avg_prediction * stock_levels).astype(np.int64)
+    return {
+        'prediction': avg_prediction,
+        'date': dates,
+        'end_date': dates + days,
+        'predicted_quantity': predicted_quantity,
+        'average_daily': predicted_quantity / days,
+        'drug_type': np.asarray(DRUG_TYPE_CODES)[drug_indices],
+        'days': days
+    }
+
 @app.route('/predict/forecast', methods=['POST'])
 def predict_forecast():
     try:
-        data = request.get_json()
-        logger.info(f"Received prediction request with data: {data}")
-        
-        # Validate required fields
-        required_fields = ['drug_type', 'date', 'days', 'stock_level']
-        for field in required_fields:
-            if field not in data:
-                return jsonify({'error': f'Missing required field: {field}'}), 400
-        
-        # Prepare the input data for the model
-        try:
-            # Parse the full date (YYYY-MM-DD)
+        with stage('parse'):
             try:
-                date = datetime.strptime(data['date'], '%Y-%m-%d')
-            except ValueError:
-                return jsonify({'error': 'Invalid date format. Use YYYY-MM-DD'}), 400
-
-            # Calculate end date based on prediction period
-            days = int(data['days'])
-            end_date = date + timedelta(days=days)
-            
-            # Create input features for both start and end dates
-            dates = [date, end_date]
-            predictions_list = []
-            
-            for current_date in dates:
-                input_features = {
-                    'Year': float(current_date.year),
-                    'Month': float(current_date.month),
-                    'Hour': 12.0,  # Default to noon
-                    'quarter': float((current_date.month - 1) // 3 + 1),
-                    'day_of_year': float(current_date.timetuple().tm_yday),
-                    'is_weekend': float(current_date.weekday() >= 5),  # 5 and 6 are Saturday and Sunday
-                    'prediction_days': float(days)  # Add prediction period as a feature
-                }
-                
-                # Convert to DataFrame
-                input_df = pd.DataFrame([input_features])
-                logger.info(f"Prepared input features for {current_date}: {input_features}")
-                
-                # Make prediction using the model
-                prediction = model.predict(input_df)
-                predictions_list.append(prediction[0])
-            
-            # Get the index of the requested drug type
-            drug_type = data['drug_type'].upper().replace('/', '')
+                fmt = negotiate(request)
+                data = decode_body(request, single=True)
+            except FormatError as e:
+                return jsonify({'error': str(e)}), e.status
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"Received prediction request with data: {data}")
+
             try:
-                drug_index = DRUG_TYPE_CODES.index(drug_type)
-            except ValueError:
-                return jsonify({'error': f'Invalid drug type: {data["drug_type"]}'}), 400
-            
-            # Calculate average prediction between start and end dates
-            start_pred = float(predictions_list[0][drug_index])
-            end_pred = float(predictions_list[1][drug_index])
-            avg_prediction = (start_pred + end_pred) / 2
-            
-            # Calculate quantities
-            stock_level = float(data['stock_level'])
-            predicted_quantity = int(avg_prediction * stock_level)
-            average_daily = predicted_quantity / days
-            
-            # Format the response with proper date
-            response = {
-                'prediction': avg_prediction,
-                'date': date.strftime('%Y-%m-%d'),
-                'end_date': end_date.strftime('%Y-%m-%d'),
-                'predicted_quantity': predicted_quantity,
-                'average_daily': average_daily,
-                'drug_type': drug_type,
-                'days': days
-            }
-            
-            logger.info(f"Final response: {response}")
-            return jsonify(response)
-            
+                parsed = parse_forecast_request(data)
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+
+        # Prepare the input data and make prediction using the model
+        try:
+            predictions = predict_forecasts([parsed])
+            if fmt == ARROW:
+                with stage('serialize'):
+                    return arrow_response(forecast_columns([parsed], predictions))
+            with stage('format'):
+                response = format_forecast(parsed, predictions[0])
+
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"Final response: {response}")
+            with stage('serialize'):
+                return document_response(fmt, response)
+
         except Exception as e:
             logger.error(f"Error making prediction: {str(e)}", exc_info=True)
             return jsonify({'error': f'Error making prediction: {str(e)}'}), 500
-            
+
     except Exception as e:
         logger.error(f"Error processing request: {str(e)}", exc_info=True)
         return jsonify({'error': str(e)}), 500
 
+@app.route('/predict/forecast/batch', methods=['POST'])
+def predict_forecast_batch():
+    try:
+        with stage('parse'):
+            try:
+                fmt = negotiate(request)
+                data = decode_body(request)
+            except FormatError as e:
+                return jsonify({'error': str(e)}), e.status
+
+            # Accept either a bare list or {"requests": [...]}
+            items = data.get('requests') if isinstance(data, dict) else data
+            if not isinstance(items, list) or not items:
+                return jsonify({'error': 'Request body must contain a non-empty list of forecasts'}), 400
+            if len(items) > MAX_BATCH_SIZE:
+                return jsonify({'error': f'Batch size exceeds limit of {MAX_BATCH_SIZE}'}), 400
+            logger.debug(f"Received batch prediction request with {len(items)} forecasts")
+            telemetry.BATCH_SIZE.observe(len(items))
+
+            parsed_requests = []
+            for i, item in enumerate(items):
+                try:
+                    parsed_requests.append(parse_forecast_request(item))
+                except ValueError as e:
+                    return jsonify({'error': f'Invalid forecast at index {i}: {str(e)}'}), 400
+
+        try:
+            predictions = predict_forecasts(parsed_requests)
+            if fmt == ARROW:
+                # One row per forecast, built column-wise without per-forecast dicts
+                with stage('serialize'):
+                    return arrow_response(forecast_columns(parsed_requests, predictions),
+                                          {'count': len(parsed_requests)})
+            with stage('format'):
+                results = [format_forecast(parsed, pred) for parsed, pred in zip(parsed_requests, predictions)]
+
+            with stage('serialize'):
+                return document_response(fmt, {'predictions': results, 'count': len(results)})
+
+        except Exception as e:
+            logger.error(f"Error making batch prediction: {str(e)}", exc_info=True)
+            return jsonify({'error': f'Error making prediction: {str(e)}'}), 500
+
+    except Exception as e:
+        logger.error(f"Error processing batch request: {str(e)}", exc_info=True)
+        return jsonify({'error': str(e)}), 500
+
+# Longest horizon a single series request may ask for
+MAX_SERIES_DAYS = int(os.getenv('ML_MAX_SERIES_DAYS', 3650))
+
+def parse_series_request(data):
+    """Validate a series request; like parse_forecast_request but with one or more drug types.
+
+    Raises ValueError with a client-facing message when the request is invalid.
+    """
+    if not isinstance(data, dict):
+        raise ValueError('Request must be a JSON object')
+    for field in ['date', 'days', 'stock_level']:
+        if field not in data:
+            raise ValueError(f'Missing required field: {field}')
+
+    try:
+        date = datetime.strptime(data['date'], '%Y-%m-%d')
+    except (TypeError, ValueError):
+        raise ValueError('Invalid date format. Use YYYY-MM-DD')
+    try:
+        days = int(data['days'])
+        stock_level = float(data['stock_level'])
+    except (TypeError, ValueError):
+        raise ValueError('Fields days and stock_level must be numeric')
+    if days <= 0 or days > MAX_SERIES_DAYS:
+        raise ValueError(f'Field days must be between 1 and {MAX_SERIES_DAYS}')
+
+    # drug_types may be a list or a single code; all drug types when omitted
+    requested = data.get('drug_types', data.get('drug_type', DRUG_TYPE_CODES))
+    if isinstance(requested, str):
+        requested = [requested]
+    if not isinstance(requested, list) or not requested:
+        raise ValueError('Field drug_types must be a non-empty list')
+    drug_types = []
+    for drug_type in requested:
+        code = str(drug_type).upper().replace('/', '')
+        if code not in DRUG_TYPE_CODES:
+            raise ValueError(f'Invalid drug type: {drug_type}')
+        drug_types.append(code)
+
+    return {
+        'date': date,
+        'end_date': date + timedelta(days=days),
+        'days': days,
+        'stock_level': stock_level,
+        'drug_types': drug_types,
+        'drug_indices': [DRUG_TYPE_CODES.index(code) for code in drug_types]
+    }
+
+def predict_series(parsed):
+    """Model outputs for every day of the horizon, shape (days, n_drug_types)"""
+    served = served_model()
+    if served.forecast_table is not None:
+        values = served.forecast_table.lookup_range(parsed['date'], parsed['days'], parsed['days'])
+        if values is not None:
+            return np.asarray(values)
+
+    # One feature row per day, built with vectorized date arithmetic
+    with stage('features'):
+        X = build_series_features(parsed['date'].date(), parsed['days'])
+    return predict_features(X, served)
+
+def series_quantities(parsed, predictions):
+    """Per-day and cumulative quantities of the requested drug types, shape (days, n_requested).
+
+    A day's quantity is its share of the horizon total, so the cumulative
+    quantity at the last day is the mean prediction times the stock level.
+    """
+    selected = predictions[:, parsed['drug_indices']]
+    daily = selected * (parsed['stock_level'] / parsed['days'])
+    return selected, daily, np.cumsum(daily, axis=0)
+
+def iter_series_ndjson(parsed, selected, daily, cumulative):
+    """Yield the series as NDJSON: a header line, then one line per day"""
+    yield json.dumps({
+        'date': parsed['date'].strftime('%Y-%m-%d'),
+        'end_date': parsed['end_date'].strftime('%Y-%m-%d'),
+        'days': parsed['days'],
+        'stock_level': parsed['stock_level'],
+        'drug_types': parsed['drug_types']
+    }) + '\n'
+    day = parsed['date']
+    for i in range(parsed['days']):
+        yield json.dumps({
+            'date': (day + timedelta(days=i)).strftime('%Y-%m-%d'),
+            'prediction': selected[i].tolist(),
+            'daily_quantity': daily[i].tolist(),
+            'cumulative_quantity': cumulative[i].tolist()
+        }) + '\n'
+
+@app.route('/predict/forecast/series', methods=['POST'])
+def predict_forecast_series():
+    try:
+        with stage('parse'):
+            # ?format=ndjson (or Accept: application/x-ndjson) streams one line per day
+            wants_ndjson = (request.args.get('format') == 'ndjson'
+                            or request.accept_mimetypes.best == 'application/x-ndjson')
+            try:
+                fmt = None if wants_ndjson else negotiate(request)
+                parsed = parse_series_request(decode_body(request, single=True))
+            except FormatError as e:
+                return jsonify({'error': str(e)}), e.status
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+
+        try:
+            predictions = predict_series(parsed)
+            selected, daily, cumulative = series_quantities(parsed, predictions)
+            if wants_ndjson:
+                return Response(iter_series_ndjson(parsed, selected, daily, cumulative),
+                                mimetype='application/x-ndjson')
+
+            predicted_quantity = {
+                drug_type: int(cumulative[-1, j]) for j, drug_type in enumerate(parsed['drug_types'])
+            }
+            header = {
+                'date': parsed['date'].strftime('%Y-%m-%d'),
+                'end_date': parsed['end_date'].strftime('%Y-%m-%d'),
+                'days': parsed['days'],
+                'stock_level': parsed['stock_level']
+            }
+            if fmt == ARROW:
+                # One row per day: a date column plus three columns per drug type
+                with stage('serialize'):
+                    columns = {'date': np.datetime64(parsed['date'].date(), 'D') + np.arange(parsed['days'])}
+                    for j, drug_type in enumerate(parsed['drug_types']):
+                        columns[f'{drug_type}.prediction'] = selected[:, j]
+                        columns[f'{drug_type}.daily_quantity'] = daily[:, j]
+                        columns[f'{drug_type}.cumulative_quantity'] = cumulative[:, j]
+                    return arrow_response(columns, dict(header, predicted_quantity=predicted_quantity))
+
+            # Compact column arrays; element i of every array belongs to date + i days
+            with stage('serialize'):
+                return document_response(fmt, {
+                    **header,
+                    'series': {
+                        drug_type: {
+                            'prediction': selected[:, j].tolist(),
+                            'daily_quantity': daily[:, j].tolist(),
+                            'cumulative_quantity': cumulative[:, j].tolist()
+                        }
+                        for j, drug_type in enumerate(parsed['drug_types'])
+                    },
+                    'predicted_quantity': predicted_quantity
+                })
+
+        except Exception as e:
+            logger.error(f"Error making series prediction: {str(e)}", exc_info=True)
+            return jsonify({'error': f'Error making prediction: {str(e)}'}), 500
+
+    except Exception as e:
+        logger.error(f"Error processing series request: {str(e)}", exc_info=True)
+        return jsonify({'error': str(e)}), 500
+
+# Largest number of demand paths a simulation request may ask for per SKU
+MAX_SIMULATION_PATHS = int(os.getenv('ML_MAX_SIMULATION_PATHS', 10000))
+# Largest items x paths x days a simulation request may ask for; it runs on the request thread,
+# and 100M simulated days take about two seconds
+MAX_SIMULATION_WORK = int(os.getenv('ML_MAX_SIMULATION_WORK', 100_000_000))
+
+SIMULATION_ITEM_FIELDS = ['drug_type', 'stock_level', 'on_hand', 'lead_time_days']
+
+def parse_simulation_request(data):
+    """Validate a simulation request: a forecast window plus one SKU or a list of them in items.
+
+    Raises ValueError with a client-facing message when the request is invalid.
+    """
+    if not isinstance(data, dict):
+        raise ValueError('Request must be a JSON object')
+    for field in ['date', 'days']:
+        if field not in data:
+            raise ValueError(f'Missing required field: {field}')
+    try:
+        date = datetime.strptime(data['date'], '%Y-%m-%d')
+    except (TypeError, ValueError):
+        raise ValueError('Invalid date format. Use YYYY-MM-DD')
+    try:
+        days = int(data['days'])
+        n_paths = int(data.get('paths', DEFAULT_PATHS))
+        service_level = float(data.get('service_level', DEFAULT_SERVICE_LEVEL))
+        seed = int(data.get('seed', 0))
+    except (TypeError, ValueError):
+        raise ValueError('Fields days, paths, service_level and seed must be numeric')
+    if days <= 0 or days > MAX_SERIES_DAYS:
+        raise ValueError(f'Field days must be between 1 and {MAX_SERIES_DAYS}')
+    if n_paths <= 0 or n_paths > MAX_SIMULATION_PATHS:
+        raise ValueError(f'Field paths must be between 1 and {MAX_SIMULATION_PATHS}')
+    if not 0 < service_level < 1:
+        raise ValueError('Field service_level must be between 0 and 1')
+
+    # Items inherit the window's lead time; a request without items describes a single SKU
+    items = data.get('items', [{field: data[field] for field in SIMULATION_ITEM_FIELDS if field in data}])
+    if not isinstance(items, list) or not items:
+        raise ValueError('Field items must be a non-empty list')
+    if len(items) > MAX_BATCH_SIZE:
+        raise ValueError(f'Number of items exceeds limit of {MAX_BATCH_SIZE}')
+    if len(items) * n_paths * days > MAX_SIMULATION_WORK:
+        raise ValueError(f'Items x paths x days is {len(items) * n_paths * days:,}, '
+                         f'above the limit of {MAX_SIMULATION_WORK:,}; use fewer paths or items')
+    default_lead_time = data.get('lead_time_days', min(7, days))
+
+    drug_indices = np.empty(len(items), dtype=np.intp)
+    stock_levels = np.empty(len(items))
+    on_hand = np.empty(len(items))
+    lead_times = np.empty(len(items), dtype=np.intp)
+    for i, item in enumerate(items):
+        prefix = f'Invalid item at index {i}: ' if 'items' in data else ''
+        if not isinstance(item, dict) or 'drug_type' not in item or 'stock_level' not in item:
+            raise ValueError(f'{prefix}Missing required field: drug_type or stock_level')
+        code = str(item['drug_type']).upper().replace('/', '')
+        if code not in DRUG_TYPE_CODES:
+            raise ValueError(f'{prefix}Invalid drug type: {item["drug_type"]}')
+        try:
+            stock_levels[i] = float(item['stock_level'])
+            on_hand[i] = float(item.get('on_hand', item['stock_level']))
+            lead_times[i] = int(item.get('lead_time_days', default_lead_time))
+        except (TypeError, ValueError):
+            raise ValueError(f'{prefix}Fields stock_level, on_hand and lead_time_days must be numeric')
+        if lead_times[i] < 1 or lead_times[i] > days:
+            raise ValueError(f'{prefix}Field lead_time_days must be between 1 and {days}')
+        drug_indices[i] = DRUG_TYPE_CODES.index(code)
+
+    return {
+        'date': date,
+        'end_date': date + timedelta(days=days),
+        'days': days,
+        'paths': n_paths,
+        'service_level': service_level,
+        'seed': seed,
+        'drug_indices': drug_indices,
+        'stock_levels': stock_levels,
+        'on_hand': on_hand,
+        'lead_times': lead_times
+    }
+
+@app.route('/simulate/stock', methods=['POST'])
+def simulate_stock():
+    try:
+        with stage('parse'):
+            try:
+                fmt = negotiate(request)
+                parsed = parse_simulation_request(decode_body(request, single=True))
+            except FormatError as e:
+                return jsonify({'error': str(e)}), e.status
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+
+        served = served_model()
+        if served.residuals is None:
+            return jsonify({'error': 'No training residuals for the served model, run: python simulation.py fit'}), 503
+
+        try:
+            # One model output per day of the window, shared by every SKU
+            outputs = predict_series(parsed)
+            with stage('simulate'):
+                results = simulate(outputs, served.residuals, parsed['drug_indices'], parsed['stock_levels'],
+                                   parsed['lead_times'], parsed['on_hand'], parsed['paths'],
+                                   parsed['service_level'], parsed['seed'])
+
+            columns = {
+                'drug_type': np.asarray(DRUG_TYPE_CODES)[parsed['drug_indices']],
+                'stock_level': parsed['stock_levels'],
+                'on_hand': parsed['on_hand'],
+                'lead_time_days': parsed['lead_times'],
+                **results,
+                'reorder': parsed['on_hand'] <= results['reorder_point']
+            }
+            header = {
+                'date': parsed['date'].strftime('%Y-%m-%d'),
+                'end_date': parsed['end_date'].strftime('%Y-%m-%d'),
+                'days': parsed['days'],
+                'paths': parsed['paths'],
+                'service_level': parsed['service_level']
+            }
+            with stage('serialize'):
+                if fmt == ARROW:
+                    return arrow_response(columns, dict(header, count=len(parsed['drug_indices'])))
+                values = {name: column.tolist() for name, column in columns.items()}
+                rows = [dict(zip(values, row)) for row in zip(*values.values())]
+                return document_response(fmt, {**header, 'results': rows, 'count': len(rows)})
+
+        except Exception as e:
+            logger.error(f"Error running stock simulation: {str(e)}", exc_info=True)
+            return jsonify({'error': f'Error running simulation: {str(e)}'}), 500
+
+    except Exception as e:
+        logger.error(f"Error processing simulation request: {str(e)}", exc_info=True)
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/cache/stats', methods=['GET'])
+def get_cache_stats():
+    return jsonify(served_model().forecast_cache.stats())
+
 @app.route('/health', methods=['GET'])
 def health_check():
     return jsonify({'status': 'healthy'})
 
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    telemetry.IN_FLIGHT.inc()
+    # Pin the request to the version served when it arrived; the watcher starts here, after any fork
+    g.served_model = model_swapper.current()
+    model_swapper.ensure_watcher()
+
+@app.after_request
+def record_request_duration(response):
+    start = g.get('request_start')
+    if start is not None:
+        telemetry.REQUEST_SECONDS.observe(time.perf_counter() - start,
+                                          endpoint=request.endpoint or 'unknown', status=str(response.status_code))
+    return response
+
+@app.teardown_request
+def end_request(exc):
+    if g.get('request_start') is not None:
+        telemetry.IN_FLIGHT.dec()
+
+def collect_service_metrics():
+    """Cache and forecast table state, read at scrape time"""
+    served = served_model()
+    cache = served.forecast_cache.stats()
+    metrics = []
+    for name, documentation in [('hits', 'Forecast cache hits.'), ('misses', 'Forecast cache misses.'),
+                                ('evictions', 'Entries evicted from the forecast cache.')]:
+        counter = Counter(f'ml_cache_{name}_total', documentation)
+        counter.inc(cache[name])
+        metrics.append(counter)
+    size = Gauge('ml_cache_entries', 'Entries in the forecast cache.')
+    size.set(cache['size'])
+    table = Gauge('ml_forecast_table_days', 'Days covered by the precomputed forecast table, 0 when unused.')
+    table.set(served.forecast_table.n_days if served.forecast_table is not None else 0)
+    return metrics + [size, table]
+
+telemetry.REGISTRY.add_collector(collect_service_metrics)
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(telemetry.render_metrics(), mimetype='text/plain; version=0.0.4')
+
+# Model version administration, only available when ML_ADMIN_TOKEN is set
+ADMIN_TOKEN = os.getenv('ML_ADMIN_TOKEN')
+
+def model_status():
+    served = model_swapper.current()
+    return {
+        'served_version': served.version,
+        'resolved_version': model_registry.resolve().version,
+        'pinned_version': model_registry.pinned(),
+        'versions': model_registry.versions(),
+        'pid': os.getpid()
+    }
+
+@app.route('/admin/model', methods=['GET', 'POST'])
+def admin_model():
+    if not ADMIN_TOKEN:
+        return jsonify({'error': 'Model administration is disabled, set ML_ADMIN_TOKEN'}), 404
+    if not hmac.compare_digest(request.headers.get('X-Admin-Token', ''), ADMIN_TOKEN):
+        return jsonify({'error': 'Invalid admin token'}), 403
+    try:
+        if request.method == 'POST':
+            data = request.get_json(silent=True) or {}
+            action = data.get('action')
+            try:
+                if action == 'pin':
+                    model_registry.pin(str(data.get('version')))
+                elif action == 'unpin':
+                    model_registry.unpin()
+                elif action == 'rollback':
+                    model_registry.rollback()
+                elif action != 'reload':
+                    return jsonify({'error': 'Field action must be one of pin, unpin, rollback, reload'}), 400
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+            logger.info(f"Model admin action {action} requested")
+
+            # Swap this process now; other workers follow on their next watcher check
+            model_swapper.refresh(force=action == 'reload')
+        return jsonify(model_status())
+    except Exception as e:
+        logger.error(f"Error administering model versions: {str(e)}", exc_info=True)
+        return jsonify({'error': str(e)}), 500
+
+# Opt-in sampling profiler, toggled at runtime through /debug/profiler when ML_PROFILER=1
+PROFILER_ENABLED = os.getenv('ML_PROFILER', '0') == '1'
+profiler = SamplingProfiler(interval=float(os.getenv('ML_PROFILER_INTERVAL_MS', 5)) / 1000)
+
+@app.route('/debug/profiler', methods=['GET', 'POST'])
+def debug_profiler():
+    if not PROFILER_ENABLED:
+        return jsonify({'error': 'Profiler is disabled, start the service with ML_PROFILER=1'}), 404
+    try:
+        if request.method == 'POST':
+            data = request.get_json(silent=True) or {}
+            if data.get('enabled', True):
+                interval_ms = data.get('interval_ms')
+                profiler.start(float(interval_ms) / 1000 if interval_ms else None)
+                logger.info(f"Sampling profiler started in process {os.getpid()}")
+            else:
+                profiler.stop()
+                logger.info(f"Sampling profiler stopped in process {os.getpid()}")
+            return jsonify(profiler.status())
+
+        # ?format=collapsed returns the stacks for flame graph tools
+        if request.args.get('format') == 'collapsed':
+            limit = request.args.get('limit', type=int)
+            return Response(profiler.collapsed(limit), mimetype='text/plain')
+        return jsonify(profiler.status())
+    except Exception as e:
+        logger.error(f"Error controlling profiler: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+log_startup_report()
+
 if __name__ == '__main__':
+    # --startup-report loads everything lazily deferred, prints where the time went and exits
+    if '--startup-report' in sys.argv:
+        get_predictor()
+        print(startup_report())
+        sys.exit(0)
+
     try:
         port = int(os.getenv('ML_SERVICE_PORT', 5003))
         logger.info(f"Starting Flask application on port {port}...")
@@ -0,0 +1,340 @@
+"""Latency, throughput and memory benchmark for the ML service.
+
+Drives the Flask app either in-process through its test client or over a local
+socket, from a pool of client threads, and reports p50/p95/p99 latency,
+requests/s and resident memory per endpoint.
+
+    python benchmark.py --mode inprocess --concurrency 8
+    python benchmark.py --mode socket --workers 4        # starts serve.py on a free port
+    python benchmark.py --mode socket --url http://localhost:5003
+    python benchmark.py --save-baseline benchmark_baseline.json
+    python benchmark.py --baseline benchmark_baseline.json --max-regression 0.25
+
+With --baseline the run exits with status 1 when an endpoint's p95 latency or
+throughput is worse than the baseline by more than --max-regression.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import random
+import argparse
+import platform
+import threading
+import subprocess
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from features import DRUG_TYPE_CODES
+
+SERVICE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+DEFAULT_SCENARIOS = ['forecast', 'model_info', 'batch']
+
+
+def make_forecast_payloads(count, seed=0):
+    """Distinct, valid /predict/forecast bodies spread over drug types, dates and horizons"""
+    rng = random.Random(seed)
+    start = datetime(2025, 1, 1)
+    return [
+        {
+            'drug_type': rng.choice(DRUG_TYPE_CODES),
+            'date': (start + timedelta(days=rng.randrange(365))).strftime('%Y-%m-%d'),
+            'days': rng.choice([7, 14, 30, 60, 90]),
+            'stock_level': rng.randrange(0, 500)
+        }
+        for _ in range(count)
+    ]
+
+
+def build_scenarios(names, distinct, batch_size):
+    """Map scenario name to (method, path, list of JSON bodies)"""
+    payloads = make_forecast_payloads(distinct)
+    scenarios = {
+        'forecast': ('POST', '/predict/forecast', payloads),
+        'model_info': ('GET', '/model/info', [None]),
+        'batch': ('POST', '/predict/forecast/batch',
+                  [payloads[i:i + batch_size] for i in range(0, len(payloads) - batch_size + 1, batch_size)] or [payloads]),
+        'health': ('GET', '/health', [None]),
+    }
+    unknown = set(names) - set(scenarios)
+    if unknown:
+        raise ValueError(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+    return {name: scenarios[name] for name in names}
+
+
+def rss_mb(pid=None):
+    """Current resident set size of a process in MB, or None when unavailable"""
+    try:
+        with open(f"/proc/{pid or 'self'}/status") as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    try:
+        import psutil
+    except ImportError:
+        return None
+    try:
+        return psutil.Process(pid).memory_info().rss / (1024 * 1024)
+    except psutil.Error:
+        return None
+
+
+def child_pids(pid):
+    """Direct children of a process, read from /proc; empty when unavailable"""
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            return [int(child) for child in f.read().split()]
+    except OSError:
+        return []
+
+
+class InProcessClient:
+    """Sends requests through Flask's test client, one client per thread"""
+
+    def __init__(self):
+        sys.path.insert(0, SERVICE_DIR)
+        import app as flask_module
+        flask_module.get_predictor()
+        self.app = flask_module.app
+        self._local = threading.local()
+
+    def request(self, method, path, body):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+        response = client.open(path, method=method, json=body)
+        response.get_data()
+        return response.status_code
+
+    def rss_mb(self):
+        return rss_mb()
+
+    def close(self):
+        pass
+
+
+class SocketClient:
+    """Sends requests over HTTP keep-alive connections, one session per thread"""
+
+    def __init__(self, url, server=None):
+        import requests
+        self._requests = requests
+        self.url = url.rstrip('/')
+        self.server = server
+        self._local = threading.local()
+
+    def request(self, method, path, body):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = self._requests.Session()
+        response = session.request(method, self.url + path, json=body)
+        return response.status_code
+
+    def rss_mb(self):
+        """Summed RSS of the spawned server's master and workers, None for external servers"""
+        if self.server is None:
+            return None
+        pids = [self.server.pid] + child_pids(self.server.pid)
+        values = [rss_mb(pid) for pid in pids]
+        return sum(value for value in values if value is not None) if any(values) else None
+
+    def close(self):
+        if self.server is not None:
+            self.server.terminate()
+            try:
+                self.server.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                self.server.kill()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(workers, threads, timeout=120):
+    """Start serve.py on a free local port and wait until /health answers"""
+    import requests
+
+    port = free_port()
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(SERVICE_DIR, 'serve.py'), '--host', '127.0.0.1', '--port', str(port),
+         '--workers', str(workers), '--threads', str(threads), '--reload-interval', '0'],
+        cwd=SERVICE_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    url = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"serve.py exited with status {server.returncode}")
+        try:
+            if requests.get(url + '/health', timeout=1).status_code == 200:
+                return server, url
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    server.kill()
+    raise RuntimeError(f"serve.py did not become healthy within {timeout}s")
+
+
+def run_scenario(client, method, path, bodies, n_requests, concurrency, warmup):
+    """Issue n_requests from `concurrency` threads; returns the result dict of one endpoint"""
+    for i in range(warmup):
+        client.request(method, path, bodies[i % len(bodies)])
+
+    latencies = np.empty(n_requests)
+    statuses = np.empty(n_requests, dtype=np.int32)
+    counter = iter(range(n_requests))
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            start = time.perf_counter()
+            try:
+                statuses[i] = client.request(method, path, bodies[i % len(bodies)])
+            except Exception:
+                statuses[i] = 0
+            latencies[i] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for _ in range(concurrency):
+            executor.submit(worker)
+    elapsed = time.perf_counter() - start
+
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000
+    errors = int(np.count_nonzero((statuses < 200) | (statuses >= 300)))
+    return {
+        'method': method,
+        'path': path,
+        'requests': n_requests,
+        'errors': errors,
+        'p50_ms': float(p50),
+        'p95_ms': float(p95),
+        'p99_ms': float(p99),
+        'mean_ms': float(latencies.mean() * 1000),
+        'requests_per_second': n_requests / elapsed,
+        'rss_mb': client.rss_mb()
+    }
+
+
+def compare_with_baseline(results, baseline, max_regression):
+    """Return a list of human-readable regressions against a baseline run"""
+    regressions = []
+    for name, result in results.items():
+        reference = baseline.get('results', {}).get(name)
+        if reference is None:
+            continue
+        if result['p95_ms'] > reference['p95_ms'] * (1 + max_regression):
+            regressions.append(f"{name}: p95 {result['p95_ms']:.2f} ms vs baseline {reference['p95_ms']:.2f} ms")
+        if result['requests_per_second'] < reference['requests_per_second'] * (1 - max_regression):
+            regressions.append(f"{name}: {result['requests_per_second']:.0f} req/s vs baseline "
+                               f"{reference['requests_per_second']:.0f} req/s")
+    return regressions
+
+
+def format_table(results, baseline=None):
+    header = f"{'endpoint':<12} {'reqs':>6} {'err':>4} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'req/s':>9} {'RSS MB':>8}"
+    lines = [header, '-' * len(header)]
+    for name, r in results.items():
+        rss = f"{r['rss_mb']:.1f}" if r['rss_mb'] is not None else 'n/a'
+        line = (f"{name:<12} {r['requests']:>6} {r['errors']:>4} {r['p50_ms']:>8.2f} {r['p95_ms']:>8.2f} "
+                f"{r['p99_ms']:>8.2f} {r['requests_per_second']:>9.1f} {rss:>8}")
+        reference = (baseline or {}).get('results', {}).get(name)
+        if reference:
+            line += (f"   (p95 {r['p95_ms'] / reference['p95_ms'] - 1:+.0%}, "
+                     f"req/s {r['requests_per_second'] / reference['requests_per_second'] - 1:+.0%})")
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the ML service endpoints')
+    parser.add_argument('--mode', choices=['inprocess', 'socket'], default='inprocess')
+    parser.add_argument('--url', help='Benchmark an already running server instead of starting serve.py')
+    parser.add_argument('--workers', type=int, default=2, help='serve.py workers when starting a server')
+    parser.add_argument('--threads', type=int, default=4, help='serve.py threads per worker when starting a server')
+    parser.add_argument('--scenarios', default=','.join(DEFAULT_SCENARIOS),
+                        help='Comma-separated endpoints: forecast, model_info, batch, health')
+    parser.add_argument('--requests', type=int, default=2000, help='Requests per endpoint')
+    parser.add_argument('--concurrency', type=int, default=8, help='Client threads')
+    parser.add_argument('--warmup', type=int, default=50, help='Unmeasured requests per endpoint')
+    parser.add_argument('--distinct', type=int, default=1000, help='Distinct forecast payloads, bounds cache hits')
+    parser.add_argument('--batch-size', type=int, default=50, help='Forecasts per batch request')
+    parser.add_argument('--output', help='Write the results JSON to this path')
+    parser.add_argument('--save-baseline', help='Write the results as the baseline to this path')
+    parser.add_argument('--baseline', help='Compare against this baseline and exit 1 on regressions')
+    parser.add_argument('--max-regression', type=float, default=0.25,
+                        help='Accepted relative p95 or throughput regression against the baseline')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    scenarios = build_scenarios([s.strip() for s in args.scenarios.split(',') if s.strip()], args.distinct, args.batch_size)
+
+    if args.mode == 'inprocess':
+        client = InProcessClient()
+    elif args.url:
+        client = SocketClient(args.url)
+    else:
+        server, url = start_server(args.workers, args.threads)
+        client = SocketClient(url, server)
+
+    try:
+        results = {}
+        for name, (method, path, bodies) in scenarios.items():
+            results[name] = run_scenario(client, method, path, bodies, args.requests, args.concurrency, args.warmup)
+    finally:
+        client.close()
+
+    report = {
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'mode': args.mode,
+        'concurrency': args.concurrency,
+        'workers': args.workers if args.mode == 'socket' and not args.url else None,
+        'threads': args.threads if args.mode == 'socket' and not args.url else None,
+        'python': platform.python_version(),
+        'cpu_count': os.cpu_count(),
+        'results': results
+    }
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('mode') != args.mode or baseline.get('concurrency') != args.concurrency:
+            print(f"Warning: baseline was recorded with mode={baseline.get('mode')} "
+                  f"concurrency={baseline.get('concurrency')}", file=sys.stderr)
+
+    print(format_table(results, baseline))
+
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, 'w') as f:
+                json.dump(report, f, indent=2)
+            print(f"Results written to {path}")
+
+    if baseline is not None:
+        regressions = compare_with_baseline(results, baseline, args.max_regression)
+        if regressions:
+            print(f"Regressions beyond {args.max_regression:.0%}:")
+            for regression in regressions:
+                print(f"- {regression}")
+            sys.exit(1)
+        print("No regressions against the baseline")
+
+
+if __name__ == '__main__':
+    main()
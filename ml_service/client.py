@@ -0,0 +1,350 @@
+"""Python client for the ML service.
+
+One MLServiceClient keeps pooled keep-alive connections (one requests.Session
+per worker thread) and bounds the requests in flight with a thread pool.
+forecast_many splits large workloads into /predict/forecast/batch calls of
+batch_size forecasts and runs them concurrently; results come back in input
+order. Failed calls are retried with exponential backoff and jitter on
+connection errors, timeouts, 429 and 502-504 (honouring Retry-After). Every
+call's latency is recorded and summarised per endpoint.
+
+    from client import MLServiceClient
+
+    with MLServiceClient('http://localhost:5003', max_in_flight=8) as client:
+        results = client.forecast_many(forecasts)
+        print(client.latency_summary())
+
+AsyncMLServiceClient exposes the same calls as coroutines for asyncio jobs.
+
+    python client.py --url http://localhost:5003 --forecasts 20000
+"""
+import os
+import time
+import random
+import asyncio
+import logging
+import argparse
+import threading
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_URL = os.getenv('ML_SERVICE_URL', 'http://localhost:5003')
+
+# Statuses worth retrying: the request was not processed or the server is overloaded
+RETRY_STATUSES = (429, 502, 503, 504)
+
+
+class MLServiceError(Exception):
+    """A call failed with a non-retryable status or ran out of retries"""
+
+    def __init__(self, message, status=None, endpoint=None):
+        super().__init__(message)
+        self.status = status
+        self.endpoint = endpoint
+
+
+class CallRecord:
+    __slots__ = ('endpoint', 'status', 'seconds', 'attempts', 'items')
+
+    def __init__(self, endpoint, status, seconds, attempts, items):
+        self.endpoint = endpoint
+        self.status = status
+        self.seconds = seconds
+        self.attempts = attempts
+        self.items = items
+
+
+def _percentile(sorted_values, q):
+    # Nearest-rank percentile of an already sorted list
+    index = min(len(sorted_values) - 1, max(0, int(round(q / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+class LatencyRecorder:
+    """Per-call latencies, kept in memory and summarised per endpoint"""
+
+    def __init__(self):
+        self.records = []
+        self._lock = threading.Lock()
+
+    def add(self, record):
+        with self._lock:
+            self.records.append(record)
+
+    def reset(self):
+        with self._lock:
+            self.records = []
+
+    def summary(self):
+        with self._lock:
+            records = list(self.records)
+        endpoints = {}
+        for record in records:
+            endpoints.setdefault(record.endpoint, []).append(record)
+
+        summary = {}
+        for endpoint, calls in endpoints.items():
+            latencies = sorted(call.seconds for call in calls)
+            summary[endpoint] = {
+                'calls': len(calls),
+                'items': sum(call.items for call in calls),
+                'errors': sum(1 for call in calls if call.status is None or call.status >= 400),
+                'retries': sum(call.attempts - 1 for call in calls),
+                'mean_ms': sum(latencies) / len(latencies) * 1000,
+                'p50_ms': _percentile(latencies, 50) * 1000,
+                'p95_ms': _percentile(latencies, 95) * 1000,
+                'p99_ms': _percentile(latencies, 99) * 1000,
+                'max_ms': latencies[-1] * 1000
+            }
+        return summary
+
+
+class MLServiceClient:
+    def __init__(self, base_url=DEFAULT_URL, max_in_flight=8, batch_size=500, timeout=30.0,
+                 retries=3, backoff=0.1, max_backoff=5.0, on_call=None):
+        self.base_url = base_url.rstrip('/')
+        self.max_in_flight = max_in_flight
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.on_call = on_call
+        self.latency = LatencyRecorder()
+        self._local = threading.local()
+        self._sessions = []
+        self._sessions_lock = threading.Lock()
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+        with self._sessions_lock:
+            for session in self._sessions:
+                session.close()
+            self._sessions = []
+
+    @property
+    def executor(self):
+        """Thread pool bounding the calls in flight, created on first use"""
+        if self._executor is None:
+            with self._executor_lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.max_in_flight, thread_name_prefix='ml-client')
+        return self._executor
+
+    def _session(self):
+        # A session per thread: its pool keeps that thread's connection alive between calls
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1, max_retries=0)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self._local.session = session
+            with self._sessions_lock:
+                self._sessions.append(session)
+        return session
+
+    def _retry_delay(self, attempt, response=None):
+        if response is not None and response.headers.get('Retry-After'):
+            try:
+                return min(float(response.headers['Retry-After']), self.max_backoff)
+            except ValueError:
+                pass
+        # Exponential backoff with jitter so retrying clients do not move in lockstep
+        delay = min(self.backoff * (2 ** attempt), self.max_backoff)
+        return delay * random.uniform(0.5, 1.0)
+
+    def request(self, method, endpoint, items=1, **kwargs):
+        """Send one call with retries; returns the decoded JSON body"""
+        url = f'{self.base_url}{endpoint}'
+        kwargs.setdefault('timeout', self.timeout)
+        start = time.perf_counter()
+        status = None
+        attempt = 0
+        try:
+            while True:
+                response = None
+                try:
+                    response = self._session().request(method, url, **kwargs)
+                    status = response.status_code
+                except (requests.ConnectionError, requests.Timeout) as e:
+                    status = None
+                    if attempt >= self.retries:
+                        raise MLServiceError(f"{method} {endpoint} failed after {attempt + 1} attempts: {e}",
+                                             endpoint=endpoint)
+                else:
+                    if status not in RETRY_STATUSES or attempt >= self.retries:
+                        break
+                logger.debug(f"Retrying {method} {endpoint} (attempt {attempt + 1}, status {status})")
+                time.sleep(self._retry_delay(attempt, response))
+                attempt += 1
+        finally:
+            record = CallRecord(endpoint, status, time.perf_counter() - start, attempt + 1, items)
+            self.latency.add(record)
+            if self.on_call is not None:
+                self.on_call(record)
+
+        try:
+            body = response.json()
+        except ValueError:
+            body = None
+        if status >= 400:
+            message = body.get('error') if isinstance(body, dict) else response.text[:200]
+            raise MLServiceError(f"{method} {endpoint} returned {status}: {message}", status, endpoint)
+        return body
+
+    def drug_types(self):
+        return self.request('GET', '/drugs/types')
+
+    def model_info(self, **params):
+        return self.request('GET', '/model/info', params=params)
+
+    def health(self):
+        return self.request('GET', '/health')
+
+    def forecast(self, drug_type, date, days, stock_level):
+        return self.request('POST', '/predict/forecast', json={
+            'drug_type': drug_type, 'date': date, 'days': days, 'stock_level': stock_level
+        })
+
+    def series(self, date, days, stock_level, drug_types=None):
+        body = {'date': date, 'days': days, 'stock_level': stock_level}
+        if drug_types is not None:
+            body['drug_types'] = drug_types
+        return self.request('POST', '/predict/forecast/series', json=body)
+
+    def forecast_batch(self, forecasts):
+        """One /predict/forecast/batch call; forecasts are dicts with the /predict/forecast fields"""
+        return self.request('POST', '/predict/forecast/batch', items=len(forecasts),
+                            json={'requests': forecasts})['predictions']
+
+    def chunks(self, forecasts):
+        return [forecasts[i:i + self.batch_size] for i in range(0, len(forecasts), self.batch_size)]
+
+    def forecast_many(self, forecasts):
+        """Forecast any number of requests as concurrent batch calls, results in input order"""
+        forecasts = list(forecasts)
+        results = []
+        for batch in self.executor.map(self.forecast_batch, self.chunks(forecasts)):
+            results.extend(batch)
+        return results
+
+    def latency_summary(self):
+        return self.latency.summary()
+
+
+class AsyncMLServiceClient:
+    """asyncio front end of MLServiceClient.
+
+    Calls run on the wrapped client's pooled sessions in its thread pool, so
+    the event loop never blocks. At most max_in_flight calls are outstanding.
+    """
+
+    def __init__(self, base_url=DEFAULT_URL, max_in_flight=8, **kwargs):
+        self.client = MLServiceClient(base_url, max_in_flight=max_in_flight, **kwargs)
+        self._semaphore = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        await asyncio.get_running_loop().run_in_executor(None, self.client.close)
+
+    async def _call(self, function, *args, **kwargs):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.client.max_in_flight)
+        async with self._semaphore:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.client.executor, lambda: function(*args, **kwargs))
+
+    async def drug_types(self):
+        return await self._call(self.client.drug_types)
+
+    async def model_info(self, **params):
+        return await self._call(self.client.model_info, **params)
+
+    async def forecast(self, drug_type, date, days, stock_level):
+        return await self._call(self.client.forecast, drug_type, date, days, stock_level)
+
+    async def series(self, date, days, stock_level, drug_types=None):
+        return await self._call(self.client.series, date, days, stock_level, drug_types)
+
+    async def forecast_batch(self, forecasts):
+        return await self._call(self.client.forecast_batch, forecasts)
+
+    async def forecast_many(self, forecasts):
+        batches = await asyncio.gather(*(self.forecast_batch(chunk) for chunk in self.client.chunks(list(forecasts))))
+        return [result for batch in batches for result in batch]
+
+    def latency_summary(self):
+        return self.client.latency_summary()
+
+
+def log_latency_summary(summary, log=logger):
+    for endpoint, values in summary.items():
+        log.info(f"{endpoint}: {values['calls']} calls, {values['items']} items, {values['errors']} errors, "
+                 f"{values['retries']} retries, p50 {values['p50_ms']:.1f}ms, p95 {values['p95_ms']:.1f}ms, "
+                 f"p99 {values['p99_ms']:.1f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Drive the ML service with the pooled client and report throughput')
+    parser.add_argument('--url', default=DEFAULT_URL)
+    parser.add_argument('--forecasts', type=int, default=10000, help='Random forecasts to request')
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--max-in-flight', type=int, default=8)
+    parser.add_argument('--asyncio', action='store_true', help='Use the asyncio client')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    from features import DRUG_TYPE_CODES
+
+    rng = random.Random(args.seed)
+    start_date = datetime(2025, 1, 1)
+    forecasts = [{
+        'drug_type': rng.choice(DRUG_TYPE_CODES),
+        'date': (start_date + timedelta(days=rng.randrange(365))).strftime('%Y-%m-%d'),
+        'days': rng.choice([7, 14, 30, 60, 90]),
+        'stock_level': rng.randrange(10, 500)
+    } for _ in range(args.forecasts)]
+
+    options = {'max_in_flight': args.max_in_flight, 'batch_size': args.batch_size}
+    start = time.perf_counter()
+    if args.asyncio:
+        async def run():
+            async with AsyncMLServiceClient(args.url, **options) as client:
+                return await client.forecast_many(forecasts), client.latency_summary()
+        results, summary = asyncio.run(run())
+    else:
+        with MLServiceClient(args.url, **options) as client:
+            results = client.forecast_many(forecasts)
+            summary = client.latency_summary()
+    elapsed = time.perf_counter() - start
+
+    log_latency_summary(summary)
+    logger.info(f"{len(results)} forecasts in {elapsed:.2f}s ({len(results) / elapsed:,.0f} forecasts/s)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,358 @@
+"""Compact variant of the compiled model for lower memory per worker.
+
+Same trees as CompiledModel, stored in the smallest types that hold them:
+
+    feature     int8     feature index of each node
+    threshold   float32  rounded down from float64, see below
+    left/right  int16    node indices local to their tree; roots keep the offsets
+    value       float32, or int16 quantized with one scale per tree
+
+Rounding thresholds down to float32 is lossless. sklearn compares the float32
+input with the float64 threshold, and for a float32 x, x <= t holds exactly
+when x <= the largest float32 not above t. Every sample therefore still
+reaches the same leaf. Only the stored leaf values lose precision: at most
+half a float32 ulp each, or half a quantization step for int16.
+export_compact_artifact records the measured drift in the manifest.
+
+    python compact_model.py --export                  # float32 leaf values
+    python compact_model.py --export --values int16   # quantized leaf values
+    python compact_model.py --report                  # RSS, load time and drift vs the pickle
+
+The service serves it with ML_INFERENCE_BACKEND=compact.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import logging
+import subprocess
+
+import numpy as np
+
+from compiled_model import CompiledModel, DEFAULT_MODEL_PATH, artifact_path, file_sha256, load_artifact, parity_frame
+
+logger = logging.getLogger(__name__)
+
+COMPACT_FORMAT_VERSION = 1
+
+COMPACT_ARRAYS = [
+    'scaler_mean', 'scaler_scale', 'init', 'learning_rate', 'roots',
+    'feature', 'threshold', 'left', 'right', 'value', 'value_scale', 'feature_importances'
+]
+
+VALUE_TYPES = ('float32', 'int16')
+
+
+def round_down_float32(values):
+    """Largest float32 not above each float64 value"""
+    rounded = values.astype(np.float32)
+    above = rounded.astype(np.float64) > values
+    rounded[above] = np.nextafter(rounded[above], np.float32(-np.inf))
+    return rounded
+
+
+class CompactModel(CompiledModel):
+    """CompiledModel with narrow node arrays and tree-local child indices.
+
+    `value_scale` is None for float32 leaf values; for int16 it holds the
+    per-tree step that leaf values are multiplied by.
+    """
+
+    def __init__(self, *args, value_scale=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.value_scale = value_scale
+
+    @classmethod
+    def from_compiled(cls, compiled, values='float32'):
+        if values not in VALUE_TYPES:
+            raise ValueError(f"Unknown leaf value type {values}, use one of {VALUE_TYPES}")
+        roots = np.asarray(compiled.roots, dtype=np.int64)
+        n_nodes = len(compiled.value)
+        tree_sizes = np.diff(np.append(roots, n_nodes))
+        if tree_sizes.max() > np.iinfo(np.int16).max:
+            raise ValueError(f"A tree has {tree_sizes.max()} nodes, more than int16 node indices can address")
+        if len(compiled.feature_names) > np.iinfo(np.int8).max:
+            raise ValueError(f"{len(compiled.feature_names)} features do not fit int8 feature indices")
+
+        # Child indices relative to their tree's root; leaves keep pointing at themselves
+        node_roots = np.repeat(roots, tree_sizes)
+        left = (np.asarray(compiled.left) - node_roots).astype(np.int16)
+        right = (np.asarray(compiled.right) - node_roots).astype(np.int16)
+
+        value = np.asarray(compiled.value, dtype=np.float64)
+        value_scale = None
+        if values == 'float32':
+            stored_value = value.astype(np.float32)
+        else:
+            # One step per tree, sized so the tree's largest leaf maps to +-32767
+            node_trees = np.repeat(np.arange(len(roots)), tree_sizes)
+            max_abs = np.zeros(len(roots))
+            np.maximum.at(max_abs, node_trees, np.abs(value))
+            value_scale = np.where(max_abs > 0, max_abs / np.iinfo(np.int16).max, 1.0)
+            stored_value = np.round(value / value_scale[node_trees]).astype(np.int16)
+
+        return cls(
+            feature_names=compiled.feature_names,
+            scaler_mean=np.asarray(compiled.scaler_mean, dtype=np.float64),
+            scaler_scale=np.asarray(compiled.scaler_scale, dtype=np.float64),
+            init=np.asarray(compiled.init, dtype=np.float64),
+            learning_rate=np.asarray(compiled.learning_rate, dtype=np.float64),
+            roots=roots.astype(np.int32),
+            feature=np.asarray(compiled.feature).astype(np.int8),
+            threshold=round_down_float32(np.asarray(compiled.threshold, dtype=np.float64)),
+            left=left,
+            right=right,
+            value=stored_value,
+            value_scale=value_scale,
+            max_depth=compiled.max_depth,
+            feature_names_out=compiled.feature_names_out,
+            feature_importances=compiled.feature_importances
+        )
+
+    @property
+    def value_type(self):
+        return 'float32' if self.value_scale is None else 'int16'
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in COMPACT_ARRAYS if getattr(self, name) is not None)
+
+    def leaf_values(self, nodes):
+        """Float64 leaf values of global node indices, shape (n_samples, n_trees)"""
+        values = self.value[nodes].astype(np.float64)
+        if self.value_scale is not None:
+            values *= self.value_scale
+        return values
+
+    def predict(self, X):
+        """Predict all outputs for X, returning an array of shape (n_samples, n_outputs)"""
+        X = self._as_array(X)
+        n_samples = X.shape[0]
+        X = ((X - self.scaler_mean) / self.scaler_scale).astype(np.float32)
+
+        # Walk every tree for every sample in lockstep, on tree-local node indices
+        rows = np.arange(n_samples)[:, np.newaxis]
+        roots = self.roots.astype(np.intp)
+        nodes = np.broadcast_to(roots, (n_samples, len(roots)))
+        for _ in range(self.max_depth):
+            go_left = X[rows, self.feature[nodes]] <= self.threshold[nodes]
+            nodes = roots + np.where(go_left, self.left[nodes], self.right[nodes])
+
+        leaf_values = self.leaf_values(nodes).reshape(n_samples, self.n_outputs, self.n_stages)
+        terms = np.empty((n_samples, self.n_outputs, self.n_stages + 1))
+        terms[:, :, 0] = self.init
+        np.multiply(self.learning_rate[:, np.newaxis], leaf_values, out=terms[:, :, 1:])
+        return np.cumsum(terms, axis=2)[:, :, -1]
+
+    def save(self, directory, source_path=None, drift=None):
+        """Write the arrays as .npy files plus a model.json manifest, atomically like CompiledModel.save"""
+        directory = os.path.abspath(directory)
+        tmp_directory = directory + '.tmp'
+        shutil.rmtree(tmp_directory, ignore_errors=True)
+        os.makedirs(tmp_directory)
+
+        for name in COMPACT_ARRAYS:
+            array = getattr(self, name)
+            if array is not None:
+                np.save(os.path.join(tmp_directory, f'{name}.npy'), np.ascontiguousarray(array))
+
+        metadata = {
+            'format': 'compact',
+            'format_version': COMPACT_FORMAT_VERSION,
+            'value_type': self.value_type,
+            'feature_names': self.feature_names,
+            'feature_names_out': self.feature_names_out,
+            'max_depth': self.max_depth,
+            'drift': drift,
+            'source_sha256': file_sha256(source_path) if source_path else None
+        }
+        with open(os.path.join(tmp_directory, 'model.json'), 'w') as f:
+            json.dump(metadata, f, indent=2)
+
+        old_directory = directory + '.old'
+        shutil.rmtree(old_directory, ignore_errors=True)
+        if os.path.exists(directory):
+            os.replace(directory, old_directory)
+        os.replace(tmp_directory, directory)
+        shutil.rmtree(old_directory, ignore_errors=True)
+
+    @classmethod
+    def load(cls, directory, mmap=True):
+        with open(os.path.join(directory, 'model.json')) as f:
+            metadata = json.load(f)
+        if metadata.get('format') != 'compact' or metadata.get('format_version') != COMPACT_FORMAT_VERSION:
+            raise ValueError(f"Unsupported compact model artifact: {metadata.get('format')} {metadata.get('format_version')}")
+
+        arrays = {}
+        for name in COMPACT_ARRAYS:
+            path = os.path.join(directory, f'{name}.npy')
+            arrays[name] = np.load(path, mmap_mode='r' if mmap else None) if os.path.exists(path) else None
+
+        return cls(
+            feature_names=metadata['feature_names'],
+            max_depth=metadata['max_depth'],
+            feature_names_out=metadata.get('feature_names_out'),
+            **arrays
+        )
+
+
+def compact_artifact_path(model_path):
+    """Directory of the compact artifact for a pickled model, e.g. models/best_model_combined.compact/"""
+    return artifact_path(model_path) + '.compact'
+
+
+def measure_drift(reference, compact, frame, stock_level=100):
+    """How far compact predictions move from the reference model's on `frame`"""
+    expected = reference.predict(frame)
+    actual = compact.predict(frame)
+    difference = np.abs(expected - actual)
+    # The service truncates prediction * stock_level into the predicted quantity
+    quantity_changes = np.count_nonzero(np.trunc(expected * stock_level) != np.trunc(actual * stock_level))
+    return {
+        'predictions': int(expected.size),
+        'identical': int(np.count_nonzero(difference == 0)),
+        'max_abs': float(difference.max()),
+        'mean_abs': float(difference.mean()),
+        'max_rel': float((difference / np.maximum(np.abs(expected), 1e-12)).max()),
+        'quantity_changes_at_stock_100': int(quantity_changes)
+    }
+
+
+def quantization_bound(compact):
+    """Worst-case absolute error per output from rounding the leaf values"""
+    tree_sizes = np.diff(np.append(compact.roots, len(compact.value)))
+    if compact.value_scale is None:
+        # Half a float32 ulp of each tree's largest leaf
+        max_abs = np.zeros(len(compact.roots), dtype=np.float32)
+        np.maximum.at(max_abs, np.repeat(np.arange(len(compact.roots)), tree_sizes), np.abs(compact.value))
+        step = np.spacing(max_abs).astype(np.float64)
+    else:
+        step = np.asarray(compact.value_scale, dtype=np.float64)
+    # Every stage of an output contributes at most learning_rate * step / 2
+    per_tree = step.reshape(compact.n_outputs, compact.n_stages) / 2
+    return (compact.learning_rate * per_tree.sum(axis=1)).tolist()
+
+
+def export_compact_artifact(pipeline, model_path, values='float32', compiled=None):
+    """Build the compact artifact from the compiled one and save it with its measured drift"""
+    compiled = compiled or CompiledModel.from_pipeline(pipeline)
+    compact = CompactModel.from_compiled(compiled, values)
+    frame = parity_frame(compiled.feature_names)
+    drift = measure_drift(compiled, compact, frame)
+    drift['bound_per_output'] = quantization_bound(compact)
+    compact.save(compact_artifact_path(model_path), source_path=model_path, drift=drift)
+    logger.info(f"Exported {values} compact artifact to {compact_artifact_path(model_path)}: "
+                f"{compact.nbytes / 1024:.0f} KB, max abs drift {drift['max_abs']:.3e}")
+    return compact
+
+
+def load_compact_artifact(model_path, mmap=True):
+    """Load the compact artifact for model_path, or None when it is missing or stale"""
+    directory = compact_artifact_path(model_path)
+    manifest = os.path.join(directory, 'model.json')
+    if not os.path.exists(manifest):
+        return None
+    with open(manifest) as f:
+        source_sha256 = json.load(f).get('source_sha256')
+    if source_sha256 != file_sha256(model_path):
+        logger.warning(f"Compact model artifact {directory} does not match {model_path}, ignoring it")
+        return None
+    return CompactModel.load(directory, mmap=mmap)
+
+
+def rss_mb():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024
+    return None
+
+
+def measure_load(kind, model_path):
+    """Load one representation in this process; returns load time and RSS after serving a date sweep"""
+    import pandas as pd
+    from features import build_feature_frame
+
+    frame = build_feature_frame(pd.date_range('2013-01-01', '2030-12-31', freq='D'), 30)
+    rss_before = rss_mb()
+    start = time.perf_counter()
+    if kind == 'pickle':
+        import joblib
+        model = joblib.load(model_path)
+    elif kind == 'compiled':
+        model = load_artifact(model_path)
+    else:
+        model = load_compact_artifact(model_path)
+    if model is None:
+        raise FileNotFoundError(f"No {kind} artifact for {model_path}")
+    load_seconds = time.perf_counter() - start
+    # Serve the sweep in micro-batch sized chunks so every tree is resident but
+    # the RSS is not dominated by one huge batch's temporaries
+    for offset in range(0, len(frame), 256):
+        model.predict(frame.iloc[offset:offset + 256])
+    return {
+        'load_seconds': load_seconds,
+        'rss_mb': rss_mb(),
+        'rss_delta_mb': rss_mb() - rss_before
+    }
+
+
+def report(model_path):
+    """Compare the pickle, the compiled artifact and the compact artifact in fresh processes"""
+    results = {}
+    for kind in ('pickle', 'compiled', 'compact'):
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--model', model_path, '--measure', kind],
+            check=True, capture_output=True, text=True
+        ).stdout
+        results[kind] = json.loads(output.strip().splitlines()[-1])
+
+    import joblib
+    pipeline = joblib.load(model_path)
+    compact = load_compact_artifact(model_path)
+    results['compact']['value_type'] = compact.value_type
+    results['compact']['drift'] = measure_drift(pipeline, compact, parity_frame(compact.feature_names))
+    results['compact']['drift']['bound_per_output'] = quantization_bound(compact)
+    results['pickle']['disk_kb'] = os.path.getsize(model_path) / 1024
+    for kind, directory in (('compiled', artifact_path(model_path)), ('compact', compact_artifact_path(model_path))):
+        results[kind]['disk_kb'] = sum(
+            os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory)) / 1024
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export and evaluate the compact float32/int16 model artifact')
+    parser.add_argument('--model', default=DEFAULT_MODEL_PATH, help='Path to the pickled model pipeline')
+    parser.add_argument('--export', action='store_true', help='Write the compact artifact next to the model')
+    parser.add_argument('--values', choices=VALUE_TYPES, default='float32', help='Storage type of the leaf values')
+    parser.add_argument('--report', action='store_true', help='Compare RSS, load time and drift against the pickle')
+    parser.add_argument('--measure', choices=('pickle', 'compiled', 'compact'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        print(json.dumps(measure_load(args.measure, args.model)))
+        return
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    if args.export:
+        import joblib
+        export_compact_artifact(joblib.load(args.model), args.model, args.values)
+
+    if args.report:
+        results = report(args.model)
+        logger.info(f"{'':10}{'load ms':>10}{'RSS MB':>10}{'RSS delta MB':>14}{'disk KB':>10}")
+        for kind, values in results.items():
+            logger.info(f"{kind:10}{values['load_seconds'] * 1000:>10.2f}{values['rss_mb']:>10.1f}"
+                        f"{values['rss_delta_mb']:>14.2f}{values['disk_kb']:>10.0f}")
+        drift = results['compact']['drift']
+        logger.info(f"Compact ({results['compact']['value_type']}) vs pickle over {drift['predictions']} predictions: "
+                    f"{drift['identical']} identical, max abs {drift['max_abs']:.3e}, max rel {drift['max_rel']:.3e}, "
+                    f"{drift['quantity_changes_at_stock_100']} predicted quantities changed at stock level 100")
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
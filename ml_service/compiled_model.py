@@ -0,0 +1,341 @@
+import os
+import sys
+import json
+import shutil
+import hashlib
+import argparse
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MODEL_PATH = os.path.join(os.path.dirname(__file__), 'models', 'best_model_combined.pkl')
+
+TREE_LEAF = -1
+
+ARTIFACT_FORMAT_VERSION = 1
+
+# Arrays written as individual .npy files so they can be memory-mapped on load
+ARTIFACT_ARRAYS = [
+    'scaler_mean', 'scaler_scale', 'init', 'learning_rate', 'roots',
+    'feature', 'threshold', 'left', 'right', 'value', 'feature_importances'
+]
+
+
+class CompiledModel:
+    """Flat NumPy evaluator for the combined StandardScaler + GradientBoosting pipeline.
+
+    All trees of all outputs are stored back to back in shared node arrays, tree
+    `k * n_stages + i` being stage `i` of output `k`. Leaves point to themselves so
+    every sample can walk `max_depth` levels without branching. Predictions are
+    bit-identical to the sklearn pipeline: inputs are scaled in float64, compared
+    as float32 like sklearn's tree code, and stage contributions are summed in
+    stage order.
+    """
+
+    def __init__(self, feature_names, scaler_mean, scaler_scale, init, learning_rate,
+                 roots, feature, threshold, left, right, value, max_depth,
+                 feature_names_out=None, feature_importances=None):
+        self.feature_names = list(feature_names)
+        self.scaler_mean = scaler_mean
+        self.scaler_scale = scaler_scale
+        self.init = init
+        self.learning_rate = learning_rate
+        self.roots = roots
+        self.feature = feature
+        self.threshold = threshold
+        self.left = left
+        self.right = right
+        self.value = value
+        self.max_depth = int(max_depth)
+        # Kept for /model/info so serving never needs the sklearn pipeline
+        self.feature_names_out = list(feature_names_out) if feature_names_out is not None else None
+        self.feature_importances = feature_importances
+
+    @property
+    def feature_names_in_(self):
+        return np.asarray(self.feature_names, dtype=object)
+
+    @property
+    def n_outputs(self):
+        return self.init.shape[0]
+
+    @property
+    def n_stages(self):
+        return self.roots.shape[0] // self.n_outputs
+
+    @staticmethod
+    def supports(pipeline):
+        """Whether from_pipeline can flatten this pipeline: every output a GradientBoostingRegressor"""
+        from sklearn.ensemble import GradientBoostingRegressor
+
+        regressor = pipeline.named_steps.get('model')
+        estimators = getattr(regressor, 'estimators_', None)
+        return bool(estimators) and all(isinstance(est, GradientBoostingRegressor) for est in estimators)
+
+    @classmethod
+    def from_pipeline(cls, pipeline):
+        """Flatten a fitted Pipeline(ColumnTransformer(StandardScaler), MultiOutputRegressor(GBR))"""
+        preprocessor = pipeline.named_steps['preprocessor']
+        transformers = [t for t in preprocessor.transformers_ if t[0] != 'remainder']
+        if len(transformers) != 1:
+            raise ValueError("Expected a single StandardScaler transformer in the preprocessor")
+        _, scaler, columns = transformers[0]
+
+        estimators = pipeline.named_steps['model'].estimators_
+        n_stages = max(est.estimators_.shape[0] for est in estimators)
+
+        init = np.empty(len(estimators))
+        learning_rate = np.empty(len(estimators))
+        trees = []
+        for k, est in enumerate(estimators):
+            if est.init_ == 'zero':
+                init[k] = 0.0
+            else:
+                init[k] = float(np.ravel(est.init_.constant_)[0])
+            learning_rate[k] = est.learning_rate
+            stages = [stage[0].tree_ for stage in est.estimators_]
+            # Estimators stopped early are padded with single-leaf zero trees
+            stages += [None] * (n_stages - len(stages))
+            trees.extend(stages)
+
+        roots = np.empty(len(trees), dtype=np.int64)
+        features, thresholds, lefts, rights, values = [], [], [], [], []
+        offset = 0
+        max_depth = 0
+        for t, tree in enumerate(trees):
+            roots[t] = offset
+            if tree is None:
+                n_nodes = 1
+                left = np.array([TREE_LEAF])
+                right = np.array([TREE_LEAF])
+                feature = np.zeros(1, dtype=np.int64)
+                threshold = np.zeros(1)
+                value = np.zeros(1)
+            else:
+                n_nodes = tree.node_count
+                left = tree.children_left.astype(np.int64)
+                right = tree.children_right.astype(np.int64)
+                feature = tree.feature.astype(np.int64)
+                threshold = tree.threshold.astype(np.float64)
+                value = tree.value[:, 0, 0].astype(np.float64)
+                max_depth = max(max_depth, tree.max_depth)
+
+            # Leaves loop back onto themselves
+            node_ids = np.arange(n_nodes)
+            is_leaf = left == TREE_LEAF
+            left = np.where(is_leaf, node_ids, left) + offset
+            right = np.where(is_leaf, node_ids, right) + offset
+            feature = np.where(is_leaf, 0, feature)
+
+            features.append(feature)
+            thresholds.append(threshold)
+            lefts.append(left)
+            rights.append(right)
+            values.append(value)
+            offset += n_nodes
+
+        return cls(
+            feature_names=list(columns),
+            scaler_mean=np.asarray(scaler.mean_, dtype=np.float64) if scaler.with_mean else np.zeros(len(columns)),
+            scaler_scale=np.asarray(scaler.scale_, dtype=np.float64) if scaler.with_std else np.ones(len(columns)),
+            init=init,
+            learning_rate=learning_rate,
+            roots=roots,
+            feature=np.concatenate(features),
+            threshold=np.concatenate(thresholds),
+            left=np.concatenate(lefts),
+            right=np.concatenate(rights),
+            value=np.concatenate(values),
+            max_depth=max_depth,
+            feature_names_out=preprocessor.get_feature_names_out(),
+            feature_importances=np.vstack([est.feature_importances_ for est in estimators])
+        )
+
+    def save(self, directory, source_path=None):
+        """Write the arrays as .npy files plus a model.json manifest.
+
+        The export is assembled in a temporary directory and moved into place, so
+        readers never see a partially written artifact.
+        """
+        directory = os.path.abspath(directory)
+        tmp_directory = directory + '.tmp'
+        shutil.rmtree(tmp_directory, ignore_errors=True)
+        os.makedirs(tmp_directory)
+
+        for name in ARTIFACT_ARRAYS:
+            array = getattr(self, name)
+            if array is not None:
+                np.save(os.path.join(tmp_directory, f'{name}.npy'), np.ascontiguousarray(array))
+
+        metadata = {
+            'format_version': ARTIFACT_FORMAT_VERSION,
+            'feature_names': self.feature_names,
+            'feature_names_out': self.feature_names_out,
+            'max_depth': self.max_depth,
+            'source_sha256': file_sha256(source_path) if source_path else None
+        }
+        with open(os.path.join(tmp_directory, 'model.json'), 'w') as f:
+            json.dump(metadata, f, indent=2)
+
+        old_directory = directory + '.old'
+        shutil.rmtree(old_directory, ignore_errors=True)
+        if os.path.exists(directory):
+            os.replace(directory, old_directory)
+        os.replace(tmp_directory, directory)
+        shutil.rmtree(old_directory, ignore_errors=True)
+
+    @classmethod
+    def load(cls, directory, mmap=True):
+        """Load an exported artifact, memory-mapping its arrays by default"""
+        with open(os.path.join(directory, 'model.json')) as f:
+            metadata = json.load(f)
+        if metadata.get('format_version') != ARTIFACT_FORMAT_VERSION:
+            raise ValueError(f"Unsupported model artifact format: {metadata.get('format_version')}")
+
+        arrays = {}
+        for name in ARTIFACT_ARRAYS:
+            path = os.path.join(directory, f'{name}.npy')
+            arrays[name] = np.load(path, mmap_mode='r' if mmap else None) if os.path.exists(path) else None
+
+        return cls(
+            feature_names=metadata['feature_names'],
+            max_depth=metadata['max_depth'],
+            feature_names_out=metadata.get('feature_names_out'),
+            **arrays
+        )
+
+    def _as_array(self, X):
+        if hasattr(X, 'columns'):
+            X = X[self.feature_names].to_numpy(dtype=np.float64)
+        return np.asarray(X, dtype=np.float64).reshape(-1, len(self.feature_names))
+
+    def predict(self, X):
+        """Predict all outputs for X, returning an array of shape (n_samples, n_outputs)"""
+        X = self._as_array(X)
+        n_samples = X.shape[0]
+
+        # StandardScaler.transform, then the float32 cast sklearn's trees apply
+        X = ((X - self.scaler_mean) / self.scaler_scale).astype(np.float32)
+
+        # Walk every tree for every sample in lockstep
+        rows = np.arange(n_samples)[:, np.newaxis]
+        node = np.broadcast_to(self.roots, (n_samples, len(self.roots)))
+        for _ in range(self.max_depth):
+            go_left = X[rows, self.feature[node]] <= self.threshold[node]
+            node = np.where(go_left, self.left[node], self.right[node])
+
+        # Sum the init value and the scaled stage contributions sequentially, in
+        # stage order, exactly like sklearn's predict_stages
+        leaf_values = self.value[node].reshape(n_samples, self.n_outputs, self.n_stages)
+        terms = np.empty((n_samples, self.n_outputs, self.n_stages + 1))
+        terms[:, :, 0] = self.init
+        np.multiply(self.learning_rate[:, np.newaxis], leaf_values, out=terms[:, :, 1:])
+        return np.cumsum(terms, axis=2)[:, :, -1]
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def artifact_path(model_path):
+    """Directory of the exported artifact for a pickled model, e.g. models/best_model_combined/"""
+    return os.path.splitext(model_path)[0]
+
+
+def export_artifact(pipeline, model_path):
+    """Compile a fitted pipeline and export it next to its pickle.
+
+    Pipelines the compiler does not support (e.g. HistGradientBoosting) get no
+    artifact and are served by sklearn; returns None for them.
+    """
+    if not CompiledModel.supports(pipeline):
+        logger.info(f"No compiled artifact for {model_path}: unsupported estimator, it is served by sklearn")
+        return None
+    compiled = CompiledModel.from_pipeline(pipeline)
+    compiled.save(artifact_path(model_path), source_path=model_path)
+    return compiled
+
+
+def load_artifact(model_path, mmap=True):
+    """Load the exported artifact for model_path, or None when it is missing or stale"""
+    directory = artifact_path(model_path)
+    manifest = os.path.join(directory, 'model.json')
+    if not os.path.exists(manifest):
+        return None
+    compiled = CompiledModel.load(directory, mmap=mmap)
+    with open(manifest) as f:
+        source_sha256 = json.load(f).get('source_sha256')
+    if source_sha256 != file_sha256(model_path):
+        logger.warning(f"Model artifact {directory} does not match {model_path}, ignoring it")
+        return None
+    return compiled
+
+
+def parity_frame(feature_names, n_random=5000, seed=0):
+    """Calendar inputs for 2013-2030 plus random inputs around and beyond their range"""
+    import pandas as pd
+    from features import build_feature_frame
+
+    dates = pd.date_range('2013-01-01', '2030-12-31', freq='D')
+    frames = [build_feature_frame(dates, days) for days in (1, 7, 30, 90)]
+
+    # Random inputs around and beyond the training range exercise every split
+    rng = np.random.default_rng(seed)
+    random_frame = build_feature_frame(dates[:n_random], 30)
+    for column in feature_names:
+        low, high = random_frame[column].min(), random_frame[column].max()
+        spread = max(high - low, 1.0)
+        random_frame[column] = rng.uniform(low - spread, high + spread, n_random)
+    frames.append(random_frame)
+    return pd.concat(frames, ignore_index=True)
+
+
+def verify_parity(pipeline, compiled, n_random=5000, seed=0):
+    """Compare compiled and sklearn predictions on calendar and random inputs.
+
+    Returns the number of mismatching predictions, 0 meaning bit-identical.
+    """
+    frame = parity_frame(compiled.feature_names, n_random, seed)
+    expected = pipeline.predict(frame)
+    actual = compiled.predict(frame)
+    mismatches = int(np.count_nonzero(expected != actual))
+    logger.info(f"Compared {expected.size} predictions, {mismatches} mismatches, "
+                f"max abs difference {np.max(np.abs(expected - actual)):.3e}")
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compile the combined model into flat array-based trees')
+    parser.add_argument('--model', default=DEFAULT_MODEL_PATH, help='Path to the pickled model pipeline')
+    parser.add_argument('--check', action='store_true', help='Verify bit-identical predictions against the pipeline')
+    parser.add_argument('--export', action='store_true', help='Write the memory-mappable artifact next to the model')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    import joblib
+    pipeline = joblib.load(args.model)
+    compiled = CompiledModel.from_pipeline(pipeline)
+    logger.info(f"Compiled {compiled.n_outputs} outputs x {compiled.n_stages} stages, "
+                f"{compiled.value.shape[0]} nodes, max depth {compiled.max_depth}")
+
+    if args.export:
+        compiled.save(artifact_path(args.model), source_path=args.model)
+        logger.info(f"Exported model artifact to {artifact_path(args.model)}")
+
+    if args.check:
+        if verify_parity(pipeline, compiled) != 0:
+            sys.exit(1)
+        # The exported artifact must round-trip to the same predictions
+        if args.export and verify_parity(pipeline, CompiledModel.load(artifact_path(args.model))) != 0:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
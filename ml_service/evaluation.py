@@ -0,0 +1,206 @@
+"""Model evaluation: vectorized per-drug metrics and time-based cross-validation.
+
+Metrics for all drug types are computed column-wise from a single predict pass.
+Cross-validation uses expanding-window folds ordered by the sales timestamp and
+fits the folds in a process pool. Results are written as JSON next to the
+model, e.g. models/best_model_combined.metrics.json.
+
+    python evaluation.py                 # in-sample metrics of the published model
+    python evaluation.py --cv-folds 5    # plus time-based cross-validation
+"""
+import os
+import json
+import time
+import logging
+import argparse
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MODEL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'models', 'best_model_combined.pkl')
+
+# Quantiles of the absolute error reported per drug type
+ERROR_QUANTILES = (0.5, 0.9, 0.95, 0.99)
+
+
+def _finite_or_none(value):
+    value = float(value)
+    return value if np.isfinite(value) else None
+
+
+def regression_metrics(y_true, y_pred, names, quantiles=ERROR_QUANTILES):
+    """Per-column MSE, MAE, R², MAPE and absolute-error quantiles of two (n, k) arrays.
+
+    MAPE is computed over the rows with a non-zero target only, as most drug
+    types have many zero-sales rows.
+    """
+    y_true = np.asarray(y_true, dtype=np.float64)
+    y_pred = np.asarray(y_pred, dtype=np.float64)
+    errors = y_true - y_pred
+    abs_errors = np.abs(errors)
+
+    mse = np.mean(errors ** 2, axis=0)
+    mae = np.mean(abs_errors, axis=0)
+    ss_res = np.sum(errors ** 2, axis=0)
+    ss_tot = np.sum((y_true - y_true.mean(axis=0)) ** 2, axis=0)
+    # Same convention as sklearn's r2_score for constant targets
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r2 = np.where(ss_tot > 0, 1 - ss_res / ss_tot, np.where(ss_res == 0, 1.0, 0.0))
+
+    nonzero = y_true != 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        relative = np.where(nonzero, abs_errors / np.abs(y_true), 0.0)
+        mape = relative.sum(axis=0) / nonzero.sum(axis=0)
+    error_quantiles = np.quantile(abs_errors, quantiles, axis=0)
+
+    per_drug = {}
+    for i, name in enumerate(names):
+        per_drug[name] = {
+            'mse': float(mse[i]),
+            'mae': float(mae[i]),
+            'r2': float(r2[i]),
+            'mape': _finite_or_none(mape[i]),
+            'abs_error_quantiles': {f'p{round(q * 100)}': float(error_quantiles[j, i]) for j, q in enumerate(quantiles)}
+        }
+    overall = {
+        'mse': float(mse.mean()),
+        'mae': float(mae.mean()),
+        'r2': float(r2.mean())
+    }
+    return {'rows': int(y_true.shape[0]), 'per_drug': per_drug, 'overall': overall}
+
+
+def evaluate_predictions(model, X, y):
+    """Predict once and compute the metrics of every target column"""
+    start = time.perf_counter()
+    y_pred = model.predict(X)
+    metrics = regression_metrics(y, y_pred, list(y.columns))
+    metrics['predict_seconds'] = time.perf_counter() - start
+    return metrics
+
+
+def time_series_folds(timestamps, n_splits):
+    """Expanding-window folds over rows sorted by timestamp, like sklearn's TimeSeriesSplit.
+
+    Returns (train_indices, test_indices) pairs; every test block is later than
+    all rows of its training set.
+    """
+    order = np.argsort(np.asarray(timestamps), kind='stable')
+    test_size = len(order) // (n_splits + 1)
+    if n_splits < 2 or test_size == 0:
+        raise ValueError(f"Cannot make {n_splits} time-based folds from {len(order)} rows")
+    folds = []
+    for k in range(n_splits):
+        test_start = len(order) - (n_splits - k) * test_size
+        folds.append((order[:test_start], order[test_start:test_start + test_size]))
+    return folds
+
+
+def _score_fold(estimator, X, y, train_index, test_index):
+    # Runs in a worker process
+    from sklearn.base import clone
+
+    start = time.perf_counter()
+    fold_model = clone(estimator).fit(X.iloc[train_index], y.iloc[train_index])
+    metrics = evaluate_predictions(fold_model, X.iloc[test_index], y.iloc[test_index])
+    metrics['train_rows'] = int(len(train_index))
+    metrics['fit_seconds'] = time.perf_counter() - start - metrics['predict_seconds']
+    return metrics
+
+
+def cross_validate(estimator, X, y, timestamps, n_splits=5, n_workers=None):
+    """Fit and score an unfitted clone of `estimator` on each time-based fold"""
+    folds = time_series_folds(timestamps, n_splits)
+    n_workers = min(n_workers or os.cpu_count() or 1, n_splits)
+    timestamps = np.asarray(timestamps)
+
+    start = time.perf_counter()
+    if n_workers == 1:
+        results = [_score_fold(estimator, X, y, train, test) for train, test in folds]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = [executor.submit(_score_fold, estimator, X, y, train, test) for train, test in folds]
+            results = [future.result() for future in futures]
+
+    for (_, test), metrics in zip(folds, results):
+        metrics['test_start'] = str(timestamps[test].min())
+        metrics['test_end'] = str(timestamps[test].max())
+    logger.info(f"Cross-validated {n_splits} folds with {n_workers} workers in {time.perf_counter() - start:.2f}s")
+
+    names = list(y.columns)
+    mean = {
+        name: {
+            metric: float(np.mean([fold['per_drug'][name][metric] for fold in results]))
+            for metric in ('mse', 'mae', 'r2')
+        }
+        for name in names
+    }
+    return {'n_splits': n_splits, 'folds': results, 'mean_per_drug': mean}
+
+
+def metrics_path(model_path):
+    """Path of the metrics JSON for a pickled model, e.g. models/best_model_combined.metrics.json"""
+    return os.path.splitext(model_path)[0] + '.metrics.json'
+
+
+def write_metrics(report, model_path):
+    """Write the metrics report next to the model, replacing any previous one atomically"""
+    from compiled_model import file_sha256
+
+    report = {
+        'model_path': os.path.basename(model_path),
+        'model_sha256': file_sha256(model_path) if os.path.exists(model_path) else None,
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        **report
+    }
+    path = metrics_path(model_path)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    os.replace(tmp_path, path)
+    return path
+
+
+def log_metrics(metrics, log=logger):
+    for name, values in metrics['per_drug'].items():
+        mape = f"{values['mape']:.2%}" if values['mape'] is not None else 'n/a'
+        quantiles = ', '.join(f"{q} {v:.4f}" for q, v in values['abs_error_quantiles'].items())
+        log.info(f"{name}: MSE {values['mse']:.4f}, MAE {values['mae']:.4f}, R2 {values['r2']:.4f}, "
+                 f"MAPE {mape}, |error| {quantiles}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Evaluate the combined model and write its metrics JSON')
+    parser.add_argument('--model', default=DEFAULT_MODEL_PATH, help='Path to the pickled model pipeline')
+    parser.add_argument('--cv-folds', type=int, default=0, help='Time-based cross-validation folds, 0 disables')
+    parser.add_argument('--workers', type=int, default=int(os.getenv('TRAIN_WORKERS', os.cpu_count() or 1)),
+                        help='Processes used to fit the cross-validation folds')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    import joblib
+    from feature_store import FeatureStore
+    from ingest import to_training_frame
+
+    store = FeatureStore()
+    store.refresh()
+    columns = store.load_columns()
+    X, y = to_training_frame(columns)
+    model = joblib.load(args.model)
+
+    report = {'in_sample': evaluate_predictions(model, X, y)}
+    log_metrics(report['in_sample'])
+    if args.cv_folds:
+        report['cross_validation'] = cross_validate(model, X, y, columns['datum'], args.cv_folds, args.workers)
+        for fold in report['cross_validation']['folds']:
+            logger.info(f"Fold {fold['test_start']} to {fold['test_end']}: overall MSE {fold['overall']['mse']:.4f}, "
+                        f"R2 {fold['overall']['r2']:.4f}")
+    logger.info(f"Wrote metrics to {write_metrics(report, args.model)}")
+
+
+if __name__ == '__main__':
+    main()
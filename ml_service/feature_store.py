@@ -0,0 +1,243 @@
+import io
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+import argparse
+
+import numpy as np
+
+from ingest import DEFAULT_CHUNKSIZE, SALES_SOURCES, iter_feature_chunks, peak_rss_mb, to_training_frame
+
+logger = logging.getLogger(__name__)
+
+STORE_FORMAT_VERSION = 2
+
+DEFAULT_DATA_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_CACHE_DIR = os.path.join(DEFAULT_DATA_DIR, 'feature_cache')
+
+HASH_BLOCK_SIZE = 1 << 20
+
+# Appends beyond this many parts are compacted into one, so loads stay a handful of files per column
+MAX_PARTS = 32
+
+
+def hash_file(path, prefix_size=None):
+    """Return (sha256 of the whole file, sha256 of its first prefix_size bytes, size)"""
+    digest = hashlib.sha256()
+    prefix_digest = None
+    size = 0
+    with open(path, 'rb') as f:
+        if prefix_size is not None:
+            remaining = prefix_size
+            while remaining > 0:
+                block = f.read(min(HASH_BLOCK_SIZE, remaining))
+                if not block:
+                    break
+                digest.update(block)
+                size += len(block)
+                remaining -= len(block)
+            prefix_digest = digest.hexdigest() if remaining == 0 else None
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+            size += len(block)
+    return digest.hexdigest(), prefix_digest, size
+
+
+def read_appended_bytes(path, offset):
+    """Return the header line plus everything after offset, as a CSV file object"""
+    with open(path, 'rb') as f:
+        header = f.readline()
+        f.seek(offset)
+        return io.BytesIO(header + f.read())
+
+
+class FeatureStore:
+    """Columnar .npy cache of the engineered features and targets of each sales CSV.
+
+    Every source file gets a directory of parts, each a directory of per-column
+    .npy files, and manifest.json records the size and sha256 of the bytes the
+    parts were built from and which parts are current. On refresh, unchanged
+    files are skipped and files that only grew are parsed from the previously
+    recorded size onwards into a new part, so an append writes only the new rows.
+
+    Parts are written before the manifest that lists them, so a crash in between
+    leaves an unlisted part that the next refresh removes and writes again; rows
+    are never appended twice.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, data_dir=DEFAULT_DATA_DIR, sources=SALES_SOURCES):
+        self.cache_dir = cache_dir
+        self.data_dir = data_dir
+        self.sources = sources
+        self.manifest_path = os.path.join(cache_dir, 'manifest.json')
+        self.manifest = self._read_manifest()
+
+    def _read_manifest(self):
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+            if manifest.get('format_version') == STORE_FORMAT_VERSION:
+                return manifest
+        return {'format_version': STORE_FORMAT_VERSION, 'sources': {}}
+
+    def _write_manifest(self):
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(tmp_path, self.manifest_path)
+
+    def _source_dir(self, filename):
+        return os.path.join(self.cache_dir, os.path.splitext(filename)[0])
+
+    def _parse(self, source, date_format, chunksize):
+        parts = [columns for columns in iter_feature_chunks(source, date_format, chunksize)]
+        if not parts:
+            return None
+        return {name: np.concatenate([part[name] for part in parts]) for name in parts[0]}
+
+    def _new_part(self, filename, columns, in_use=()):
+        """Write columns into a part directory that neither the manifest nor in_use lists; returns its name"""
+        directory = self._source_dir(filename)
+        os.makedirs(directory, exist_ok=True)
+        listed = [*self.manifest['sources'].get(filename, {}).get('parts', []), *in_use]
+        numbers = [int(name.split('-')[1]) for name in listed]
+        part = f'part-{max(numbers, default=-1) + 1:05d}'
+        part_dir = os.path.join(directory, part)
+        # Left over from a refresh that died before its manifest write
+        shutil.rmtree(part_dir, ignore_errors=True)
+        os.makedirs(part_dir)
+        for name, array in columns.items():
+            np.save(os.path.join(part_dir, f'{name}.npy'), array)
+        return part
+
+    def _remove_unlisted(self, filename):
+        """Delete parts and files of a source directory that the manifest no longer lists"""
+        directory = self._source_dir(filename)
+        listed = set(self.manifest['sources'][filename]['parts'])
+        for name in os.listdir(directory):
+            if name not in listed:
+                path = os.path.join(directory, name)
+                if os.path.isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                else:
+                    os.remove(path)
+
+    def refresh(self, chunksize=DEFAULT_CHUNKSIZE):
+        """Bring the cache up to date with the source files; returns the action per file"""
+        actions = {}
+        os.makedirs(self.cache_dir, exist_ok=True)
+        for filename, time_period, date_format in self.sources:
+            path = os.path.join(self.data_dir, filename)
+            entry = self.manifest['sources'].get(filename)
+            sha256, prefix_sha256, size = hash_file(path, entry['size'] if entry else None)
+
+            if entry and entry['sha256'] == sha256:
+                actions[filename] = 'cached'
+                continue
+
+            start = time.perf_counter()
+            # Only new rows were appended when the old bytes are an intact, newline-terminated prefix
+            appended = bool(entry) and prefix_sha256 == entry['sha256'] and entry.get('ends_with_newline', False)
+            if appended:
+                columns = self._parse(read_appended_bytes(path, entry['size']), date_format, chunksize)
+                rows = entry['rows']
+                parts = list(entry['parts'])
+                if columns is not None:
+                    parts.append(self._new_part(filename, columns))
+                    rows += len(columns['datum'])
+                if len(parts) > MAX_PARTS:
+                    compacted = self.load_source_columns(filename, mmap=True, parts=parts)
+                    parts = [self._new_part(filename, compacted, in_use=parts)]
+                actions[filename] = 'appended'
+            else:
+                columns = self._parse(path, date_format, chunksize)
+                if columns is None:
+                    raise ValueError(f"{filename} contains no rows")
+                parts = [self._new_part(filename, columns)]
+                rows = len(columns['datum'])
+                actions[filename] = 'rebuilt'
+
+            with open(path, 'rb') as f:
+                f.seek(max(size - 1, 0))
+                ends_with_newline = f.read(1) == b'\n'
+            self.manifest['sources'][filename] = {
+                'time_period': time_period,
+                'size': size,
+                'sha256': sha256,
+                'rows': rows,
+                'ends_with_newline': ends_with_newline,
+                'parts': parts
+            }
+            self._write_manifest()
+            self._remove_unlisted(filename)
+            logger.info(f"Feature store {actions[filename]} {filename}: {rows} rows in {time.perf_counter() - start:.2f}s")
+        return actions
+
+    def load_source_parts(self, filename, mmap=True):
+        """Return the cached columns of one source file as a list of parts, oldest first, without copying"""
+        if filename not in self.manifest['sources']:
+            raise FileNotFoundError(f"{filename} is not in the feature store, run refresh() first")
+        return [self._load_part(filename, part, mmap) for part in self.manifest['sources'][filename]['parts']]
+
+    def _load_part(self, filename, part, mmap):
+        part_dir = os.path.join(self._source_dir(filename), part)
+        return {
+            os.path.splitext(name)[0]: np.load(os.path.join(part_dir, name), mmap_mode='r' if mmap else None)
+            for name in os.listdir(part_dir) if name.endswith('.npy')
+        }
+
+    def load_source_columns(self, filename, mmap=True, parts=None):
+        """Return the cached columns of one source file.
+
+        A single part is returned as memory maps; several parts are concatenated,
+        which reads them into memory. Use load_source_parts to avoid the copy.
+        """
+        if parts is None:
+            loaded = self.load_source_parts(filename, mmap)
+        else:
+            loaded = [self._load_part(filename, part, mmap) for part in parts]
+        if len(loaded) == 1:
+            return loaded[0]
+        return {name: np.concatenate([part[name] for part in loaded]) for name in loaded[0]}
+
+    def source_rows(self):
+        """Number of cached rows per source file"""
+        return {filename: entry['rows'] for filename, entry in self.manifest['sources'].items()}
+
+    def load_columns(self, mmap=True):
+        """Return the cached columns of all sources, stacked in source order.
+
+        With more than one source or part the stacking copies every column into
+        memory; only a single-part, single-source store stays memory mapped.
+        """
+        parts = [part for filename, _, _ in self.sources for part in self.load_source_parts(filename, mmap)]
+        if len(parts) == 1:
+            return parts[0]
+        return {name: np.concatenate([part[name] for part in parts]) for name in parts[0]}
+
+    def load_training_data(self):
+        """(X, y) as returned by load_and_preprocess_data, read from the cache"""
+        return to_training_frame(self.load_columns())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build or refresh the columnar feature cache of the sales CSVs')
+    parser.add_argument('--data-dir', default=DEFAULT_DATA_DIR)
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR)
+    parser.add_argument('--chunksize', type=int, default=DEFAULT_CHUNKSIZE)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    start = time.perf_counter()
+    store = FeatureStore(args.cache_dir, args.data_dir)
+    actions = store.refresh(args.chunksize)
+    rss = peak_rss_mb()
+    rss = f"{rss:.1f} MB" if rss is not None else 'n/a'
+    logger.info(f"Feature store refreshed in {time.perf_counter() - start:.2f}s: {actions}, peak RSS {rss}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+import numpy as np
+
+# Drug types served by the API, in the order the combined model predicts them
+DRUG_TYPES = [
+    { 'code': 'M01AB', 'name': 'Anti-inflammatory and antirheumatic products (Acetic acid derivatives)' },
+    { 'code': 'M01AE', 'name': 'Anti-inflammatory and antirheumatic products (Propionic acid derivatives)' },
+    { 'code': 'N02BA', 'name': 'Other analgesics and antipyretics (Salicylic acid derivatives)' },
+    { 'code': 'N02BE/B', 'name': 'Other analgesics and antipyretics (Pyrazolones and Anilides)' },
+    { 'code': 'N05B', 'name': 'Psycholeptics drugs (Anxiolytic)' },
+    { 'code': 'N05C', 'name': 'Psycholeptics drugs (Hypnotics and sedatives)' },
+    { 'code': 'R03', 'name': 'Drugs for obstructive airway diseases' },
+    { 'code': 'R06', 'name': 'Antihistamines for systemic use' }
+]
+
+# Drug type codes as the API accepts them ('N02BE/B' without the slash)
+DRUG_TYPE_CODES = [drug['code'].replace('/', '') for drug in DRUG_TYPES]
+
+# Columns of the feature rows sent to the model, in order
+FEATURE_COLUMNS = ['Year', 'Month', 'Hour', 'quarter', 'day_of_year', 'is_weekend', 'prediction_days']
+
+
+def build_input_features(current_date, days):
+    """Build the model input features for one forecast date"""
+    return {
+        'Year': float(current_date.year),
+        'Month': float(current_date.month),
+        'Hour': 12.0,  # Default to noon
+        'quarter': float((current_date.month - 1) // 3 + 1),
+        'day_of_year': float(current_date.timetuple().tm_yday),
+        'is_weekend': float(current_date.weekday() >= 5),  # 5 and 6 are Saturday and Sunday
+        'prediction_days': float(days)  # Add prediction period as a feature
+    }
+
+
+def build_feature_frame(dates, days):
+    """Vectorized build_input_features for many dates.
+
+    `dates` is anything accepted by pd.DatetimeIndex and `days` is a scalar or an
+    array with one prediction period per date.
+    """
+    # pandas is only needed for vectorized calendar arithmetic, keep it off the import path
+    import pandas as pd
+
+    dates = pd.DatetimeIndex(dates)
+    days = np.broadcast_to(np.asarray(days, dtype=np.float64), (len(dates),))
+    return pd.DataFrame({
+        'Year': dates.year.astype(np.float64),
+        'Month': dates.month.astype(np.float64),
+        'Hour': np.full(len(dates), 12.0),
+        'quarter': dates.quarter.astype(np.float64),
+        'day_of_year': dates.dayofyear.astype(np.float64),
+        'is_weekend': (dates.dayofweek >= 5).astype(np.float64),
+        'prediction_days': days
+    }, columns=FEATURE_COLUMNS)
+
+
+def build_series_features(start_date, days):
+    """FEATURE_COLUMNS matrix of `days` consecutive dates from start_date, each with prediction_days=days.
+
+    These are the rows POST /predict/forecast/series and the stock-out simulation
+    predict, so both see the same model outputs for the same window.
+    """
+    dates = np.datetime64(start_date, 'D') + np.arange(days)
+    return build_feature_frame(dates, days)[FEATURE_COLUMNS].to_numpy(dtype=np.float64)
+
+
+def predict_feature_matrix(model, X):
+    """Run a fitted pipeline or a compiled artifact on a FEATURE_COLUMNS matrix"""
+    names = getattr(model, 'feature_names', None)
+    if names is not None:
+        # Compiled artifact: a plain matrix of the columns it was trained on
+        return model.predict(X[:, [FEATURE_COLUMNS.index(name) for name in names]])
+    import pandas as pd
+    return model.predict(pd.DataFrame(X, columns=FEATURE_COLUMNS))
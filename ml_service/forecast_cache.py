@@ -0,0 +1,83 @@
+import time
+import threading
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class ForecastCache:
+    """Bounded LRU/TTL cache of raw model output vectors.
+
+    A cache belongs to one loaded model: entries are keyed on the engineered
+    feature tuple together with that model's identity. A changed model file is
+    not watched here, because the loaded model would keep producing the old
+    outputs under the new identity; the model swapper loads the new version
+    with a fresh cache instead.
+    """
+
+    def __init__(self, identity, maxsize=4096, ttl=3600.0):
+        self.identity = identity
+        self.maxsize = int(maxsize)
+        self.ttl = float(ttl)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self):
+        return self.maxsize > 0
+
+    def make_key(self, features):
+        return (self.identity, tuple(features))
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < now:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, vector):
+        if not self.enabled:
+            return
+        # Callers share cached vectors, so make sure nobody can modify them
+        vector = vector.copy()
+        vector.setflags(write=False)
+        with self._lock:
+            # Drop results computed by another model
+            if key[0] != self.identity:
+                return
+            self._entries[key] = (time.monotonic() + self.ttl, vector)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'enabled': self.enabled,
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions
+            }
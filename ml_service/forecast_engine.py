@@ -0,0 +1,447 @@
+"""Bulk forecasts for every store, SKU and horizon of a catalog.
+
+The catalog is a CSV with one row per stocked SKU:
+
+    store_id,sku,drug_type,stock_level
+    S0001,PARA-500,N02BE/B,120
+    S0001,IBU-400,M01AE,80
+
+Every catalog row is forecast for every horizon the same way POST
+/predict/forecast answers a single request, so the output rows carry the same
+prediction, predicted_quantity and average_daily fields.
+
+The model only sees calendar features and the horizon, so it is evaluated once
+for the start date and each horizon's end date (and the start date once per
+horizon when prediction_days is one of the model's features). The catalog arrays and those predictions are
+placed in shared memory and the store x SKU x horizon grid is expanded and
+written in shards by a process pool, one part file per shard. A run is written
+to a hidden directory and renamed once complete, with a manifest.json listing
+its parts and throughput:
+
+    python forecast_engine.py run --catalog catalog.csv --horizons 7,14,30,60,90
+    python forecast_engine.py run --synthetic 500x2000 --format parquet
+    python forecast_engine.py schedule --catalog catalog.csv --at 02:00
+"""
+import os
+import json
+import time
+import shutil
+import logging
+import argparse
+from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from features import DRUG_TYPE_CODES, FEATURE_COLUMNS, build_feature_frame, predict_feature_matrix
+from precompute import parse_horizons
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_OUTPUT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'forecasts')
+DEFAULT_SHARD_SIZE = 20000
+
+OUTPUT_FORMATS = ('ndjson', 'parquet')
+
+
+class Catalog:
+    """Store and SKU labels with per-row drug type indices and stock levels"""
+
+    def __init__(self, stores, skus, store_codes, sku_codes, drug_indices, stock_levels):
+        self.stores = list(stores)
+        self.skus = list(skus)
+        self.store_codes = np.ascontiguousarray(store_codes, dtype=np.int32)
+        self.sku_codes = np.ascontiguousarray(sku_codes, dtype=np.int32)
+        self.drug_indices = np.ascontiguousarray(drug_indices, dtype=np.int8)
+        self.stock_levels = np.ascontiguousarray(stock_levels, dtype=np.float64)
+
+    def __len__(self):
+        return len(self.stock_levels)
+
+    @classmethod
+    def from_csv(cls, path):
+        import pandas as pd
+
+        frame = pd.read_csv(path, dtype={'store_id': str, 'sku': str, 'drug_type': str})
+        missing = {'store_id', 'sku', 'drug_type', 'stock_level'} - set(frame.columns)
+        if missing:
+            raise ValueError(f"Catalog {path} is missing columns: {sorted(missing)}")
+
+        # Blank cells would become category -1 (another store's label) or NaN quantities
+        stock_levels = pd.to_numeric(frame['stock_level'], errors='coerce')
+        invalid = frame[['store_id', 'sku', 'drug_type']].isna().any(axis=1) | stock_levels.isna() | (stock_levels < 0)
+        if invalid.any():
+            # Line numbers in the CSV, counting the header as line 1
+            lines = (np.flatnonzero(invalid.to_numpy()) + 2).tolist()
+            shown = ', '.join(map(str, lines[:10])) + (f' and {len(lines) - 10} more' if len(lines) > 10 else '')
+            raise ValueError(f"Catalog {path} has rows with a blank store_id, sku or drug_type "
+                             f"or a blank or negative stock_level on lines {shown}")
+
+        # Accept the same drug type spellings as the API, e.g. N02BE/B
+        codes = frame['drug_type'].str.upper().str.replace('/', '', regex=False)
+        unknown = sorted(set(codes) - set(DRUG_TYPE_CODES))
+        if unknown:
+            raise ValueError(f"Catalog {path} has unknown drug types: {unknown}")
+
+        stores = pd.Categorical(frame['store_id'])
+        skus = pd.Categorical(frame['sku'])
+        if (stores.codes < 0).any() or (skus.codes < 0).any():
+            raise ValueError(f"Catalog {path} has rows without a store or SKU code")
+        return cls(
+            stores.categories, skus.categories, stores.codes, skus.codes,
+            pd.Categorical(codes, categories=DRUG_TYPE_CODES).codes,
+            stock_levels.to_numpy(dtype=np.float64)
+        )
+
+    @classmethod
+    def synthetic(cls, n_stores, n_skus, seed=0):
+        """Every store stocking the same n_skus SKUs, for throughput testing"""
+        rng = np.random.default_rng(seed)
+        sku_drugs = np.arange(n_skus) % len(DRUG_TYPE_CODES)
+        return cls(
+            [f'S{i:05d}' for i in range(n_stores)],
+            [f'{DRUG_TYPE_CODES[d]}-{j:05d}' for j, d in enumerate(sku_drugs)],
+            np.repeat(np.arange(n_stores), n_skus),
+            np.tile(np.arange(n_skus), n_stores),
+            np.tile(sku_drugs, n_stores),
+            rng.integers(10, 500, size=n_stores * n_skus).astype(np.float64)
+        )
+
+
+def load_model(model_path=None):
+    """Load the served registry version (or model_path), preferring its compiled artifact"""
+    from compiled_model import load_artifact
+    from model_registry import ModelRegistry
+
+    if model_path is None:
+        resolved = ModelRegistry().resolve()
+        model_path, version = resolved.model_path, resolved.version
+    else:
+        version = os.path.basename(model_path)
+    compiled = load_artifact(model_path)
+    if compiled is not None:
+        return compiled, version
+    import joblib
+    return joblib.load(model_path), version
+
+
+def predict_dates(model, dates, days):
+    """Model outputs for each date, shape (len(dates), n_drug_types); days is a scalar or one per date"""
+    X = build_feature_frame(dates, days)[FEATURE_COLUMNS].to_numpy(dtype=np.float64)
+    return predict_feature_matrix(model, X)
+
+
+def predict_horizons(model, start_date, horizons):
+    """Model outputs at the start date and at each horizon's end date, shape (2, len(horizons), n_drug_types).
+
+    Both dates of a horizon are predicted with prediction_days set to it, as
+    POST /predict/forecast does. Like ForecastTable.build, a model that was not
+    trained on prediction_days is evaluated once per date instead.
+    """
+    horizons = np.asarray(horizons)
+    end_dates = [start_date + timedelta(days=int(h)) for h in horizons]
+    # Compiled artifacts list their columns as feature_names, fitted pipelines as feature_names_in_
+    names = getattr(model, 'feature_names', None)
+    used_features = set(getattr(model, 'feature_names_in_', []) if names is None else names)
+    if used_features and 'prediction_days' not in used_features:
+        outputs = predict_dates(model, [start_date] + end_dates, horizons[0])
+        return np.stack([np.broadcast_to(outputs[0], outputs[1:].shape), outputs[1:]])
+    outputs = predict_dates(model, [start_date] * len(horizons) + end_dates, np.tile(horizons, 2))
+    return outputs.reshape(2, len(horizons), -1)
+
+
+class SharedArrays:
+    """Named numpy arrays in one shared memory block, attachable from other processes"""
+
+    def __init__(self, arrays):
+        self.layout = []
+        offset = 0
+        for name, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            self.layout.append((name, array.dtype.str, array.shape, offset))
+            offset += -(-array.nbytes // 64) * 64
+        self.shm = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+        for (name, _, _, _), array in zip(self.layout, arrays.values()):
+            self.view(name)[...] = array
+
+    @property
+    def spec(self):
+        return self.shm.name, self.layout
+
+    def view(self, name):
+        return _view(self.shm, self.layout, name)
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+
+def _view(shm, layout, name):
+    for array_name, dtype, shape, offset in layout:
+        if array_name == name:
+            return np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf, offset=offset)
+    raise KeyError(name)
+
+
+# Per-worker state set by _init_worker, so tasks only carry a row range
+_worker = {}
+
+
+def _init_worker(spec, stores, skus, horizons, start_date, output_dir, output_format):
+    name, layout = spec
+    shm = shared_memory.SharedMemory(name=name)
+    _worker.update(
+        shm=shm,
+        arrays={array_name: _view(shm, layout, array_name) for array_name, _, _, _ in layout},
+        stores=stores, skus=skus, horizons=horizons, start_date=start_date,
+        output_dir=output_dir, output_format=output_format
+    )
+
+
+def forecast_shard(arrays, lo, hi, horizons):
+    """Expand catalog rows lo:hi over all horizons, rows ordered by catalog row then horizon.
+
+    Matches format_forecast in app.py: the prediction is the mean of the start
+    and end date outputs and predicted_quantity truncates prediction * stock.
+    """
+    predictions = arrays['predictions']
+    drug_indices = arrays['drug_indices'][lo:hi].astype(np.intp)
+    stock_levels = arrays['stock_levels'][lo:hi]
+    horizons = np.asarray(horizons)
+
+    start_pred = predictions[0][:, drug_indices].T
+    end_pred = predictions[1][:, drug_indices].T
+    prediction = (start_pred + end_pred) / 2
+    quantity = np.trunc(prediction * stock_levels[:, np.newaxis]).astype(np.int64)
+    return prediction.ravel(), quantity.ravel(), (quantity / horizons).ravel()
+
+
+def write_shard(shard, lo, hi, arrays, stores, skus, horizons, start_date, output_dir, output_format):
+    """Forecast one shard and write it as a part file; returns the part's manifest entry"""
+    start = time.perf_counter()
+    prediction, quantity, average_daily = forecast_shard(arrays, lo, hi, horizons)
+    n_horizons = len(horizons)
+    store_codes = np.repeat(arrays['store_codes'][lo:hi], n_horizons)
+    sku_codes = np.repeat(arrays['sku_codes'][lo:hi], n_horizons)
+    drug_indices = np.repeat(arrays['drug_indices'][lo:hi], n_horizons)
+    horizon_column = np.tile(horizons, hi - lo)
+    end_dates = [(start_date + timedelta(days=h)).strftime('%Y-%m-%d') for h in horizons]
+    end_date_column = np.tile(np.arange(n_horizons), hi - lo)
+    date = start_date.strftime('%Y-%m-%d')
+
+    path = os.path.join(output_dir, f'part-{shard:05d}.{output_format}')
+    if output_format == 'ndjson':
+        # Everything but the numbers is encoded once per distinct value
+        store_json = {code: json.dumps(stores[code]) for code in np.unique(store_codes).tolist()}
+        sku_json = {code: json.dumps(skus[code]) for code in np.unique(sku_codes).tolist()}
+        suffixes = [f'"date":"{date}","end_date":"{end_date}","days":{h}' for end_date, h in zip(end_dates, horizons)]
+        with open(path, 'w') as f:
+            f.writelines(
+                f'{{"store_id":{store_json[store]},"sku":{sku_json[sku]},"drug_type":"{DRUG_TYPE_CODES[drug]}",'
+                f'{suffixes[e]},"prediction":{p!r},"predicted_quantity":{q},"average_daily":{a!r}}}\n'
+                for store, sku, drug, e, p, q, a in zip(
+                    store_codes.tolist(), sku_codes.tolist(), drug_indices.tolist(), end_date_column.tolist(),
+                    prediction.tolist(), quantity.tolist(), average_daily.tolist())
+            )
+    else:
+        import pandas as pd
+
+        pd.DataFrame({
+            'store_id': pd.Categorical.from_codes(store_codes, categories=stores),
+            'sku': pd.Categorical.from_codes(sku_codes, categories=skus),
+            'drug_type': pd.Categorical.from_codes(drug_indices, categories=DRUG_TYPE_CODES),
+            'date': date,
+            'end_date': pd.Categorical.from_codes(end_date_column, categories=end_dates),
+            'days': horizon_column.astype(np.int32),
+            'prediction': prediction,
+            'predicted_quantity': quantity,
+            'average_daily': average_daily
+        }).to_parquet(path, index=False)
+
+    return {
+        'path': os.path.basename(path),
+        'rows': len(prediction),
+        'seconds': time.perf_counter() - start,
+        'pid': os.getpid()
+    }
+
+
+def _write_shard_task(shard, lo, hi):
+    w = _worker
+    return write_shard(shard, lo, hi, w['arrays'], w['stores'], w['skus'], w['horizons'],
+                       w['start_date'], w['output_dir'], w['output_format'])
+
+
+def check_output_format(output_format):
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format {output_format}, use one of {OUTPUT_FORMATS}")
+    if output_format == 'parquet':
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise ImportError("Parquet output needs pyarrow (pip install pyarrow), or use --format ndjson")
+
+
+def run_forecast(catalog, start_date, horizons, output_dir=DEFAULT_OUTPUT_DIR, output_format='ndjson',
+                 model_path=None, n_workers=None, shard_size=DEFAULT_SHARD_SIZE):
+    """Forecast the whole catalog into output_dir/<run id>/ and return the run manifest"""
+    check_output_format(output_format)
+    horizons = sorted(set(horizons))
+    timings = {}
+
+    stage_start = time.perf_counter()
+    model, version = load_model(model_path)
+    timings['load_model'] = time.perf_counter() - stage_start
+
+    # One model evaluation covers the start date and every horizon's end date
+    stage_start = time.perf_counter()
+    predictions = np.ascontiguousarray(predict_horizons(model, start_date, horizons), dtype=np.float64)
+    timings['predict'] = time.perf_counter() - stage_start
+
+    run_id = f"{start_date:%Y-%m-%d}-{datetime.now():%Y%m%dT%H%M%S%f}"
+    run_dir = os.path.join(output_dir, run_id)
+    tmp_dir = os.path.join(output_dir, f'.{run_id}.tmp')
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    shards = [(i, lo, min(lo + shard_size, len(catalog))) for i, lo in enumerate(range(0, len(catalog), shard_size))]
+    n_workers = max(1, min(n_workers or os.cpu_count() or 1, len(shards)))
+
+    stage_start = time.perf_counter()
+    shared = SharedArrays({
+        'predictions': predictions,
+        'store_codes': catalog.store_codes,
+        'sku_codes': catalog.sku_codes,
+        'drug_indices': catalog.drug_indices,
+        'stock_levels': catalog.stock_levels
+    })
+    try:
+        init_args = (shared.spec, catalog.stores, catalog.skus, horizons, start_date, tmp_dir, output_format)
+        if n_workers == 1:
+            _init_worker(*init_args)
+            try:
+                parts = [_write_shard_task(*shard) for shard in shards]
+            finally:
+                _worker.pop('arrays', None)
+                _worker.pop('shm').close()
+        else:
+            with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker, initargs=init_args) as executor:
+                parts = list(executor.map(_write_shard_task, *zip(*shards)))
+    except Exception:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    finally:
+        shared.close()
+    timings['write'] = time.perf_counter() - stage_start
+
+    rows = sum(part['rows'] for part in parts)
+    total = sum(timings.values())
+    manifest = {
+        'run_id': run_id,
+        'date': start_date.strftime('%Y-%m-%d'),
+        'horizons': horizons,
+        'model_version': version,
+        'format': output_format,
+        'stores': len(catalog.stores),
+        'skus': len(catalog.skus),
+        'catalog_rows': len(catalog),
+        'rows': rows,
+        'parts': parts,
+        'throughput': {
+            'workers': n_workers,
+            'shards': len(shards),
+            'seconds': total,
+            'rows_per_second': rows / total if total > 0 else None,
+            'stage_seconds': timings,
+            'bytes': sum(os.path.getsize(os.path.join(tmp_dir, part['path'])) for part in parts)
+        },
+        'created_at': datetime.now().isoformat(timespec='seconds')
+    }
+    with open(os.path.join(tmp_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    # Readers only ever see complete runs
+    os.rename(tmp_dir, run_dir)
+    return manifest
+
+
+def log_throughput(manifest):
+    throughput = manifest['throughput']
+    stages = ', '.join(f"{name} {seconds:.2f}s" for name, seconds in throughput['stage_seconds'].items())
+    logger.info(f"Run {manifest['run_id']}: {manifest['rows']} forecasts for {manifest['stores']} stores x "
+                f"{manifest['skus']} SKUs x {len(manifest['horizons'])} horizons in {throughput['seconds']:.2f}s "
+                f"({throughput['rows_per_second']:,.0f} rows/s, {throughput['workers']} workers, "
+                f"{throughput['shards']} shards, {throughput['bytes'] / 1e6:.1f} MB)")
+    logger.info(f"Stage timings: {stages}")
+
+
+def next_run_time(now, at=None, interval_minutes=None):
+    """Next scheduled time: daily at HH:MM, or every interval_minutes from now"""
+    if interval_minutes:
+        return now + timedelta(minutes=interval_minutes)
+    hour, minute = (int(part) for part in at.split(':'))
+    scheduled = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    return scheduled if scheduled > now else scheduled + timedelta(days=1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Forecast every store, SKU and horizon of a catalog')
+    commands = parser.add_subparsers(dest='command', required=True)
+    run = commands.add_parser('run', help='Run one forecast now')
+    schedule = commands.add_parser('schedule', help='Run forecasts daily or at a fixed interval')
+    for command in (run, schedule):
+        catalog = command.add_mutually_exclusive_group(required=True)
+        catalog.add_argument('--catalog', help='CSV with store_id, sku, drug_type and stock_level columns')
+        catalog.add_argument('--synthetic', help="Generated catalog of STORESxSKUS, e.g. '500x2000'")
+        command.add_argument('--horizons', default='7,14,30,60,90', help="Forecast periods, e.g. '7,30,90' or '1-90'")
+        command.add_argument('--output-dir', default=DEFAULT_OUTPUT_DIR)
+        command.add_argument('--format', choices=OUTPUT_FORMATS, default='ndjson')
+        command.add_argument('--model', help='Pickled model to use instead of the served registry version')
+        command.add_argument('--workers', type=int, default=int(os.getenv('FORECAST_WORKERS', os.cpu_count() or 1)))
+        command.add_argument('--shard-size', type=int, default=DEFAULT_SHARD_SIZE, help='Catalog rows per part file')
+    run.add_argument('--date', default=datetime.now().strftime('%Y-%m-%d'), help='Forecast start date (YYYY-MM-DD)')
+    when = schedule.add_mutually_exclusive_group(required=True)
+    when.add_argument('--at', help='Daily run time, HH:MM')
+    when.add_argument('--interval-minutes', type=float)
+    schedule.add_argument('--max-runs', type=int, help='Stop after this many runs')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    def load_catalog():
+        if args.synthetic:
+            n_stores, n_skus = (int(part) for part in args.synthetic.lower().split('x'))
+            return Catalog.synthetic(n_stores, n_skus)
+        return Catalog.from_csv(args.catalog)
+
+    def forecast(start_date):
+        manifest = run_forecast(load_catalog(), start_date, parse_horizons(args.horizons), args.output_dir,
+                                args.format, args.model, args.workers, args.shard_size)
+        log_throughput(manifest)
+        return manifest
+
+    try:
+        if args.command == 'run':
+            forecast(datetime.strptime(args.date, '%Y-%m-%d'))
+            return
+
+        check_output_format(args.format)
+        runs = 0
+        while args.max_runs is None or runs < args.max_runs:
+            scheduled = next_run_time(datetime.now(), args.at, args.interval_minutes)
+            logger.info(f"Next forecast run at {scheduled:%Y-%m-%d %H:%M:%S}")
+            time.sleep(max(0.0, (scheduled - datetime.now()).total_seconds()))
+            # The catalog is re-read on every run so updates are picked up
+            try:
+                forecast(datetime.now().replace(hour=0, minute=0, second=0, microsecond=0))
+            except Exception as e:
+                logger.error(f"Scheduled forecast run failed: {str(e)}", exc_info=True)
+            runs += 1
+
+    except Exception as e:
+        logger.error(f"Error in forecast engine: {str(e)}", exc_info=True)
+        raise
+
+
+if __name__ == '__main__':
+    main()
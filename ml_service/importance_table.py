@@ -0,0 +1,44 @@
+import hashlib
+
+import numpy as np
+
+
+class ImportanceTable:
+    """Feature importances of every drug type's estimator, sorted once at model load.
+
+    `order` ranks all (drug, feature) pairs by importance and `drug_order[d]`
+    ranks the features of drug d, so any top-k query is a slice.
+    """
+
+    def __init__(self, feature_names, importances, drug_codes):
+        self.feature_names = np.asarray(feature_names, dtype=str)
+        self.importances = np.ascontiguousarray(importances, dtype=np.float64)
+        self.drug_codes = list(drug_codes)
+        n_drugs, n_features = self.importances.shape
+
+        # Stable descending sort keeps the estimator order for ties, like list.sort(reverse=True)
+        flat = self.importances.ravel()
+        self.order = np.argsort(-flat, kind='stable')
+        self.drug_order = np.argsort(-self.importances, axis=1, kind='stable')
+        self.labels = np.array([f"{feature} ({drug})" for drug in self.drug_codes for feature in self.feature_names])
+
+        digest = hashlib.sha256(self.importances.tobytes())
+        digest.update('\0'.join(self.labels).encode())
+        self.etag = digest.hexdigest()[:32]
+
+    @property
+    def size(self):
+        return len(self.labels)
+
+    def top(self, k):
+        """The k most important (drug, feature) pairs across all drug types"""
+        flat = self.importances.ravel()
+        return [{'name': self.labels[i], 'importance': float(flat[i])} for i in self.order[:k]]
+
+    def top_for_drug(self, drug_index, k):
+        """The k most important features of one drug type's estimator"""
+        row = self.importances[drug_index]
+        return [
+            {'name': f"{self.feature_names[j]} ({self.drug_codes[drug_index]})", 'importance': float(row[j])}
+            for j in self.drug_order[drug_index, :k]
+        ]
@@ -0,0 +1,162 @@
+import os
+import sys
+import time
+import logging
+import argparse
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+DRUG_TYPES = ['M01AB', 'M01AE', 'N02BA', 'N02BE', 'N05B', 'N05C', 'R03', 'R06']
+
+# Raw calendar columns present in the hourly and daily files only
+CALENDAR_COLUMNS = ['Year', 'Month', 'Hour']
+
+# Model features, in training order
+FEATURE_COLUMNS = ['Year', 'Month', 'Hour', 'quarter', 'day_of_year', 'is_weekend']
+
+# (file, time_period, datum format), in the order load_and_preprocess_data stacks them
+SALES_SOURCES = [
+    ('saleshourly.csv', 'hourly', '%m/%d/%Y %H:%M'),
+    ('salesdaily.csv', 'daily', '%m/%d/%Y'),
+    ('salesweekly.csv', 'weekly', '%m/%d/%Y'),
+    ('salesmonthly.csv', 'monthly', '%Y-%m-%d'),
+]
+
+CSV_DTYPES = {
+    'datum': str,
+    **{drug: np.float32 for drug in DRUG_TYPES},
+    # float32 so empty calendar cells parse as NaN and get mean-filled, like the eager loader
+    **{column: np.float32 for column in CALENDAR_COLUMNS},
+}
+
+DEFAULT_CHUNKSIZE = 100000
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB, or None when unavailable"""
+    try:
+        import resource
+    except ImportError:
+        try:
+            import psutil
+        except ImportError:
+            return None
+        info = psutil.Process().memory_info()
+        return getattr(info, 'peak_wset', info.rss) / (1024 * 1024)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def derive_features(chunk, date_format):
+    """Turn one raw CSV chunk into compact feature and target columns"""
+    datum = pd.to_datetime(chunk['datum'], format=date_format)
+    n_rows = len(chunk)
+
+    columns = {}
+    for column in CALENDAR_COLUMNS:
+        # Weekly and monthly files have no calendar columns; filled with the mean later
+        if column in chunk.columns:
+            columns[column] = chunk[column].to_numpy(dtype=np.float32)
+        else:
+            columns[column] = np.full(n_rows, np.nan, dtype=np.float32)
+    columns['quarter'] = datum.dt.quarter.to_numpy(dtype=np.int8)
+    columns['day_of_year'] = datum.dt.dayofyear.to_numpy(dtype=np.int16)
+    columns['is_weekend'] = (datum.dt.dayofweek >= 5).to_numpy(dtype=np.bool_)
+    # Same bins as pd.cut(month, [0, 3, 6, 9, 12]): 0=Winter, 1=Spring, 2=Summer, 3=Fall
+    columns['season'] = ((datum.dt.month.to_numpy() - 1) // 3).astype(np.int8)
+    columns['datum'] = datum.to_numpy(dtype='datetime64[s]')
+    for drug in DRUG_TYPES:
+        columns[drug] = chunk[drug].to_numpy(dtype=np.float32)
+    return columns
+
+
+def iter_feature_chunks(path, date_format, chunksize=DEFAULT_CHUNKSIZE, skiprows=None):
+    """Yield compact feature columns for a sales CSV, `chunksize` rows at a time"""
+    reader = pd.read_csv(
+        path,
+        chunksize=chunksize,
+        dtype=CSV_DTYPES,
+        usecols=lambda column: column in CSV_DTYPES,
+        skiprows=skiprows
+    )
+    for chunk in reader:
+        yield derive_features(chunk, date_format)
+
+
+class IngestStats:
+    def __init__(self):
+        self.rows = 0
+        self.seconds = 0.0
+        self.peak_rss_mb = None
+
+    @property
+    def rows_per_second(self):
+        return self.rows / self.seconds if self.seconds else 0.0
+
+    def __str__(self):
+        rss = f"{self.peak_rss_mb:.1f} MB" if self.peak_rss_mb is not None else 'n/a'
+        return f"{self.rows} rows in {self.seconds:.2f}s ({self.rows_per_second:,.0f} rows/s), peak RSS {rss}"
+
+
+def load_sales_streaming(data_dir='.', chunksize=DEFAULT_CHUNKSIZE, sources=SALES_SOURCES):
+    """Stream all sales CSVs into compact column arrays.
+
+    Only one raw chunk is alive at a time; derived columns are kept as float32,
+    int16, int8 and bool until the caller asks for the training frame.
+    Returns (columns, time_period codes, IngestStats).
+    """
+    stats = IngestStats()
+    start = time.perf_counter()
+    parts = []
+    periods = []
+    for period_code, (filename, time_period, date_format) in enumerate(sources):
+        file_rows = 0
+        for columns in iter_feature_chunks(os.path.join(data_dir, filename), date_format, chunksize):
+            parts.append(columns)
+            n_rows = len(columns['datum'])
+            periods.append(np.full(n_rows, period_code, dtype=np.int8))
+            file_rows += n_rows
+        logger.info(f"Streamed {file_rows} {time_period} rows from {filename}")
+        stats.rows += file_rows
+
+    columns = {name: np.concatenate([part[name] for part in parts]) for name in parts[0]}
+    stats.seconds = time.perf_counter() - start
+    stats.peak_rss_mb = peak_rss_mb()
+    return columns, np.concatenate(periods), stats
+
+
+def to_training_frame(columns, fill_values=None):
+    """Build the (X, y) frames load_and_preprocess_data returns from compact columns.
+
+    Missing calendar values are filled with `fill_values` when given, otherwise
+    with the column means of these rows.
+    """
+    X = pd.DataFrame({name: columns[name].astype(np.float64) for name in FEATURE_COLUMNS})
+
+    # Handle missing values with the column mean, as the eager loader does
+    if fill_values is None:
+        fill_values = X[CALENDAR_COLUMNS].mean()
+    X[CALENDAR_COLUMNS] = X[CALENDAR_COLUMNS].fillna(fill_values)
+
+    y = pd.DataFrame({drug: columns[drug].astype(np.float64) for drug in DRUG_TYPES})
+    return X, y
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stream the sales CSVs and report ingestion throughput')
+    parser.add_argument('--data-dir', default=os.path.dirname(os.path.abspath(__file__)))
+    parser.add_argument('--chunksize', type=int, default=DEFAULT_CHUNKSIZE)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    columns, _, stats = load_sales_streaming(args.data_dir, args.chunksize)
+    compact_mb = sum(array.nbytes for array in columns.values()) / (1024 * 1024)
+    logger.info(f"Ingested {stats}; compact columns use {compact_mb:.1f} MB")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,7 @@
 import joblib
 import os
 import numpy as np
+from feature_store import FeatureStore
 
 def inspect_model():
     try:
@@ -28,6 +29,17 @@ def inspect_model():
         except Exception as e:
             print(f"Could not get feature names: {str(e)}")
         
+        # Test prediction on real rows from the feature store when it has been built
+        store = FeatureStore()
+        if store.manifest['sources']:
+            print("\nTesting prediction with cached training rows...")
+            X, y = store.load_training_data()
+            prediction = model.predict(X.head(5))
+            print("Prediction shape:", prediction.shape)
+            print("Prediction sample:", prediction)
+            print("Actual values:", y.head(5).to_numpy())
+            return
+        
         # Test prediction with dummy data
         print("\nTesting prediction with dummy data...")
         dummy_data = {
@@ -0,0 +1,139 @@
+import os
+import time
+import logging
+import threading
+from collections import deque
+from concurrent.futures import Future
+
+import numpy as np
+
+import telemetry
+
+logger = logging.getLogger(__name__)
+
+
+class MicroBatcher:
+    """Coalesces concurrent predict calls into one call on a stacked feature matrix.
+
+    Callers block in submit() while a dispatcher thread collects queued
+    matrices for up to `max_wait` seconds after the first one, or until
+    `max_rows` rows are queued, runs `predict` once and hands every caller its
+    slice of the result. The wait is adaptive: when `concurrency()` reports no
+    other request in flight than the ones already collected, the batch is
+    dispatched immediately, so a lone request pays no added latency.
+
+    The dispatcher thread is started on demand and exits after `idle_timeout`
+    seconds without work, so batchers survive fork and old model versions do
+    not keep threads alive. If the dispatcher fails outside predict, every
+    waiting caller gets the error and the next submit starts a new thread;
+    callers never wait longer than `result_timeout` seconds.
+    """
+
+    def __init__(self, predict, max_wait=0.002, max_rows=256, concurrency=None, idle_timeout=1.0,
+                 result_timeout=30.0):
+        self.predict = predict
+        self.max_wait = max_wait
+        self.max_rows = max_rows
+        self.concurrency = concurrency
+        self.idle_timeout = idle_timeout
+        self.result_timeout = result_timeout
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._thread_pid = None
+
+    def submit(self, X):
+        """Return predict(X), computed together with other concurrently submitted rows"""
+        future = Future()
+        with self._cond:
+            self._queue.append((X, future, time.perf_counter()))
+            if self._thread is None or self._thread_pid != os.getpid():
+                self._thread_pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name='ml-micro-batcher', daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        try:
+            return future.result(timeout=self.result_timeout)
+        except TimeoutError:
+            # A cancelled future is skipped when its batch is dispatched
+            future.cancel()
+            raise TimeoutError(f"Batched prediction did not complete within {self.result_timeout}s")
+
+    def _collect(self):
+        """Take the next batch off the queue, or return None when idle for too long"""
+        with self._cond:
+            if not self._queue:
+                self._cond.wait(self.idle_timeout)
+                if not self._queue:
+                    self._thread = None
+                    return None
+
+            batch = [self._queue.popleft()]
+            rows = len(batch[0][0])
+            deadline = batch[0][2] + self.max_wait
+            try:
+                while rows < self.max_rows:
+                    if self._queue:
+                        item = self._queue.popleft()
+                        batch.append(item)
+                        rows += len(item[0])
+                        continue
+                    # Only wait when other requests are in flight that may still submit rows
+                    if self.concurrency is not None and self.concurrency() <= len(batch):
+                        break
+                    remaining = deadline - time.perf_counter()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+            except Exception:
+                # Put the rows back so the caller can fail them along with the rest of the queue
+                self._queue.extendleft(reversed(batch))
+                raise
+            return batch
+
+    def _run(self):
+        batch = []
+        try:
+            while True:
+                batch = self._collect()
+                if batch is None:
+                    return
+                self._dispatch(batch)
+                batch = []
+        except Exception as e:
+            # Fail everything still waiting and let the next submit start a new dispatcher
+            logger.error(f"Micro-batcher dispatcher failed: {str(e)}", exc_info=True)
+            with self._cond:
+                pending = batch + list(self._queue)
+                self._queue.clear()
+                if self._thread is threading.current_thread():
+                    self._thread = None
+            for _, future, _ in pending:
+                if not future.done():
+                    future.set_exception(e)
+
+    def _dispatch(self, batch):
+        # Drop callers that timed out; the rest can no longer be cancelled
+        batch[:] = [item for item in batch if item[1].set_running_or_notify_cancel()]
+        if not batch:
+            return
+        try:
+            dispatched_at = time.perf_counter()
+            for _, _, submitted_at in batch:
+                telemetry.MICROBATCH_QUEUE_SECONDS.observe(dispatched_at - submitted_at)
+            matrices = [X for X, _, _ in batch]
+            telemetry.MICROBATCH_REQUESTS.observe(len(batch))
+            X = matrices[0] if len(matrices) == 1 else np.concatenate(matrices)
+            telemetry.MICROBATCH_ROWS.observe(len(X))
+            predictions = self.predict(X)
+        except Exception as e:
+            logger.error(f"Error in batched prediction: {str(e)}", exc_info=True)
+            for _, future, _ in batch:
+                future.set_exception(e)
+            return
+
+        # Scatter the stacked predictions back to the waiting callers
+        offset = 0
+        for X, future, _ in batch:
+            future.set_result(predictions[offset:offset + len(X)])
+            offset += len(X)
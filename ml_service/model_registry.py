@@ -0,0 +1,273 @@
+"""Versioned model registry with in-process hot swapping.
+
+Every published model gets an immutable directory under models/registry/:
+
+    models/registry/20261018T162958123456-c15ec39c/
+        model.pkl            the pickled pipeline
+        model/               its compiled, memory-mappable artifact
+        model.residuals.npz  its training residuals, when saved before publishing
+        version.json         sha256, source and creation time
+
+The served version is the pinned one if models/registry/pinned.json exists,
+otherwise the newest. Without any published version the service keeps serving
+models/best_model_combined.pkl.
+
+ModelSwapper holds the version a process serves. Its watcher thread loads and
+warms a newly resolved version off the request path and then replaces the
+reference in a single assignment; requests that already hold the old version
+finish on it.
+
+    python model_registry.py publish models/best_model_combined.pkl
+    python model_registry.py list
+    python model_registry.py pin 20261018T162958123456-c15ec39c
+    python model_registry.py rollback
+    python model_registry.py unpin
+"""
+import os
+import json
+import time
+import shutil
+import logging
+import argparse
+import threading
+from datetime import datetime
+
+from compiled_model import export_artifact, file_sha256
+from simulation import residuals_path, residuals_sha256
+
+logger = logging.getLogger(__name__)
+
+SERVICE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_REGISTRY_DIR = os.path.join(SERVICE_DIR, 'models', 'registry')
+LEGACY_MODEL_PATH = os.path.join(SERVICE_DIR, 'models', 'best_model_combined.pkl')
+
+MODEL_FILENAME = 'model.pkl'
+
+
+class ResolvedVersion:
+    """A version to serve: its name, pickle path and a key that changes with its content"""
+
+    def __init__(self, version, model_path, key):
+        self.version = version
+        self.model_path = model_path
+        self.key = key
+
+    @property
+    def directory(self):
+        return os.path.dirname(self.model_path)
+
+    def __repr__(self):
+        return f"ResolvedVersion({self.version!r})"
+
+
+class ModelRegistry:
+    def __init__(self, root=DEFAULT_REGISTRY_DIR, legacy_model_path=LEGACY_MODEL_PATH):
+        self.root = root
+        self.legacy_model_path = legacy_model_path
+        self.pin_path = os.path.join(root, 'pinned.json')
+
+    def versions(self):
+        """Published versions, oldest first; half-written directories start with a dot"""
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(
+            name for name in os.listdir(self.root)
+            if not name.startswith('.') and os.path.isfile(os.path.join(self.root, name, MODEL_FILENAME))
+        )
+
+    def model_path(self, version):
+        return os.path.join(self.root, version, MODEL_FILENAME)
+
+    def metadata(self, version):
+        with open(os.path.join(self.root, version, 'version.json')) as f:
+            return json.load(f)
+
+    def pinned(self):
+        if not os.path.exists(self.pin_path):
+            return None
+        with open(self.pin_path) as f:
+            return json.load(f).get('version')
+
+    def resolve(self):
+        """The version that should be served right now"""
+        versions = self.versions()
+        pinned = self.pinned()
+        if pinned is not None:
+            if pinned in versions:
+                return ResolvedVersion(pinned, self.model_path(pinned), pinned)
+            logger.warning(f"Pinned model version {pinned} does not exist, ignoring the pin")
+        if versions:
+            return ResolvedVersion(versions[-1], self.model_path(versions[-1]), versions[-1])
+
+        # No registry yet: serve the legacy pickle, reloading it whenever it is replaced
+        stat = os.stat(self.legacy_model_path)
+        return ResolvedVersion('legacy', self.legacy_model_path, f'legacy@{stat.st_mtime_ns}-{stat.st_size}')
+
+    def publish(self, model_path, pipeline=None, **metadata):
+        """Copy a pickled pipeline into a new version directory and export its artifact"""
+        sha256 = file_sha256(model_path)
+        version = f"{datetime.now().strftime('%Y%m%dT%H%M%S%f')}-{sha256[:8]}"
+        directory = os.path.join(self.root, version)
+        if os.path.exists(directory):
+            return version
+
+        # Build the version under a hidden name so watchers never see it half written
+        tmp_directory = os.path.join(self.root, f'.{version}.tmp')
+        shutil.rmtree(tmp_directory, ignore_errors=True)
+        os.makedirs(tmp_directory)
+        target = os.path.join(tmp_directory, MODEL_FILENAME)
+        shutil.copyfile(model_path, target)
+        # Residuals travel with the model they were fitted for; stale ones stay behind
+        residuals = residuals_path(model_path)
+        if os.path.exists(residuals):
+            if residuals_sha256(residuals) == sha256:
+                shutil.copyfile(residuals, residuals_path(target))
+            else:
+                logger.warning(f"Not publishing {residuals}: it was fitted for another model")
+        if pipeline is None:
+            import joblib
+            pipeline = joblib.load(target)
+        # The artifact's source sha256 is of the copied bytes, so it stays valid after the rename
+        export_artifact(pipeline, target)
+        with open(os.path.join(tmp_directory, 'version.json'), 'w') as f:
+            json.dump({
+                'version': version,
+                'sha256': sha256,
+                'source': os.path.abspath(model_path),
+                'created_at': datetime.now().isoformat(timespec='seconds'),
+                **metadata
+            }, f, indent=2)
+        os.rename(tmp_directory, directory)
+        logger.info(f"Published model version {version}")
+        return version
+
+    def pin(self, version):
+        if version not in self.versions():
+            raise ValueError(f"Unknown model version: {version}")
+        tmp_path = self.pin_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': version, 'pinned_at': datetime.now().isoformat(timespec='seconds')}, f)
+        os.replace(tmp_path, self.pin_path)
+        logger.info(f"Pinned model version {version}")
+
+    def unpin(self):
+        if os.path.exists(self.pin_path):
+            os.remove(self.pin_path)
+            logger.info("Removed the model version pin")
+
+    def rollback(self):
+        """Pin the version published before the one currently resolved"""
+        versions = self.versions()
+        current = self.resolve().version
+        if current not in versions or versions.index(current) == 0:
+            raise ValueError(f"No version to roll back to from {current}")
+        previous = versions[versions.index(current) - 1]
+        self.pin(previous)
+        return previous
+
+    def prune(self, keep):
+        """Delete all but the newest `keep` versions, never the pinned one"""
+        pinned = self.pinned()
+        removed = [v for v in self.versions()[:-keep] if v != pinned] if keep > 0 else []
+        for version in removed:
+            shutil.rmtree(os.path.join(self.root, version))
+        return removed
+
+
+class ModelSwapper:
+    """Holds the model version this process serves and swaps in new ones.
+
+    `load_version(resolved)` must return a fully loaded and warmed object; it
+    is called from the watcher thread, so requests never wait on it.
+    """
+
+    def __init__(self, registry, load_version, interval=5.0):
+        self.registry = registry
+        self.load_version = load_version
+        self.interval = interval
+        self._current = None
+        self._lock = threading.Lock()
+        self._watcher_pid = None
+
+    def current(self):
+        served = self._current
+        if served is None:
+            with self._lock:
+                if self._current is None:
+                    self._current = self.load_version(self.registry.resolve())
+                served = self._current
+        return served
+
+    def refresh(self, force=False):
+        """Load the resolved version if it differs from the served one; returns True on a swap"""
+        with self._lock:
+            resolved = self.registry.resolve()
+            if not force and self._current is not None and self._current.key == resolved.key:
+                return False
+            previous = self._current
+            served = self.load_version(resolved)
+            # A single reference assignment: new requests see the new version, running ones keep theirs
+            self._current = served
+        logger.info(f"Serving model version {resolved.version}"
+                    + (f" (was {previous.version})" if previous is not None else ''))
+        return True
+
+    def ensure_watcher(self):
+        """Start the watcher thread once per process; call after fork, from the request path"""
+        if self.interval <= 0 or self._watcher_pid == os.getpid():
+            return
+        with self._lock:
+            if self._watcher_pid == os.getpid():
+                return
+            self._watcher_pid = os.getpid()
+        threading.Thread(target=self._watch, name='ml-model-watcher', daemon=True).start()
+
+    def _watch(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.error(f"Error loading new model version, keeping the current one: {str(e)}", exc_info=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Manage published model versions')
+    parser.add_argument('--root', default=DEFAULT_REGISTRY_DIR)
+    commands = parser.add_subparsers(dest='command', required=True)
+    publish = commands.add_parser('publish', help='Publish a pickled pipeline as a new version')
+    publish.add_argument('model', nargs='?', default=LEGACY_MODEL_PATH)
+    commands.add_parser('list', help='List versions and show which one is served')
+    pin = commands.add_parser('pin', help='Serve a specific version until unpinned')
+    pin.add_argument('version')
+    commands.add_parser('unpin', help='Serve the newest version again')
+    commands.add_parser('rollback', help='Pin the version before the served one')
+    prune = commands.add_parser('prune', help='Delete old versions')
+    prune.add_argument('--keep', type=int, default=5)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    registry = ModelRegistry(args.root)
+    if args.command == 'publish':
+        print(registry.publish(args.model))
+    elif args.command == 'list':
+        served = registry.resolve().version
+        pinned = registry.pinned()
+        for version in registry.versions():
+            marks = [mark for mark, on in (('served', version == served), ('pinned', version == pinned)) if on]
+            print(f"{version}  {', '.join(marks)}")
+        if served == 'legacy':
+            print(f"No published versions, serving {registry.legacy_model_path}")
+    elif args.command == 'pin':
+        registry.pin(args.version)
+    elif args.command == 'unpin':
+        registry.unpin()
+    elif args.command == 'rollback':
+        print(registry.rollback())
+    elif args.command == 'prune':
+        for version in registry.prune(args.keep):
+            print(f"Removed {version}")
+
+
+if __name__ == '__main__':
+    main()
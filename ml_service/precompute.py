@@ -0,0 +1,175 @@
+import os
+import json
+import time
+import argparse
+import logging
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from features import build_feature_frame
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MODEL_PATH = os.path.join(os.path.dirname(__file__), 'models', 'best_model_combined.pkl')
+DEFAULT_TABLE_PATH = os.path.join(os.path.dirname(__file__), 'models', 'forecast_table.npy')
+DEFAULT_HORIZONS = list(range(1, 91))
+
+
+def model_file_identity(model_path):
+    """Identity of a model file used to detect stale precomputed tables"""
+    stat = os.stat(model_path)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def parse_horizons(value):
+    """Parse a horizon list such as '1-90' or '7,14,30,60,90'"""
+    horizons = set()
+    for part in value.split(','):
+        part = part.strip()
+        if '-' in part:
+            low, high = part.split('-', 1)
+            horizons.update(range(int(low), int(high) + 1))
+        elif part:
+            horizons.add(int(part))
+    if not horizons or min(horizons) <= 0:
+        raise ValueError(f"Invalid horizons: {value}")
+    return sorted(horizons)
+
+
+class ForecastTable:
+    """Model outputs evaluated ahead of time for a window of calendar dates.
+
+    `values[day_offset, horizon_index, drug_index]` holds the raw model output for
+    `start_date + day_offset` predicted with `prediction_days=horizons[horizon_index]`.
+    """
+
+    def __init__(self, values, start_date, horizons, model_identity=None):
+        self.values = values
+        self.start_date = start_date
+        self.horizons = list(horizons)
+        self.model_identity = model_identity
+        self._horizon_index = {h: i for i, h in enumerate(self.horizons)}
+
+    @property
+    def n_days(self):
+        return self.values.shape[0]
+
+    @property
+    def end_date(self):
+        return self.start_date + timedelta(days=self.n_days - 1)
+
+    @classmethod
+    def build(cls, model, start_date, n_days, horizons=DEFAULT_HORIZONS, model_identity=None):
+        """Evaluate the model for every date in the window and every horizon"""
+        import pandas as pd
+
+        horizons = list(horizons)
+        dates = pd.date_range(start_date, periods=n_days, freq='D')
+
+        # The fitted ColumnTransformer drops columns it was not trained on; when the
+        # horizon is not one of them a single evaluation per date covers every horizon
+        used_features = set(getattr(model, 'feature_names_in_', []))
+        if used_features and 'prediction_days' not in used_features:
+            predictions = model.predict(build_feature_frame(dates, horizons[0]))
+            values = np.repeat(predictions[:, np.newaxis, :], len(horizons), axis=1)
+        else:
+            frame = build_feature_frame(np.repeat(dates.values, len(horizons)), np.tile(horizons, n_days))
+            predictions = model.predict(frame)
+            values = predictions.reshape(n_days, len(horizons), -1)
+
+        return cls(np.ascontiguousarray(values), start_date, horizons, model_identity)
+
+    def lookup(self, date, days):
+        """Return the model output vector for (date, days), or None when outside the table"""
+        horizon_index = self._horizon_index.get(days)
+        if horizon_index is None:
+            return None
+        offset = (date - self.start_date).days
+        if offset < 0 or offset >= self.n_days:
+            return None
+        return self.values[offset, horizon_index]
+
+    def lookup_range(self, date, n_days, days):
+        """Return the (n_days, n_drugs) outputs for consecutive dates from `date`, or None when not covered"""
+        horizon_index = self._horizon_index.get(days)
+        if horizon_index is None:
+            return None
+        offset = (date - self.start_date).days
+        if offset < 0 or offset + n_days > self.n_days:
+            return None
+        return self.values[offset:offset + n_days, horizon_index]
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        np.save(path, self.values)
+        metadata = {
+            'start_date': self.start_date.strftime('%Y-%m-%d'),
+            'n_days': self.n_days,
+            'horizons': self.horizons,
+            'model_identity': self.model_identity,
+            'created_at': datetime.now().isoformat(timespec='seconds')
+        }
+        with open(metadata_path(path), 'w') as f:
+            json.dump(metadata, f, indent=2)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        with open(metadata_path(path)) as f:
+            metadata = json.load(f)
+        values = np.load(path, mmap_mode='r' if mmap else None)
+        start_date = datetime.strptime(metadata['start_date'], '%Y-%m-%d')
+        return cls(values, start_date, metadata['horizons'], metadata.get('model_identity'))
+
+
+def metadata_path(path):
+    return os.path.splitext(path)[0] + '.json'
+
+
+def load_or_build_table(model, model_path, table_path, start_date, n_days, horizons, build=True):
+    """Load a fresh table from disk, rebuilding it when missing or stale if `build` is set"""
+    identity = model_file_identity(model_path)
+    if os.path.exists(table_path) and os.path.exists(metadata_path(table_path)):
+        table = ForecastTable.load(table_path)
+        if table.model_identity == identity:
+            logger.info(f"Loaded forecast table {table_path} ({table.start_date:%Y-%m-%d} to {table.end_date:%Y-%m-%d})")
+            return table
+        logger.warning(f"Forecast table {table_path} was built for a different model file")
+
+    if not build:
+        return None
+
+    logger.info(f"Precomputing forecast table for {n_days} days and {len(horizons)} horizons...")
+    start_time = time.perf_counter()
+    table = ForecastTable.build(model, start_date, n_days, horizons, identity)
+    table.save(table_path)
+    logger.info(f"Forecast table saved to {table_path} in {time.perf_counter() - start_time:.2f}s")
+    return table
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Precompute forecast model outputs for a window of dates')
+    parser.add_argument('--model', default=DEFAULT_MODEL_PATH, help='Path to the pickled model pipeline')
+    parser.add_argument('--output', default=DEFAULT_TABLE_PATH, help='Path of the .npy table to write')
+    parser.add_argument('--start', default=datetime.now().strftime('%Y-%m-%d'), help='First date of the window (YYYY-MM-DD)')
+    parser.add_argument('--days', type=int, default=730, help='Number of days in the window')
+    parser.add_argument('--horizons', default='1-90', help="Supported prediction periods, e.g. '1-90' or '7,30,90'")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    import joblib
+    model = joblib.load(args.model)
+    start_date = datetime.strptime(args.start, '%Y-%m-%d')
+    horizons = parse_horizons(args.horizons)
+
+    # End dates of forecasts near the window edge need max(horizons) extra days
+    n_days = args.days + max(horizons)
+    start_time = time.perf_counter()
+    table = ForecastTable.build(model, start_date, n_days, horizons, model_file_identity(args.model))
+    table.save(args.output)
+    logger.info(f"Wrote {table.values.shape} forecast table to {args.output} in {time.perf_counter() - start_time:.2f}s")
+
+
+if __name__ == '__main__':
+    main()
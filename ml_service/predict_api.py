@@ -1,4 +1,5 @@
 import logging
+import threading
 from datetime import datetime
 import os
 import numpy as np
@@ -21,14 +22,26 @@ EXPECTED_FEATURES = [
 ]
 
 class Predictor:
-    def __init__(self, model_path=None):
+    """Classifier inference for single rows or whole batches.
+
+    predict_batch accepts an (n, len(EXPECTED_FEATURES)) array, a DataFrame, a
+    dict of columns, an Arrow record batch or a list of dicts. Inputs are
+    written into a reusable feature buffer, scaled in place and evaluated with
+    a single predict_proba pass that yields both the class and its confidence.
+    """
+
+    def __init__(self, model_path=None, scaler_path=None):
         self.logger = logging.getLogger(__name__)
         self.model = None
         self.scaler = None
         # Use virtual environment directory for models
         venv_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-        self.model_path = model_path or os.path.join(venv_dir, 'venv', 'models', 'best_model_combined.pkl')
-        self.scaler_path = os.path.join(venv_dir, 'venv', 'models', 'scaler.pkl')
+        self.model_path = model_path or os.path.join(venv_dir, 'venv', 'models', 'best_model_classifier.pkl')
+        self.scaler_path = scaler_path or os.path.join(venv_dir, 'venv', 'models', 'scaler.pkl')
+
+        # Feature buffer grown on demand and reused across calls; the lock guards it
+        self._buffer = np.empty((0, len(EXPECTED_FEATURES)))
+        self._buffer_lock = threading.Lock()
         
         try:
             self.load_model()
@@ -60,52 +73,99 @@ class Predictor:
                 dump(self.scaler, self.scaler_path)
                 self.logger.info("Created and saved new default scaler")
                 
+            # Scaling parameters and classes, so batches skip the per-call sklearn checks
+            # sklearn sets mean_ even with with_mean=False, so the flags decide what transform applies
+            self._mean = self.scaler.mean_ if self.scaler.with_mean else None
+            self._scale = self.scaler.scale_ if self.scaler.with_std else None
+            self._classes = self.model.classes_
             self.logger.info("Successfully loaded model and scaler")
         except Exception as e:
             self.logger.error(f"Error loading model or scaler: {str(e)}")
             raise
 
+    def _rows_buffer(self, n_rows):
+        """The first n_rows of the feature buffer, growing it geometrically when too small"""
+        if self._buffer.shape[0] < n_rows:
+            self._buffer = np.empty((max(n_rows, 2 * self._buffer.shape[0]), len(EXPECTED_FEATURES)))
+        return self._buffer[:n_rows]
+
+    def _fill(self, batch):
+        """Copy a batch into the feature buffer in EXPECTED_FEATURES order; missing features are 0.0"""
+        if isinstance(batch, np.ndarray):
+            if batch.ndim != 2 or batch.shape[1] != len(EXPECTED_FEATURES):
+                raise ValueError(f"Expected an array of shape (n, {len(EXPECTED_FEATURES)}), got {batch.shape}")
+            buffer = self._rows_buffer(batch.shape[0])
+            buffer[...] = batch
+            return buffer
+
+        if isinstance(batch, (list, tuple)):
+            # Records: one dict per row
+            buffer = self._rows_buffer(len(batch))
+            for j, feature in enumerate(EXPECTED_FEATURES):
+                buffer[:, j] = [record.get(feature, 0.0) for record in batch]
+            return buffer
+
+        # Columnar: DataFrame, dict of arrays or Arrow RecordBatch/Table
+        if hasattr(batch, 'column_names'):
+            columns = {name: batch.column(name).to_numpy() for name in batch.column_names}
+        elif hasattr(batch, 'columns'):
+            columns = {name: batch[name].to_numpy() for name in batch.columns}
+        else:
+            columns = batch
+        n_rows = len(next(iter(columns.values()))) if columns else 0
+        buffer = self._rows_buffer(n_rows)
+        for j, feature in enumerate(EXPECTED_FEATURES):
+            buffer[:, j] = columns[feature] if feature in columns else 0.0
+        return buffer
+
+    def predict_batch(self, batch):
+        """Predict class and confidence for every row of a batch, from one predict_proba pass.
+
+        Returns {'prediction': array of classes, 'confidence': array of max probabilities}.
+        """
+        try:
+            with self._buffer_lock:
+                try:
+                    features = self._fill(batch)
+                except (TypeError, ValueError, KeyError) as e:
+                    raise ValueError(f"Error reading input batch: {str(e)}")
+                if self.logger.isEnabledFor(logging.DEBUG):
+                    self.logger.debug(f"Predicting a batch of {features.shape[0]} rows")
+
+                # StandardScaler.transform, in place on the buffer
+                if self._mean is not None:
+                    np.subtract(features, self._mean, out=features)
+                if self._scale is not None:
+                    np.divide(features, self._scale, out=features)
+
+                try:
+                    probabilities = self.model.predict_proba(features)
+                except Exception as e:
+                    self.logger.error(f"Error during model prediction: {str(e)}")
+                    raise ValueError(f"Error making prediction: {str(e)}")
+
+            # Same class as model.predict: the most probable one
+            best = probabilities.argmax(axis=1)
+            return {
+                'prediction': self._classes[best],
+                'confidence': probabilities[np.arange(len(best)), best]
+            }
+
+        except Exception as e:
+            self.logger.error(f"Error in predict_batch method: {str(e)}", exc_info=True)
+            raise
+
     def predict(self, input_data):
-        """Make predictions using the loaded model"""
+        """Make a prediction for one dict of features"""
         try:
-            self.logger.debug(f"Input data received: {input_data}")
-            
-            # Ensure all required features are present
-            processed_data = {}
-            for feature in EXPECTED_FEATURES:
-                if feature in input_data:
-                    processed_data[feature] = float(input_data[feature])
-                else:
-                    processed_data[feature] = 0.0  # Default value for missing features
-            
-            # Convert to DataFrame with correct column order
-            df = pd.DataFrame([processed_data])[EXPECTED_FEATURES]
-            self.logger.debug(f"Processed DataFrame: {df.to_dict('records')}")
-            
-            # Scale the input data
-            try:
-                scaled_data = self.scaler.transform(df)
-                self.logger.debug(f"Scaled data shape: {scaled_data.shape}")
-            except Exception as e:
-                self.logger.error(f"Error during scaling: {str(e)}")
-                raise ValueError(f"Error scaling input data: {str(e)}")
-            
-            # Make prediction
-            try:
-                prediction = self.model.predict(scaled_data)
-                confidence = float(self.model.predict_proba(scaled_data).max())
-                self.logger.debug(f"Raw prediction: {prediction[0]}, Confidence: {confidence}")
-            except Exception as e:
-                self.logger.error(f"Error during model prediction: {str(e)}")
-                raise ValueError(f"Error making prediction: {str(e)}")
-            
-            result = {
-                'prediction': float(prediction[0]),
-                'confidence': confidence
+            result = self.predict_batch([{
+                feature: float(input_data[feature]) for feature in EXPECTED_FEATURES if feature in input_data
+            }])
+            return {
+                'prediction': float(result['prediction'][0]),
+                'confidence': float(result['confidence'][0])
             }
-            self.logger.debug(f"Final prediction result: {result}")
-            return result
-            
+
         except Exception as e:
             self.logger.error(f"Error in predict method: {str(e)}", exc_info=True)
             raise
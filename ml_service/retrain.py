@@ -0,0 +1,168 @@
+"""Incremental retraining of the combined model on newly ingested sales rows.
+
+Instead of refitting from scratch, every per-drug GradientBoostingRegressor of
+the published model is warm-started: it keeps its existing trees and fits
+--extra-estimators more stages on the feature store rows added since the last
+training run. The tail of the new rows is held out, and the candidate is only
+published when its holdout error is no worse than the current model's.
+
+    python train_combined_model.py                   # full training, records the trained rows and model
+    python retrain.py --extra-estimators 20          # later, after new rows were appended
+"""
+import os
+import copy
+import time
+import argparse
+
+import joblib
+import numpy as np
+import pandas as pd
+
+from compiled_model import CompiledModel, artifact_path, file_sha256
+from feature_store import FeatureStore
+from model_registry import ModelRegistry
+from simulation import fit_residuals, write_residuals
+from ingest import CALENDAR_COLUMNS, DEFAULT_CHUNKSIZE
+from ingest import to_training_frame
+from train_combined_model import (
+    MODEL_PATH, TRAINING_STATE_PATH, fit_estimators_in_pool, load_training_state, logger, save_training_state
+)
+
+
+def load_new_rows(store, trained_rows, holdout_fraction):
+    """Split the rows each source gained since training into (train, holdout) frames.
+
+    The last `holdout_fraction` of every source's new rows is held out so the
+    validation rows are the most recent ones. Also returns the row counts the
+    candidate is trained on, so held-out rows are trained on by the next run.
+    """
+    all_columns = store.load_columns()
+    # Fill missing calendar values with the means the full training set would use
+    fill_values = pd.Series({column: float(np.nanmean(all_columns[column])) for column in CALENDAR_COLUMNS})
+
+    train_parts, holdout_parts = [], []
+    new_trained_rows = dict(trained_rows)
+    for filename, rows in store.source_rows().items():
+        start = trained_rows.get(filename, 0)
+        if rows < start:
+            raise ValueError(f"{filename} has {rows} rows but the model was trained on {start}; run a full training")
+        if rows == start:
+            continue
+        columns = {name: array[start:] for name, array in store.load_source_columns(filename).items()}
+        split = (rows - start) - int(round((rows - start) * holdout_fraction))
+        train_parts.append({name: array[:split] for name, array in columns.items()})
+        holdout_parts.append({name: array[split:] for name, array in columns.items()})
+        new_trained_rows[filename] = start + split
+        logger.info(f"{filename}: {rows - start} new rows ({split} train, {rows - start - split} holdout)")
+
+    def stack(parts):
+        columns = {name: np.concatenate([part[name] for part in parts]) for name in parts[0]}
+        return to_training_frame(columns, fill_values)
+
+    if not train_parts:
+        return None, None, trained_rows
+    return stack(train_parts), stack(holdout_parts), new_trained_rows
+
+
+def holdout_mse(model, X, y):
+    return float(np.mean((y.to_numpy() - model.predict(X)) ** 2))
+
+
+def warm_start(current, X, y, extra_estimators, n_workers=None):
+    """Return a copy of the pipeline with extra boosting stages fitted on (X, y)"""
+    candidate = copy.deepcopy(current)
+    preprocessor = candidate.named_steps['preprocessor']
+    regressor = candidate.named_steps['model']
+
+    # Scale with the already fitted preprocessor so new trees see the same feature space
+    X_transformed = preprocessor.transform(X)
+    estimators = []
+    for estimator in regressor.estimators_:
+        # HistGradientBoostingRegressor counts its stages as max_iter / n_iter_
+        if hasattr(estimator, 'n_estimators_'):
+            estimator.set_params(warm_start=True, n_estimators=estimator.n_estimators_ + extra_estimators)
+        else:
+            estimator.set_params(warm_start=True, max_iter=estimator.n_iter_ + extra_estimators)
+        estimators.append(estimator)
+
+    fitted = fit_estimators_in_pool(estimators, X_transformed, y, n_workers)
+    for estimator in fitted:
+        estimator.set_params(warm_start=False)
+    regressor.estimators_ = fitted
+    return candidate
+
+
+def publish(model, model_path, source_rows, residuals, **extra):
+    """Atomically replace the published pickle, its artifact and residuals, and publish a registry version"""
+    tmp_path = model_path + '.tmp'
+    joblib.dump(model, tmp_path)
+    # The artifact records the sha256 of tmp_path, which is the same file after the rename;
+    # until then the service sees a mismatch and keeps using the current pickle
+    if CompiledModel.supports(model):
+        CompiledModel.from_pipeline(model).save(artifact_path(model_path), source_path=tmp_path)
+    write_residuals(residuals, model_path, source_path=tmp_path)
+    os.replace(tmp_path, model_path)
+    save_training_state(source_rows, TRAINING_STATE_PATH, model_path, **extra)
+    return ModelRegistry().publish(model_path, pipeline=model, source_script='retrain.py', **extra)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Warm-start the combined model on newly ingested rows')
+    parser.add_argument('--extra-estimators', type=int, default=20, help='Boosting stages added per drug type')
+    parser.add_argument('--holdout', type=float, default=0.2, help='Fraction of the new rows held out for validation')
+    parser.add_argument('--tolerance', type=float, default=0.0,
+                        help='Relative holdout MSE increase still accepted, e.g. 0.01 for 1%%')
+    parser.add_argument('--workers', type=int, default=int(os.getenv('TRAIN_WORKERS', os.cpu_count() or 1)))
+    parser.add_argument('--chunksize', type=int, default=DEFAULT_CHUNKSIZE)
+    parser.add_argument('--dry-run', action='store_true', help='Validate the candidate without publishing it')
+    args = parser.parse_args()
+
+    try:
+        state = load_training_state()
+        if state is None:
+            raise FileNotFoundError(f"{TRAINING_STATE_PATH} not found, run train_combined_model.py first")
+        # A state written for another model would warm-start on rows it was already fitted on
+        if state.get('model_sha256') != file_sha256(MODEL_PATH):
+            raise ValueError(f"{TRAINING_STATE_PATH} does not describe {MODEL_PATH}, run train_combined_model.py first")
+
+        store = FeatureStore()
+        actions = store.refresh(args.chunksize)
+        logger.info(f"Feature store: {actions}")
+
+        train, holdout, trained_rows = load_new_rows(store, state['source_rows'], args.holdout)
+        if train is None:
+            logger.info("No new rows since the last training, nothing to do")
+            return
+        (X_train, y_train), (X_holdout, y_holdout) = train, holdout
+        if len(X_train) == 0 or len(X_holdout) == 0:
+            raise ValueError(f"Too few new rows ({len(X_train) + len(X_holdout)}) for a holdout of {args.holdout}")
+
+        current = joblib.load(MODEL_PATH)
+        start = time.perf_counter()
+        candidate = warm_start(current, X_train, y_train, args.extra_estimators, args.workers)
+        logger.info(f"Warm-started {args.extra_estimators} stages on {len(X_train)} rows in {time.perf_counter() - start:.2f}s")
+
+        current_mse = holdout_mse(current, X_holdout, y_holdout)
+        candidate_mse = holdout_mse(candidate, X_holdout, y_holdout)
+        logger.info(f"Holdout MSE on {len(X_holdout)} rows: current {current_mse:.6f}, candidate {candidate_mse:.6f}")
+
+        if candidate_mse > current_mse * (1 + args.tolerance):
+            logger.warning("Candidate is worse than the current model on the holdout, keeping the current model")
+            return
+        if args.dry_run:
+            logger.info("Dry run, not publishing the candidate")
+            return
+
+        # Residuals of the candidate on every cached row, as train_combined_model.py fits them
+        residuals = fit_residuals(candidate, *store.load_training_data())
+        version = publish(candidate, MODEL_PATH, trained_rows, residuals,
+                          holdout_mse=candidate_mse, previous_holdout_mse=current_mse)
+        logger.info(f"Published warm-started model to {MODEL_PATH} as version {version}")
+
+    except Exception as e:
+        logger.error(f"Error in incremental retraining: {str(e)}", exc_info=True)
+        raise
+
+
+if __name__ == '__main__':
+    main()
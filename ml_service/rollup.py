@@ -0,0 +1,369 @@
+"""Daily, weekly and monthly sales rollups derived from the hourly stream.
+
+Only saleshourly.csv is parsed. Its rows are kept sorted by hour, and the
+coarser granularities are maintained from them with vectorized bucketing
+(datetime64 arithmetic and np.add.reduceat, no per-row Python):
+
+  daily    calendar days; Hour is the summed hour of day, as in salesdaily.csv
+  weekly   weeks ending on Sunday, labelled with that Sunday as in salesweekly.csv
+  monthly  calendar months, labelled with the month end as in salesmonthly.csv
+
+New hourly rows are folded in incrementally. Their sums are added to the
+buckets they fall in, and no other bucket is read or written. A row for an
+hour that is already stored replaces it, and only the difference is applied.
+RollupStore persists the state with a manifest of the saleshourly.csv bytes
+consumed so far. A refresh after rows were appended parses only the new rows.
+
+    python rollup.py refresh
+    python rollup.py export --granularity weekly --output salesweekly.csv
+    python rollup.py verify
+"""
+import os
+import json
+import time
+import logging
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from ingest import DEFAULT_CHUNKSIZE, DRUG_TYPES, SALES_SOURCES, derive_features, to_training_frame
+from feature_store import hash_file, read_appended_bytes
+
+logger = logging.getLogger(__name__)
+
+STORE_FORMAT_VERSION = 1
+
+DEFAULT_DATA_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_CACHE_DIR = os.path.join(DEFAULT_DATA_DIR, 'rollup_cache')
+
+HOURLY_FILE, _, HOURLY_DATE_FORMAT = SALES_SOURCES[0]
+GRANULARITIES = ['daily', 'weekly', 'monthly']
+
+# Columns of a rollup's sums: the drug sales, then the summed hour of day and the hourly row count
+HOUR_SUM = len(DRUG_TYPES)
+ROW_COUNT = len(DRUG_TYPES) + 1
+N_SUMS = len(DRUG_TYPES) + 2
+
+
+def bucket_labels(days, granularity):
+    """Label of the bucket each day (datetime64[D]) falls in"""
+    if granularity == 'daily':
+        return days
+    if granularity == 'weekly':
+        # 1970-01-01 was a Thursday; with Monday as 0 every week ends on weekday 6
+        weekday = (days.astype(np.int64) + 3) % 7
+        return days + (6 - weekday)
+    if granularity == 'monthly':
+        return (days.astype('datetime64[M]') + 1).astype('datetime64[D]') - 1
+    raise ValueError(f"Unknown granularity {granularity}, use one of {GRANULARITIES}")
+
+
+def group_sum(keys, values):
+    """Sum the rows of values that share a key; returns (sorted distinct keys, sums)"""
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    return keys[starts], np.add.reduceat(values[order], starts, axis=0)
+
+
+def locate(sorted_keys, keys):
+    """Insertion positions of keys in sorted_keys, and which of them are already present"""
+    positions = np.searchsorted(sorted_keys, keys)
+    present = positions < len(sorted_keys)
+    present[present] = sorted_keys[positions[present]] == keys[present]
+    return positions, present
+
+
+class Rollup:
+    """Sorted bucket labels of one granularity and the sums of the hourly rows in each bucket"""
+
+    def __init__(self, labels=None, sums=None):
+        self.labels = labels if labels is not None else np.empty(0, dtype='datetime64[D]')
+        self.sums = sums if sums is not None else np.empty((0, N_SUMS))
+
+    def __len__(self):
+        return len(self.labels)
+
+    def apply(self, labels, deltas):
+        """Add per-bucket deltas (distinct, sorted labels); returns (buckets updated, buckets added)"""
+        positions, present = locate(self.labels, labels)
+        self.sums[positions[present]] += deltas[present]
+        added = ~present
+        if added.any():
+            self.labels = np.insert(self.labels, positions[added], labels[added])
+            self.sums = np.insert(self.sums, positions[added], deltas[added], axis=0)
+        return int(present.sum()), int(added.sum())
+
+
+class RollupEngine:
+    """Hourly sales rows plus their daily, weekly and monthly rollups, updated together"""
+
+    def __init__(self):
+        self.hours = np.empty(0, dtype='datetime64[s]')
+        self.values = np.empty((0, len(DRUG_TYPES)))
+        self.rollups = {granularity: Rollup() for granularity in GRANULARITIES}
+
+    def ingest(self, hours, values):
+        """Fold hourly rows into the rollups.
+
+        hours are timestamps, values an (n, n_drugs) array in DRUG_TYPES order.
+        Returns the number of hours and buckets updated and added per level.
+        """
+        hours = np.asarray(hours, dtype='datetime64[s]')
+        values = np.asarray(values, dtype=np.float64).reshape(len(hours), len(DRUG_TYPES))
+        touched = {'hourly': {'updated': 0, 'added': 0}}
+        touched.update({granularity: {'updated': 0, 'added': 0} for granularity in GRANULARITIES})
+        if len(hours) == 0:
+            return touched
+
+        # Sort the batch by hour; when an hour repeats its last row wins
+        order = np.argsort(hours, kind='stable')
+        hours, values = hours[order], values[order]
+        last = np.r_[hours[1:] != hours[:-1], True]
+        hours, values = hours[last], values[last]
+
+        # Replaced hours contribute their difference, new hours their values, hour of day and a row
+        positions, present = locate(self.hours, hours)
+        days = hours.astype('datetime64[D]')
+        deltas = np.zeros((len(hours), N_SUMS))
+        deltas[:, :HOUR_SUM] = values
+        deltas[present, :HOUR_SUM] -= self.values[positions[present]]
+        added = ~present
+        deltas[added, HOUR_SUM] = (hours[added] - days[added]).astype('timedelta64[h]').astype(np.int64)
+        deltas[added, ROW_COUNT] = 1
+
+        self.values[positions[present]] = values[present]
+        if added.any():
+            self.hours = np.insert(self.hours, positions[added], hours[added])
+            self.values = np.insert(self.values, positions[added], values[added], axis=0)
+        touched['hourly'] = {'updated': int(present.sum()), 'added': int(added.sum())}
+
+        # Weeks and months are summed from the per-day deltas instead of the rows again
+        day_labels, day_deltas = group_sum(days, deltas)
+        for granularity in GRANULARITIES:
+            if granularity == 'daily':
+                labels, bucket_deltas = day_labels, day_deltas
+            else:
+                labels, bucket_deltas = group_sum(bucket_labels(day_labels, granularity), day_deltas)
+            updated, added_buckets = self.rollups[granularity].apply(labels, bucket_deltas)
+            touched[granularity] = {'updated': updated, 'added': added_buckets}
+        return touched
+
+    def frame(self, time_period):
+        """One level in the column layout of its sales CSV, with datum as timestamps.
+
+        The hourly and daily levels carry the Year, Month, Hour and Weekday Name columns.
+        """
+        if time_period == 'hourly':
+            datum = pd.DatetimeIndex(self.hours)
+            frame = pd.DataFrame(self.values, columns=DRUG_TYPES)
+            hour = datum.hour
+        else:
+            rollup = self.rollups[time_period]
+            datum = pd.DatetimeIndex(rollup.labels.astype('datetime64[s]'))
+            frame = pd.DataFrame(rollup.sums[:, :HOUR_SUM], columns=DRUG_TYPES)
+            hour = rollup.sums[:, HOUR_SUM].astype(np.int64)
+        frame.insert(0, 'datum', datum)
+        if time_period in ('hourly', 'daily'):
+            frame['Year'] = datum.year
+            frame['Month'] = datum.month
+            frame['Hour'] = hour
+            frame['Weekday Name'] = datum.day_name()
+        return frame
+
+    def load_columns(self):
+        """Compact feature columns of every level, stacked in SALES_SOURCES order like load_sales_streaming"""
+        parts = [derive_features(self.frame(time_period), None) for _, time_period, _ in SALES_SOURCES]
+        return {name: np.concatenate([part[name] for part in parts]) for name in parts[0]}
+
+    def load_training_data(self):
+        """(X, y) as returned by load_and_preprocess_data, with every level derived from the hourly rows"""
+        return to_training_frame(self.load_columns())
+
+    def state(self):
+        arrays = {'hours': self.hours, 'values': self.values}
+        for granularity, rollup in self.rollups.items():
+            arrays[f'{granularity}_labels'] = rollup.labels
+            arrays[f'{granularity}_sums'] = rollup.sums
+        return arrays
+
+    @classmethod
+    def from_state(cls, arrays):
+        engine = cls()
+        engine.hours = arrays['hours']
+        engine.values = arrays['values']
+        for granularity in GRANULARITIES:
+            engine.rollups[granularity] = Rollup(arrays[f'{granularity}_labels'], arrays[f'{granularity}_sums'])
+        return engine
+
+
+def iter_hourly_chunks(source, chunksize=DEFAULT_CHUNKSIZE):
+    """Yield (hours, values) of an hourly sales CSV, chunksize rows at a time"""
+    reader = pd.read_csv(
+        source,
+        chunksize=chunksize,
+        usecols=['datum'] + DRUG_TYPES,
+        dtype={'datum': str, **{drug: np.float64 for drug in DRUG_TYPES}}
+    )
+    for chunk in reader:
+        hours = pd.to_datetime(chunk['datum'], format=HOURLY_DATE_FORMAT).to_numpy(dtype='datetime64[s]')
+        yield hours, chunk[DRUG_TYPES].to_numpy()
+
+
+class RollupStore:
+    """RollupEngine persisted in cache_dir and kept in sync with saleshourly.csv.
+
+    manifest.json records the size and sha256 of the hourly file bytes already
+    ingested, the same way FeatureStore tracks its sources. When the file only
+    grew, refresh parses the appended rows and folds them into the stored rollups.
+    Any other change rebuilds from the whole file.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, data_dir=DEFAULT_DATA_DIR):
+        self.cache_dir = cache_dir
+        self.data_dir = data_dir
+        self.manifest_path = os.path.join(cache_dir, 'manifest.json')
+        self.state_path = os.path.join(cache_dir, 'rollups.npz')
+        self.manifest = self._read_manifest()
+        self._engine = None
+
+    def _read_manifest(self):
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+            if manifest.get('format_version') == STORE_FORMAT_VERSION:
+                return manifest
+        return {'format_version': STORE_FORMAT_VERSION, 'source': None}
+
+    def _write_manifest(self):
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(tmp_path, self.manifest_path)
+
+    @property
+    def engine(self):
+        if self._engine is None:
+            if self.manifest['source'] is None or not os.path.exists(self.state_path):
+                raise FileNotFoundError(f"No rollups in {self.cache_dir}, run refresh() first")
+            with np.load(self.state_path) as arrays:
+                self._engine = RollupEngine.from_state({name: arrays[name] for name in arrays.files})
+        return self._engine
+
+    def _save_engine(self, engine):
+        tmp_path = self.state_path + '.tmp.npz'
+        np.savez(tmp_path, **engine.state())
+        os.replace(tmp_path, self.state_path)
+        self._engine = engine
+
+    def refresh(self, chunksize=DEFAULT_CHUNKSIZE):
+        """Bring the rollups up to date with the hourly file; returns the action and touched buckets"""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = os.path.join(self.data_dir, HOURLY_FILE)
+        entry = self.manifest['source']
+        sha256, prefix_sha256, size = hash_file(path, entry['size'] if entry else None)
+        if entry and entry['sha256'] == sha256:
+            return {'action': 'cached'}
+
+        start = time.perf_counter()
+        # Only new rows were appended when the old bytes are an intact, newline-terminated prefix
+        appended = bool(entry) and prefix_sha256 == entry['sha256'] and entry.get('ends_with_newline', False)
+        if appended:
+            engine = self.engine
+            source = read_appended_bytes(path, entry['size'])
+            action = 'appended'
+        else:
+            engine = RollupEngine()
+            source = path
+            action = 'rebuilt'
+
+        touched = {}
+        for hours, values in iter_hourly_chunks(source, chunksize):
+            for level, counts in engine.ingest(hours, values).items():
+                total = touched.setdefault(level, {'updated': 0, 'added': 0})
+                total['updated'] += counts['updated']
+                total['added'] += counts['added']
+        if not len(engine.hours):
+            raise ValueError(f"{HOURLY_FILE} contains no rows")
+        self._save_engine(engine)
+
+        with open(path, 'rb') as f:
+            f.seek(max(size - 1, 0))
+            ends_with_newline = f.read(1) == b'\n'
+        self.manifest['source'] = {
+            'file': HOURLY_FILE,
+            'size': size,
+            'sha256': sha256,
+            'rows': len(engine.hours),
+            'ends_with_newline': ends_with_newline
+        }
+        self._write_manifest()
+        logger.info(f"Rollups {action} from {HOURLY_FILE} in {time.perf_counter() - start:.2f}s: {touched}")
+        return {'action': action, 'touched': touched}
+
+    def frame(self, time_period):
+        return self.engine.frame(time_period)
+
+    def load_columns(self):
+        return self.engine.load_columns()
+
+    def load_training_data(self):
+        return self.engine.load_training_data()
+
+
+def export_csv(frame, path, date_format):
+    frame = frame.copy()
+    frame['datum'] = frame['datum'].dt.strftime(date_format)
+    frame.to_csv(path, index=False)
+
+
+def verify(store, data_dir=DEFAULT_DATA_DIR):
+    """Compare each rollup with its legacy CSV; returns per level the buckets and the ones differing"""
+    report = {}
+    for filename, time_period, date_format in SALES_SOURCES[1:]:
+        legacy = pd.read_csv(os.path.join(data_dir, filename))
+        legacy['datum'] = pd.to_datetime(legacy['datum'], format=date_format)
+        derived = store.frame(time_period).set_index('datum')[DRUG_TYPES]
+        joined = derived.join(legacy.set_index('datum')[DRUG_TYPES], rsuffix='_legacy', how='outer')
+        difference = np.abs(joined[DRUG_TYPES].to_numpy()
+                            - joined[[f'{drug}_legacy' for drug in DRUG_TYPES]].to_numpy())
+        differing = np.isnan(difference).any(axis=1) | (np.nan_to_num(difference) > 1e-6).any(axis=1)
+        report[time_period] = {
+            'buckets': len(derived),
+            'legacy_rows': len(legacy),
+            'differing': int(differing.sum()),
+            'max_abs_difference': float(np.nanmax(difference)) if len(difference) else 0.0
+        }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Maintain daily, weekly and monthly rollups of the hourly sales')
+    parser.add_argument('command', nargs='?', choices=['refresh', 'export', 'verify'], default='refresh')
+    parser.add_argument('--data-dir', default=DEFAULT_DATA_DIR)
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR)
+    parser.add_argument('--chunksize', type=int, default=DEFAULT_CHUNKSIZE)
+    parser.add_argument('--granularity', choices=GRANULARITIES, default='daily', help='Level to export')
+    parser.add_argument('--output', help='CSV path for export, in the layout of the legacy sales file')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    store = RollupStore(args.cache_dir, args.data_dir)
+    result = store.refresh(args.chunksize)
+    logger.info(f"Rollups {result['action']}: {len(store.engine.hours)} hours, "
+                + ', '.join(f"{len(rollup)} {granularity}" for granularity, rollup in store.engine.rollups.items()))
+
+    if args.command == 'export':
+        date_format = {time_period: date_format for _, time_period, date_format in SALES_SOURCES}[args.granularity]
+        output = args.output or f'sales{args.granularity}.rollup.csv'
+        export_csv(store.frame(args.granularity), output, date_format)
+        logger.info(f"Wrote {args.granularity} rollup to {output}")
+    elif args.command == 'verify':
+        for time_period, values in verify(store, args.data_dir).items():
+            logger.info(f"{time_period}: {values['buckets']} buckets vs {values['legacy_rows']} legacy rows, "
+                        f"{values['differing']} differing, max abs difference {values['max_abs_difference']:.6g}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,280 @@
+"""Content negotiation for the forecast and model-info endpoints.
+
+JSON stays the default. Clients can ask for two binary formats with the
+Accept header or ?format=json|msgpack|arrow:
+
+  application/msgpack                   the JSON document, MessagePack encoded
+  application/vnd.apache.arrow.stream   Arrow IPC stream: typed column arrays,
+                                        with the scalar fields of the JSON
+                                        document in the schema metadata
+
+Request bodies are decoded by their Content-Type in the same formats. An Arrow
+body is a table with one row per forecast. msgpack and pyarrow are optional and
+imported on first use; a format whose library is missing is not offered, and
+asking for it explicitly is answered with 406 (or 415 for a request body).
+
+    curl -X POST -H 'Accept: application/msgpack' -H 'Content-Type: application/json' \\
+         -d '{"drug_type": "M01AB", "date": "2025-06-01", "days": 30, "stock_level": 100}' \\
+         http://localhost:5003/predict/forecast
+
+Compare payload size and (de)serialization time against JSON:
+
+    python serialization.py --rows 10000 --days 3650
+"""
+import sys
+import json
+import time
+import argparse
+import importlib
+
+from flask import Response, jsonify
+from werkzeug.exceptions import BadRequest
+
+JSON = 'json'
+MSGPACK = 'msgpack'
+ARROW = 'arrow'
+FORMATS = [JSON, MSGPACK, ARROW]
+
+MIMETYPES = {
+    JSON: 'application/json',
+    MSGPACK: 'application/msgpack',
+    ARROW: 'application/vnd.apache.arrow.stream'
+}
+
+# Media types understood in Accept and Content-Type, including the older msgpack alias
+FORMAT_BY_MIMETYPE = {
+    'application/json': JSON,
+    'application/msgpack': MSGPACK,
+    'application/x-msgpack': MSGPACK,
+    'application/vnd.apache.arrow.stream': ARROW
+}
+
+LIBRARIES = {MSGPACK: 'msgpack', ARROW: 'pyarrow'}
+_libraries = {}
+
+
+class FormatError(ValueError):
+    """A format that cannot be produced or decoded; status is the HTTP status to answer with"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def library(fmt):
+    """The module implementing a binary format, or None when it is not installed"""
+    if fmt not in _libraries:
+        try:
+            _libraries[fmt] = importlib.import_module(LIBRARIES[fmt])
+        except ImportError:
+            _libraries[fmt] = None
+    return _libraries[fmt]
+
+
+def available(fmt):
+    return fmt == JSON or library(fmt) is not None
+
+
+def available_formats():
+    return [fmt for fmt in FORMATS if available(fmt)]
+
+
+def negotiate(request):
+    """Response format from ?format= or the Accept header; JSON when neither asks otherwise"""
+    requested = request.args.get('format')
+    if requested:
+        if requested not in MIMETYPES:
+            raise FormatError(f'Unknown format: {requested}. Use one of {", ".join(FORMATS)}', 406)
+        if not available(requested):
+            raise FormatError(f'Format {requested} is not available: {LIBRARIES[requested]} is not installed', 406)
+        return requested
+
+    accept = request.accept_mimetypes
+    if not accept:
+        return JSON
+    # JSON is offered first so */* and browser Accept headers keep getting JSON
+    offered = [mimetype for mimetype, fmt in FORMAT_BY_MIMETYPE.items() if available(fmt)]
+    best = accept.best_match(offered)
+    if best is None:
+        raise FormatError(f'None of the accepted media types can be produced. Available: '
+                          f'{", ".join(MIMETYPES[fmt] for fmt in available_formats())}', 406)
+    return FORMAT_BY_MIMETYPE[best]
+
+
+def decode_body(request, single=False):
+    """Decode the request body by its Content-Type: JSON, MessagePack or Arrow.
+
+    An Arrow body decodes to a list of row dicts, or to the only row when single is set.
+    Other content types raise FormatError 415 and malformed JSON FormatError 400.
+    """
+    if request.is_json:
+        try:
+            return request.get_json()
+        except BadRequest:
+            raise FormatError('Malformed json request body')
+    fmt = FORMAT_BY_MIMETYPE.get(request.mimetype)
+    if fmt is None:
+        raise FormatError(f'Unsupported request Content-Type: {request.mimetype or "none"}. '
+                          f'Use one of {", ".join(MIMETYPES[fmt] for fmt in available_formats())}', 415)
+    if not available(fmt):
+        raise FormatError(f'Request bodies in {request.mimetype} are not supported: '
+                          f'{LIBRARIES[fmt]} is not installed', 415)
+
+    data = request.get_data()
+    try:
+        if fmt == MSGPACK:
+            return library(MSGPACK).unpackb(data, raw=False)
+        records = arrow_records(data)
+    except Exception as e:
+        raise FormatError(f'Malformed {fmt} request body: {e}')
+    if single:
+        if len(records) != 1:
+            raise FormatError(f'Arrow request body must contain exactly one row, got {len(records)}')
+        return records[0]
+    return records
+
+
+def arrow_records(data):
+    """Rows of an Arrow IPC stream as dicts, with date and timestamp columns as YYYY-MM-DD strings"""
+    pa = library(ARROW)
+    import pyarrow.compute as pc
+
+    table = pa.ipc.open_stream(data).read_all()
+    for i, field in enumerate(table.schema):
+        if pa.types.is_date(field.type) or pa.types.is_timestamp(field.type):
+            table = table.set_column(i, field.name, pc.strftime(table.column(i), format='%Y-%m-%d'))
+    return table.to_pylist()
+
+
+def arrow_stream(columns, metadata=None):
+    """Encode equally long column arrays as one Arrow IPC stream.
+
+    numpy datetime64[D] columns become date32; metadata values are stored as JSON.
+    """
+    pa = library(ARROW)
+    table = pa.table(columns)
+    if metadata:
+        table = table.replace_schema_metadata({key: json.dumps(value) for key, value in metadata.items()})
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def document_response(fmt, document):
+    """Answer with a JSON-shaped document, as JSON or MessagePack"""
+    if fmt == MSGPACK:
+        response = Response(library(MSGPACK).packb(document, use_bin_type=True), mimetype=MIMETYPES[MSGPACK])
+    else:
+        response = jsonify(document)
+    response.vary.add('Accept')
+    return response
+
+
+def arrow_response(columns, metadata=None):
+    response = Response(arrow_stream(columns, metadata), mimetype=MIMETYPES[ARROW])
+    response.vary.add('Accept')
+    return response
+
+
+def encode_body(fmt, records):
+    """Client side: a list of row dicts as a request body in fmt, returns (bytes, content type)"""
+    if fmt == MSGPACK:
+        return library(MSGPACK).packb(records, use_bin_type=True), MIMETYPES[MSGPACK]
+    if fmt == ARROW:
+        pa = library(ARROW)
+        table = pa.Table.from_pylist(records)
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return sink.getvalue().to_pybytes(), MIMETYPES[ARROW]
+    return json.dumps(records).encode(), MIMETYPES[JSON]
+
+
+def decode_response(fmt, data):
+    """Client side: decode a response body; Arrow streams decode to a pyarrow Table"""
+    if fmt == MSGPACK:
+        return library(MSGPACK).unpackb(data, raw=False)
+    if fmt == ARROW:
+        return library(ARROW).ipc.open_stream(data).read_all()
+    return json.loads(data)
+
+
+def benchmark_case(client, fmt, method, path, body, repeats):
+    """Median request time, request and response bytes and client decode time of one endpoint"""
+    kwargs = {'headers': {'Accept': MIMETYPES[fmt]}}
+    request_bytes = 0
+    if body is not None:
+        data, content_type = encode_body(fmt, body)
+        kwargs.update(data=data, content_type=content_type)
+        request_bytes = len(data)
+
+    request_times, decode_times = [], []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        response = client.open(path, method=method, **kwargs)
+        payload = response.get_data()
+        request_times.append(time.perf_counter() - start)
+        if response.status_code != 200:
+            raise RuntimeError(f"{method} {path} as {fmt} returned {response.status_code}: {payload[:200]}")
+        start = time.perf_counter()
+        decode_response(fmt, payload)
+        decode_times.append(time.perf_counter() - start)
+
+    request_times.sort()
+    decode_times.sort()
+    return {
+        'request_ms': request_times[len(request_times) // 2] * 1000,
+        'decode_ms': decode_times[len(decode_times) // 2] * 1000,
+        'request_bytes': request_bytes,
+        'response_bytes': len(payload)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare JSON, MessagePack and Arrow payloads of the ML service')
+    parser.add_argument('--rows', type=int, default=10000, help='Forecasts in the batch request')
+    parser.add_argument('--days', type=int, default=3650, help='Horizon of the series request')
+    parser.add_argument('--repeats', type=int, default=7)
+    args = parser.parse_args()
+
+    import app as flask_module
+    from benchmark import make_forecast_payloads
+
+    flask_module.get_predictor()
+    client = flask_module.app.test_client()
+    forecasts = make_forecast_payloads(args.rows)
+    cases = {
+        'forecast': ('POST', '/predict/forecast', [forecasts[0]]),
+        'batch': ('POST', '/predict/forecast/batch', forecasts),
+        'series': ('POST', '/predict/forecast/series',
+                   [{'date': '2025-01-01', 'days': args.days, 'stock_level': 100}]),
+        'model_info': ('GET', '/model/info?per_drug=true', None)
+    }
+
+    formats = available_formats()
+    missing = [fmt for fmt in FORMATS if fmt not in formats]
+    if missing:
+        print(f"Skipping {', '.join(missing)}: {', '.join(LIBRARIES[fmt] for fmt in missing)} not installed",
+              file=sys.stderr)
+
+    header = (f"{'endpoint':<11} {'format':<8} {'request ms':>11} {'decode ms':>10} "
+              f"{'request B':>11} {'response B':>11} {'vs JSON':>8}")
+    print(header)
+    print('-' * len(header))
+    for name, (method, path, body) in cases.items():
+        # Single-object endpoints take one object; Arrow sends it as a one-row table
+        baseline = None
+        for fmt in formats:
+            case_body = body
+            if body is not None and name != 'batch' and fmt != ARROW:
+                case_body = body[0]
+            result = benchmark_case(client, fmt, method, path, case_body, args.repeats)
+            baseline = baseline or result
+            ratio = result['response_bytes'] / baseline['response_bytes']
+            print(f"{name:<11} {fmt:<8} {result['request_ms']:>11.2f} {result['decode_ms']:>10.2f} "
+                  f"{result['request_bytes']:>11,} {result['response_bytes']:>11,} {ratio:>7.0%}")
+
+
+if __name__ == '__main__':
+    main()
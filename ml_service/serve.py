@@ -0,0 +1,279 @@
+"""Production entry point for the ML service.
+
+The master process imports app.py, which loads the model, and then forks the
+worker processes so they share the model memory copy-on-write. Workers serve
+the unchanged Flask app from a shared listening socket with a bounded thread
+pool each. Workers swap in new model versions themselves (see model_registry.py).
+The master restarts workers that die, and replaces all of them gracefully when
+it receives SIGHUP, or when the model file changes if --reload-interval is set.
+
+    python serve.py --workers 4 --threads 8
+    python serve.py --asyncio   # uvicorn front end, needs uvicorn and asgiref
+
+On platforms without os.fork (Windows) a single process is served.
+"""
+import os
+import gc
+import time
+import signal
+import socket
+import logging
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+
+logger = logging.getLogger('serve')
+
+
+class KeepAliveRequestHandler(WSGIRequestHandler):
+    # Idle keep-alive connections would otherwise hold a pool thread forever
+    timeout = float(os.getenv('ML_KEEPALIVE_TIMEOUT', 5))
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    """Werkzeug server handling requests on a fixed-size thread pool"""
+
+    multithread = True
+
+    def __init__(self, host, port, app, threads, fd=None):
+        super().__init__(host, port, app, handler=KeepAliveRequestHandler, fd=fd)
+        self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='ml-worker')
+
+    def process_request(self, request, client_address):
+        self._executor.submit(self._process_request_thread, request, client_address)
+
+    def _process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def close(self):
+        # Let in-flight requests finish before closing the socket
+        self._executor.shutdown(wait=True)
+        self.server_close()
+
+
+def create_listen_socket(host, port, backlog):
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+def model_file_identity(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def run_worker(flask_app, sock, args):
+    """Serve requests in a forked worker until SIGTERM"""
+    if args.asyncio:
+        run_asyncio_worker(flask_app, sock, args)
+        return
+
+    server = PooledWSGIServer(args.host, args.port, flask_app, args.threads, fd=sock.fileno())
+
+    def stop(signum, frame):
+        # shutdown() blocks until serve_forever returns, so call it off the main thread
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    try:
+        server.serve_forever()
+    finally:
+        server.close()
+
+
+def run_asyncio_worker(flask_app, sock, args):
+    """Serve the WSGI app behind uvicorn's asyncio event loop"""
+    try:
+        import uvicorn
+        from asgiref.wsgi import WsgiToAsgi
+    except ImportError:
+        logger.error("The asyncio front end needs the optional uvicorn and asgiref packages")
+        raise
+
+    config = uvicorn.Config(
+        WsgiToAsgi(flask_app),
+        backlog=args.backlog,
+        limit_concurrency=args.threads * 16,
+        timeout_keep_alive=int(KeepAliveRequestHandler.timeout),
+        log_level='warning'
+    )
+    # uvicorn installs its own SIGTERM/SIGINT handlers for a graceful shutdown
+    uvicorn.Server(config).run(sockets=[sock])
+
+
+class Master:
+    """Preforking process manager"""
+
+    def __init__(self, flask_module, sock, args):
+        self.flask_module = flask_module
+        self.sock = sock
+        self.args = args
+        self.workers = set()
+        self.retiring = set()
+        self.reload_requested = False
+        self.stopping = False
+        self.model_identity = model_file_identity(flask_module.model_path)
+
+    def spawn_worker(self):
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 0
+            try:
+                run_worker(self.flask_module.app, self.sock, self.args)
+            except BaseException:
+                logger.exception("Worker crashed")
+                exit_code = 1
+            finally:
+                os._exit(exit_code)
+        self.workers.add(pid)
+        return pid
+
+    def spawn_generation(self):
+        # Objects loaded so far are never freed, so keep the collector from
+        # touching (and copying) their pages in every worker
+        gc.collect()
+        gc.freeze()
+        return {self.spawn_worker() for _ in range(self.args.workers)}
+
+    def stop_workers(self, pids):
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def reap_workers(self):
+        """Collect exited workers, returning the pids that died"""
+        dead = set()
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            if pid in self.workers:
+                self.workers.discard(pid)
+                dead.add(pid)
+                if not self.stopping:
+                    logger.warning(f"Worker {pid} exited with status {status}")
+        return dead
+
+    def reload(self):
+        """Reload the model in the master, then replace workers generation by generation"""
+        logger.info("Reloading model and replacing workers...")
+        # Let the previous model be collected once the old workers are gone
+        gc.unfreeze()
+        try:
+            self.flask_module.reload_model()
+        except Exception:
+            logger.exception("Model reload failed, keeping the current workers")
+            return
+        old_workers = set(self.workers)
+        self.spawn_generation()
+        self.stop_workers(old_workers)
+        self.retiring.update(old_workers)
+
+    def run(self):
+        def request_stop(signum, frame):
+            self.stopping = True
+
+        def request_reload(signum, frame):
+            self.reload_requested = True
+
+        signal.signal(signal.SIGTERM, request_stop)
+        signal.signal(signal.SIGINT, request_stop)
+        signal.signal(signal.SIGHUP, request_reload)
+
+        self.spawn_generation()
+        logger.info(f"Serving on {self.args.host}:{self.args.port} with {self.args.workers} workers "
+                    f"x {self.args.threads} threads (master pid {os.getpid()})")
+
+        last_check = time.monotonic()
+        while not self.stopping:
+            time.sleep(0.2)
+            dead = self.reap_workers()
+            # Replace crashed workers of the current generation
+            for _ in dead - self.retiring:
+                if not self.stopping:
+                    self.spawn_worker()
+            self.retiring -= dead
+
+            if self.args.reload_interval > 0 and time.monotonic() - last_check >= self.args.reload_interval:
+                last_check = time.monotonic()
+                identity = model_file_identity(self.flask_module.model_path)
+                if identity != self.model_identity:
+                    self.model_identity = identity
+                    self.reload_requested = True
+
+            if self.reload_requested:
+                self.reload_requested = False
+                self.reload()
+
+        logger.info("Shutting down workers...")
+        self.stop_workers(self.workers)
+        deadline = time.monotonic() + self.args.graceful_timeout
+        while self.workers and time.monotonic() < deadline:
+            self.reap_workers()
+            time.sleep(0.1)
+        for pid in self.workers:
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Serve the ML service with preforked workers')
+    parser.add_argument('--host', default=os.getenv('ML_SERVICE_HOST', '0.0.0.0'))
+    parser.add_argument('--port', type=int, default=int(os.getenv('ML_SERVICE_PORT', 5003)))
+    parser.add_argument('--workers', type=int, default=int(os.getenv('ML_WORKERS', os.cpu_count() or 1)))
+    parser.add_argument('--threads', type=int, default=int(os.getenv('ML_THREADS', 4)), help='Request threads per worker')
+    parser.add_argument('--backlog', type=int, default=int(os.getenv('ML_BACKLOG', 2048)), help='Listen socket backlog')
+    parser.add_argument('--reload-interval', type=float, default=float(os.getenv('ML_RELOAD_INTERVAL', 0)),
+                        help='Seconds between checks of the model file that restart all workers, 0 disables; '
+                             'workers already hot-swap new model versions')
+    parser.add_argument('--graceful-timeout', type=float, default=float(os.getenv('ML_GRACEFUL_TIMEOUT', 30)),
+                        help='Seconds workers get to finish in-flight requests on shutdown')
+    parser.add_argument('--asyncio', action='store_true', default=os.getenv('ML_ASYNCIO', '0') == '1',
+                        help='Serve through uvicorn (asyncio) instead of the threaded WSGI server')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    # Import the app, and with it the model, once in the master before forking
+    import app as flask_module
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    flask_module.get_predictor()
+
+    sock = create_listen_socket(args.host, args.port, args.backlog)
+
+    if not hasattr(os, 'fork') or args.workers <= 1:
+        logger.info(f"Serving on {args.host}:{args.port} in a single process with {args.threads} threads")
+        run_worker(flask_module.app, sock, args)
+        return
+
+    Master(flask_module, sock, args).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,263 @@
+"""Monte Carlo stock-out and reorder-point simulation on top of the model forecasts.
+
+A point forecast says nothing about how likely a SKU is to run out. Here every
+SKU gets n_paths simulated daily demand paths over the horizon. Each day's
+demand is the model output for that date plus a residual drawn from the
+model's training residuals, floored at zero. It is scaled to quantities the
+same way /predict/forecast/series scales daily_quantity (output x stock_level
+/ days). From the paths come, per SKU:
+
+  stockout_probability  share of paths whose horizon demand exceeds on_hand
+  reorder_point         service_level quantile of the demand over the lead time
+  safety_stock          reorder_point minus the mean lead-time demand
+
+The paths of many SKUs of one drug type are drawn and accumulated as one
+(skus, paths, days) array. SKUs are processed in chunks of at most
+max_elements values, so memory stays bounded and runtime grows linearly with
+the SKU count.
+
+The residuals are the training rows at the hour the service predicts for
+(Hour 12). train_combined_model.py, retrain.py and tuning.py save them next to
+the model before publishing it, and ModelRegistry.publish copies them into the
+version directory. They record the sha256 of the model they were fitted for,
+and residuals of any other model are never used. To fit them for an existing
+model:
+
+    python simulation.py fit --model models/best_model_combined.pkl
+    python simulation.py run --catalog catalog.csv --date 2025-06-01 --days 30 --lead-time 7
+    python simulation.py run --synthetic 100x1000 --paths 2000 --output simulation.csv
+"""
+import os
+import time
+import logging
+import argparse
+from datetime import datetime
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+SERVICE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_MODEL_PATH = os.path.join(SERVICE_DIR, 'models', 'best_model_combined.pkl')
+
+# build_input_features predicts every date at noon, so residuals are taken from that hour
+SERVING_HOUR = 12.0
+
+DEFAULT_PATHS = 1000
+DEFAULT_SERVICE_LEVEL = 0.95
+# Values of the (skus, paths, days) demand array simulated at once, about 32 MB as float32
+DEFAULT_MAX_ELEMENTS = 8_000_000
+
+RESULT_FIELDS = ['expected_demand', 'stockout_probability', 'lead_time_demand', 'reorder_point', 'safety_stock']
+
+
+def residuals_path(model_path):
+    """Path of the residuals saved for a model, e.g. models/best_model_combined.residuals.npz"""
+    return os.path.splitext(model_path)[0] + '.residuals.npz'
+
+
+def fit_residuals(model, X, y):
+    """Training residuals (y - prediction) of the rows at SERVING_HOUR, shape (n_rows, n_drug_types)"""
+    rows = np.asarray(X['Hour'] == SERVING_HOUR)
+    if not rows.any():
+        raise ValueError(f"No training rows with Hour == {SERVING_HOUR:g} to take residuals from")
+    return np.asarray(y[rows], dtype=np.float64) - model.predict(X[rows])
+
+
+def write_residuals(residuals, model_path, source_path=None):
+    """Save the residuals next to the model, replacing any previous ones atomically.
+
+    They record the sha256 of source_path (default model_path), the file that
+    will be at model_path once it is moved there.
+    """
+    from compiled_model import file_sha256
+
+    source_path = source_path or model_path
+    path = residuals_path(model_path)
+    tmp_path = path + '.tmp.npz'
+    np.savez(
+        tmp_path,
+        residuals=np.asarray(residuals, dtype=np.float32),
+        model_sha256=np.array(file_sha256(source_path) if os.path.exists(source_path) else ''),
+        created_at=np.array(datetime.now().isoformat(timespec='seconds'))
+    )
+    os.replace(tmp_path, path)
+    return path
+
+
+def residuals_sha256(path):
+    """sha256 of the model file the residuals at path were fitted for, '' when unknown"""
+    with np.load(path) as saved:
+        return str(saved['model_sha256'])
+
+
+def load_residuals(model_path):
+    """Residuals saved for the model at model_path; None when missing or fitted for another model"""
+    from compiled_model import file_sha256
+
+    path = residuals_path(model_path)
+    if not os.path.exists(path):
+        logger.warning(f"No residuals saved for {model_path}, run: python simulation.py fit --model {model_path}")
+        return None
+    with np.load(path) as saved:
+        residuals, model_sha256, created_at = saved['residuals'], str(saved['model_sha256']), saved['created_at']
+    if model_sha256 != file_sha256(model_path):
+        logger.warning(f"Ignoring {path}: it was fitted for another model than {model_path}")
+        return None
+    logger.info(f"Loaded {len(residuals)} residuals per drug type from {path} (created {created_at})")
+    return residuals
+
+
+def simulate(outputs, residuals, drug_indices, stock_levels, lead_times, on_hand=None,
+             n_paths=DEFAULT_PATHS, service_level=DEFAULT_SERVICE_LEVEL, seed=0,
+             max_elements=DEFAULT_MAX_ELEMENTS):
+    """Simulate demand paths for many SKUs sharing one forecast window.
+
+    outputs holds the model outputs of each day of the window, shape (days,
+    n_drug_types). residuals is (n_rows, n_drug_types). The per-SKU arrays give
+    the drug type index, the stock level that scales quantities, the lead time
+    in days (1..days) and the stock on hand (default: stock_levels).
+    Returns a dict of RESULT_FIELDS arrays with one value per SKU.
+    """
+    outputs = np.asarray(outputs, dtype=np.float32)
+    residuals = np.asarray(residuals, dtype=np.float32)
+    drug_indices = np.asarray(drug_indices, dtype=np.intp)
+    stock_levels = np.asarray(stock_levels, dtype=np.float64)
+    lead_times = np.asarray(lead_times, dtype=np.intp)
+    on_hand = stock_levels if on_hand is None else np.asarray(on_hand, dtype=np.float64)
+    days = len(outputs)
+    n_skus = len(drug_indices)
+    if lead_times.size and (lead_times.min() < 1 or lead_times.max() > days):
+        raise ValueError(f'Lead times must be between 1 and the {days} forecast days')
+
+    results = {name: np.empty(n_skus) for name in RESULT_FIELDS}
+    rng = np.random.default_rng(seed)
+    chunk = max(1, max_elements // (n_paths * days))
+    paths = np.arange(n_paths)
+
+    # Chunks never mix drug types, so residuals are drawn from one flat pool with a 1-D take
+    for drug in np.unique(drug_indices):
+        pool = np.ascontiguousarray(residuals[:, drug])
+        drug_outputs = outputs[:, drug]
+        skus = np.flatnonzero(drug_indices == drug)
+        for lo in range(0, len(skus), chunk):
+            rows = skus[lo:lo + chunk]
+
+            # Daily demand: model output plus a bootstrapped residual, floored at zero, in quantity units
+            draws = rng.integers(0, len(pool), size=(len(rows), n_paths, days), dtype=np.int32)
+            demand = np.take(pool, draws, mode='clip')
+            demand += drug_outputs
+            np.maximum(demand, 0, out=demand)
+            demand *= (stock_levels[rows] / days).astype(np.float32)[:, None, None]
+            np.cumsum(demand, axis=2, out=demand)
+
+            horizon_demand = demand[:, :, -1]
+            lead_demand = demand[np.arange(len(rows))[:, None], paths, lead_times[rows, None] - 1]
+            mean_lead_demand = lead_demand.mean(axis=1, dtype=np.float64)
+            reorder_point = np.quantile(lead_demand, service_level, axis=1)
+
+            results['expected_demand'][rows] = horizon_demand.mean(axis=1, dtype=np.float64)
+            results['stockout_probability'][rows] = (horizon_demand > on_hand[rows, None]).mean(axis=1)
+            results['lead_time_demand'][rows] = mean_lead_demand
+            results['reorder_point'][rows] = reorder_point
+            results['safety_stock'][rows] = reorder_point - mean_lead_demand
+    return results
+
+
+def run_catalog(catalog, model, residuals, start_date, days, lead_time, n_paths=DEFAULT_PATHS,
+                service_level=DEFAULT_SERVICE_LEVEL, seed=0, max_elements=DEFAULT_MAX_ELEMENTS):
+    """Simulate every catalog row over one window; returns a DataFrame with one row per store and SKU"""
+    import pandas as pd
+    from features import DRUG_TYPE_CODES, build_series_features, predict_feature_matrix
+
+    # The same feature rows and outputs as /predict/forecast/series and /simulate/stock
+    outputs = predict_feature_matrix(model, build_series_features(start_date, days))
+    results = simulate(outputs, residuals, catalog.drug_indices, catalog.stock_levels,
+                       np.full(len(catalog), lead_time), n_paths=n_paths, service_level=service_level,
+                       seed=seed, max_elements=max_elements)
+    frame = pd.DataFrame({
+        'store_id': np.asarray(catalog.stores, dtype=object)[catalog.store_codes],
+        'sku': np.asarray(catalog.skus, dtype=object)[catalog.sku_codes],
+        'drug_type': np.asarray(DRUG_TYPE_CODES)[catalog.drug_indices],
+        'stock_level': catalog.stock_levels,
+        **results
+    })
+    frame['reorder'] = frame['stock_level'] <= frame['reorder_point']
+    return frame
+
+
+def fit_and_write(model_path=DEFAULT_MODEL_PATH):
+    """Compute the residuals of a trained model on the feature store rows and save them next to it"""
+    import joblib
+    from feature_store import FeatureStore
+
+    store = FeatureStore()
+    store.refresh()
+    X, y = store.load_training_data()
+    residuals = fit_residuals(joblib.load(model_path), X, y)
+    path = write_residuals(residuals, model_path)
+    logger.info(f"Wrote {len(residuals)} residuals per drug type to {path}")
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Monte Carlo stock-out and reorder-point simulation')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    fit = subparsers.add_parser('fit', help='Save the training residuals of a model next to it')
+    fit.add_argument('--model', default=DEFAULT_MODEL_PATH)
+
+    run = subparsers.add_parser('run', help='Simulate every SKU of a catalog')
+    source = run.add_mutually_exclusive_group(required=True)
+    source.add_argument('--catalog', help='CSV with store_id, sku, drug_type and stock_level columns')
+    source.add_argument('--synthetic', help='STORESxSKUS synthetic catalog, e.g. 100x1000')
+    run.add_argument('--model', help='Model path; defaults to the served registry version')
+    run.add_argument('--date', default=datetime.now().strftime('%Y-%m-%d'), help='First forecast day, YYYY-MM-DD')
+    run.add_argument('--days', type=int, default=30, help='Forecast horizon in days')
+    run.add_argument('--lead-time', type=int, default=7, help='Replenishment lead time in days')
+    run.add_argument('--paths', type=int, default=DEFAULT_PATHS, help='Demand paths per SKU')
+    run.add_argument('--service-level', type=float, default=DEFAULT_SERVICE_LEVEL)
+    run.add_argument('--seed', type=int, default=0)
+    run.add_argument('--max-elements', type=int, default=DEFAULT_MAX_ELEMENTS,
+                     help='Largest skus x paths x days array simulated at once')
+    run.add_argument('--output', help='CSV path for the per-SKU results')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    if args.command == 'fit':
+        fit_and_write(args.model)
+        return
+
+    from forecast_engine import Catalog, load_model
+    from model_registry import ModelRegistry
+
+    if args.catalog:
+        catalog = Catalog.from_csv(args.catalog)
+    else:
+        n_stores, n_skus = (int(value) for value in args.synthetic.lower().split('x'))
+        catalog = Catalog.synthetic(n_stores, n_skus)
+    if args.model:
+        model_path, version = args.model, os.path.basename(args.model)
+    else:
+        resolved = ModelRegistry().resolve()
+        model_path, version = resolved.model_path, resolved.version
+    model, _ = load_model(model_path)
+    residuals = load_residuals(model_path)
+    if residuals is None:
+        raise SystemExit(f"No residuals saved for {model_path}, run: python simulation.py fit --model {model_path}")
+
+    start = time.perf_counter()
+    frame = run_catalog(catalog, model, residuals, datetime.strptime(args.date, '%Y-%m-%d'), args.days,
+                        args.lead_time, args.paths, args.service_level, args.seed, args.max_elements)
+    elapsed = time.perf_counter() - start
+    logger.info(f"Simulated {len(frame)} SKUs x {args.paths} paths x {args.days} days with model {version} "
+                f"in {elapsed:.2f}s ({len(frame) / elapsed:,.0f} SKUs/s); "
+                f"{int(frame['reorder'].sum())} at or below their reorder point")
+    if args.output:
+        frame.to_csv(args.output, index=False)
+        logger.info(f"Results written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
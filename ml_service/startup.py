@@ -0,0 +1,34 @@
+import time
+import logging
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Measured from the first import of this module, which app.py does before anything else
+PROCESS_START = time.perf_counter()
+
+STARTUP_TIMINGS = {}
+
+
+@contextmanager
+def timed_stage(name):
+    """Record how long an import or load stage takes"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STARTUP_TIMINGS[name] = STARTUP_TIMINGS.get(name, 0.0) + time.perf_counter() - start
+
+
+def startup_report():
+    """Format the recorded stages as a table, slowest first"""
+    total = time.perf_counter() - PROCESS_START
+    lines = [f"{'stage':<32}{'seconds':>10}{'share':>8}"]
+    for name, seconds in sorted(STARTUP_TIMINGS.items(), key=lambda item: item[1], reverse=True):
+        lines.append(f"{name:<32}{seconds:>10.4f}{seconds / total:>8.1%}")
+    lines.append(f"{'total since start':<32}{total:>10.4f}")
+    return '\n'.join(lines)
+
+
+def log_startup_report():
+    logger.info("Startup time report:\n" + startup_report())
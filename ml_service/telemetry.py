@@ -0,0 +1,277 @@
+"""Request instrumentation for the ML service, exposed in Prometheus text format.
+
+Only the standard library is used: counters, gauges and histograms are kept in
+process memory and rendered on demand by the /metrics endpoint. Under serve.py
+every worker process keeps its own values, so each scrape reports the worker
+that answered it, identified by the pid label of ml_process_info.
+
+The sampling profiler is opt-in: it records the stacks of all request threads
+every few milliseconds while enabled, and reports them in the collapsed-stack
+format flame graph tools read.
+"""
+import os
+import sys
+import time
+import threading
+from collections import Counter as StackCounter
+from contextlib import contextmanager
+
+# Latency buckets in seconds, from 100µs to 10s
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 10.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labelnames, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(labels[name] for name in self.labelnames)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._render_sample(key, value))
+        return lines
+
+    def _render_sample(self, key, value):
+        return [f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}']
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def get(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def _render_sample(self, key, state):
+        counts, total, count = state
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            labels = _format_labels(self.labelnames, key, f'le="{_format_value(float(bound))}"')
+            lines.append(f'{self.name}_bucket{labels} {cumulative}')
+        labels = _format_labels(self.labelnames, key)
+        lines.append(f'{self.name}_sum{labels} {_format_value(float(total))}')
+        lines.append(f'{self.name}_count{labels} {count}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector):
+        """Register a callable returning extra metrics, evaluated on every scrape"""
+        self.collectors.append(collector)
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        for collector in self.collectors:
+            for metric in collector():
+                lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    'ml_request_duration_seconds', 'Time spent handling a request.', ('endpoint', 'status')))
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    'ml_request_stage_seconds', 'Time spent in each stage of request handling.', ('stage',)))
+IN_FLIGHT = REGISTRY.register(Gauge(
+    'ml_requests_in_flight', 'Requests currently being handled by this process.'))
+BATCH_SIZE = REGISTRY.register(Histogram(
+    'ml_batch_forecasts', 'Forecasts per batch request.', (),
+    buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)))
+MODEL_ROWS = REGISTRY.register(Histogram(
+    'ml_model_rows', 'Feature rows per model evaluation.', (),
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 4096, 16384)))
+MICROBATCH_ROWS = REGISTRY.register(Histogram(
+    'ml_microbatch_rows', 'Rows per coalesced model evaluation.', (),
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)))
+MICROBATCH_REQUESTS = REGISTRY.register(Histogram(
+    'ml_microbatch_requests', 'Requests coalesced into one model evaluation.', (),
+    buckets=(1, 2, 3, 4, 6, 8, 12, 16, 24, 32, 64)))
+MICROBATCH_QUEUE_SECONDS = REGISTRY.register(Histogram(
+    'ml_microbatch_queue_seconds', 'Time rows waited for their batch to be dispatched.'))
+MODEL_LOAD_SECONDS = REGISTRY.register(Gauge(
+    'ml_model_load_seconds', 'Time taken by the last model load.', ('backend',)))
+MODEL_LOADED_AT = REGISTRY.register(Gauge(
+    'ml_model_loaded_timestamp_seconds', 'Unix time of the last model load.'))
+MODEL_VERSION = REGISTRY.register(Gauge(
+    'ml_model_version_info', 'Model version served by this process.', ('version',)))
+PROCESS_INFO = REGISTRY.register(Gauge(
+    'ml_process_info', 'Process that answered this scrape.', ('pid',)))
+
+
+@contextmanager
+def stage(name):
+    """Time a block of request handling into ml_request_stage_seconds"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage=name)
+
+
+def render_metrics():
+    # Forked workers inherit the master's value, so set the pid at scrape time
+    PROCESS_INFO.clear()
+    PROCESS_INFO.set(1, pid=os.getpid())
+    return REGISTRY.render()
+
+
+class SamplingProfiler:
+    """Samples the Python stacks of all other threads at a fixed interval.
+
+    Started and stopped at runtime; the sampling thread only exists while enabled.
+    """
+
+    def __init__(self, interval=0.005, max_depth=64):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.stacks = StackCounter()
+        self.samples = 0
+        self.started_at = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, interval=None):
+        with self._lock:
+            if interval:
+                self.interval = interval
+            if self.running:
+                return
+            self.stacks.clear()
+            self.samples = 0
+            self.started_at = time.time()
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='ml-profiler', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        with self._lock:
+            self._stop.set()
+            thread = self._thread
+        if thread is not None:
+            thread.join()
+
+    def _run(self):
+        own_ident = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            for ident, frame in frames.items():
+                if ident == own_ident:
+                    continue
+                names = []
+                while frame is not None and len(names) < self.max_depth:
+                    code = frame.f_code
+                    names.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+                    frame = frame.f_back
+                with self._lock:
+                    self.stacks[';'.join(reversed(names))] += 1
+            with self._lock:
+                self.samples += 1
+
+    def collapsed(self, limit=None):
+        """Stacks in collapsed format, 'outer;inner count' per line, most frequent first"""
+        with self._lock:
+            items = self.stacks.most_common(limit)
+        return '\n'.join(f'{stack} {count}' for stack, count in items) + '\n'
+
+    def status(self):
+        with self._lock:
+            return {
+                'running': self.running,
+                'interval_ms': self.interval * 1000,
+                'samples': self.samples,
+                'distinct_stacks': len(self.stacks),
+                'started_at': self.started_at
+            }
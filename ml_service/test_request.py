@@ -30,14 +30,14 @@ def test_model_info():
             print(f"- {feature['name']}: {feature['importance']:.4f}")
     return response.json() if response.status_code == 200 else None
 
-def test_prediction(drug_type, month, days, stock_level):
+def test_prediction(drug_type, date, days, stock_level):
     """Test making a prediction"""
     print(f"\nTesting POST /predict/forecast")
-    print(f"Parameters: Drug Type: {drug_type}, Month: {month}, Days: {days}, Stock Level: {stock_level}")
+    print(f"Parameters: Drug Type: {drug_type}, Date: {date}, Days: {days}, Stock Level: {stock_level}")
     
     data = {
         "drug_type": drug_type,
-        "month": month,
+        "date": date,
         "days": days,
         "stock_level": stock_level
     }
@@ -74,32 +74,32 @@ def main():
     
     # Test cases for different drug types
     test_cases = [
-        # Different drug types for same month
-        ("M01AB", "2025-06", 30, 100),
-        ("N02BA", "2025-06", 30, 100),
-        ("R03", "2025-06", 30, 100),
+        # Different drug types for same date
+        ("M01AB", "2025-06-01", 30, 100),
+        ("N02BA", "2025-06-01", 30, 100),
+        ("R03", "2025-06-01", 30, 100),
         
         # Different months for same drug type
-        ("M01AB", "2025-01", 31, 100),  # Winter
-        ("M01AB", "2025-07", 31, 100),  # Summer
-        ("M01AB", "2025-12", 31, 100),  # Winter
+        ("M01AB", "2025-01-01", 31, 100),  # Winter
+        ("M01AB", "2025-07-01", 31, 100),  # Summer
+        ("M01AB", "2025-12-01", 31, 100),  # Winter
         
         # Different stock levels
-        ("M01AB", "2025-06", 30, 50),   # Low stock
-        ("M01AB", "2025-06", 30, 200),  # High stock
+        ("M01AB", "2025-06-01", 30, 50),   # Low stock
+        ("M01AB", "2025-06-01", 30, 200),  # High stock
         
         # Different days
-        ("M01AB", "2025-06", 15, 100),  # Half month
-        ("M01AB", "2025-06", 7, 100),   # One week
+        ("M01AB", "2025-06-01", 15, 100),  # Half month
+        ("M01AB", "2025-06-01", 7, 100),   # One week
     ]
     
     results = []
-    for drug_type, month, days, stock_level in test_cases:
-        result = test_prediction(drug_type, month, days, stock_level)
+    for drug_type, date, days, stock_level in test_cases:
+        result = test_prediction(drug_type, date, days, stock_level)
         if result:
             results.append({
                 'drug_type': drug_type,
-                'month': month,
+                'date': date,
                 'days': days,
                 'stock_level': stock_level,
                 'prediction': result['prediction'],
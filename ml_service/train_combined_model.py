@@ -5,10 +5,22 @@ from sklearn.compose import ColumnTransformer
 from sklearn.preprocessing import StandardScaler, OneHotEncoder
 from sklearn.multioutput import MultiOutputRegressor
 from sklearn.ensemble import GradientBoostingRegressor
+from sklearn.base import clone
 import joblib
 import logging
 import os
+import json
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+from compiled_model import export_artifact, file_sha256
+from model_registry import ModelRegistry
+from ingest import DEFAULT_CHUNKSIZE, load_sales_streaming, to_training_frame
+from feature_store import FeatureStore
+from rollup import RollupStore
+from evaluation import cross_validate, evaluate_predictions, log_metrics, write_metrics
+from simulation import fit_residuals, write_residuals
 
 # Configure logging
 logging.basicConfig(
@@ -23,6 +35,77 @@ logger = logging.getLogger(__name__)
 
 DRUG_TYPES = ['M01AB', 'M01AE', 'N02BA', 'N02BE', 'N05B', 'N05C', 'R03', 'R06']
 
+MODEL_PATH = 'models/best_model_combined.pkl'
+
+# Feature store rows per source file the published model was trained on, and that model's sha256
+TRAINING_STATE_PATH = 'models/best_model_combined.train.json'
+
+def save_training_state(source_rows, path=TRAINING_STATE_PATH, model_path=MODEL_PATH, **extra):
+    state = {
+        'trained_at': datetime.now().isoformat(timespec='seconds'),
+        'source_rows': source_rows,
+        'model_sha256': file_sha256(model_path),
+        **extra
+    }
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_path, path)
+
+def load_training_state(path=TRAINING_STATE_PATH):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+def load_and_preprocess_data_streaming(chunksize=DEFAULT_CHUNKSIZE):
+    """Chunked, typed variant of load_and_preprocess_data with bounded parsing memory"""
+    try:
+        logger.info(f"Streaming datasets in chunks of {chunksize} rows...")
+        columns, _, stats = load_sales_streaming(chunksize=chunksize)
+        logger.info(f"Ingested {stats}")
+        
+        X, y = to_training_frame(columns)
+        logger.info(f"Features: {list(X.columns)}")
+        logger.info(f"Target shape: {y.shape}")
+        return X, y
+        
+    except Exception as e:
+        logger.error(f"Error streaming and preprocessing data: {str(e)}", exc_info=True)
+        raise
+
+def load_and_preprocess_data_cached(chunksize=DEFAULT_CHUNKSIZE):
+    """Load the training data from the columnar feature store, parsing only new CSV rows"""
+    try:
+        store = FeatureStore()
+        actions = store.refresh(chunksize)
+        logger.info(f"Feature store status: {actions}")
+        
+        X, y = store.load_training_data()
+        logger.info(f"Features: {list(X.columns)}")
+        logger.info(f"Target shape: {y.shape}")
+        return X, y
+        
+    except Exception as e:
+        logger.error(f"Error loading data from the feature store: {str(e)}", exc_info=True)
+        raise
+
+def load_and_preprocess_data_rollup(chunksize=DEFAULT_CHUNKSIZE):
+    """Load the training data with the daily, weekly and monthly rows rolled up from the hourly file"""
+    try:
+        store = RollupStore()
+        status = store.refresh(chunksize)
+        logger.info(f"Rollup status: {status['action']}")
+        
+        X, y = store.load_training_data()
+        logger.info(f"Features: {list(X.columns)}")
+        logger.info(f"Target shape: {y.shape}")
+        return X, y
+        
+    except Exception as e:
+        logger.error(f"Error loading data from the hourly rollups: {str(e)}", exc_info=True)
+        raise
+
 def load_and_preprocess_data():
     try:
         logger.info("Loading datasets...")
@@ -88,7 +171,40 @@ def load_and_preprocess_data():
         logger.error(f"Error loading and preprocessing data: {str(e)}", exc_info=True)
         raise
 
-def train_model(X, y):
+def _fit_estimator(estimator, X, y, drug_type):
+    # Runs in a worker process; returns the fitted estimator and its wall time
+    start = time.perf_counter()
+    estimator.fit(X, y)
+    return estimator, time.perf_counter() - start
+
+def fit_estimators(base_model, X, y, n_workers=None):
+    """Fit one clone of base_model per target column, in a process pool when n_workers > 1.
+
+    Each estimator sees exactly the inputs MultiOutputRegressor.fit would give it,
+    so the result is identical to sequential fitting for a fixed random_state.
+    """
+    return fit_estimators_in_pool([clone(base_model) for _ in y.columns], X, y, n_workers)
+
+def fit_estimators_in_pool(estimators, X, y, n_workers=None):
+    """Fit estimators[i] on target column i, in a process pool when n_workers > 1"""
+    n_workers = n_workers or os.cpu_count() or 1
+    n_workers = min(n_workers, y.shape[1])
+    targets = [(estimator, X, y.iloc[:, i].to_numpy(dtype=np.float64), drug_type)
+               for i, (estimator, drug_type) in enumerate(zip(estimators, y.columns))]
+
+    start = time.perf_counter()
+    if n_workers == 1:
+        results = [_fit_estimator(*target) for target in targets]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            results = list(executor.map(_fit_estimator, *zip(*targets)))
+
+    for drug_type, (_, seconds) in zip(y.columns, results):
+        logger.info(f"Fitted estimator for {drug_type} in {seconds:.2f}s")
+    logger.info(f"Fitted {len(results)} estimators with {n_workers} workers in {time.perf_counter() - start:.2f}s")
+    return [estimator for estimator, _ in results]
+
+def train_model(X, y, n_workers=None):
     try:
         logger.info("Starting model training...")
         
@@ -108,8 +224,14 @@ def train_model(X, y):
             random_state=42
         )
         
-        # Create multi-output model
+        # Train model: scale once, then fit the per-drug estimators in parallel
+        logger.info("Fitting model...")
+        X_scaled = preprocessor.fit_transform(X)
+        
+        # Create multi-output model from the fitted estimators
         multi_model = MultiOutputRegressor(base_model)
+        multi_model.estimators_ = fit_estimators(base_model, X_scaled, y, n_workers)
+        multi_model.n_features_in_ = X_scaled.shape[1]
         
         # Create model pipeline
         pipeline = Pipeline([
@@ -117,15 +239,21 @@ def train_model(X, y):
             ('model', multi_model)
         ])
         
-        # Train model
-        logger.info("Fitting model...")
-        pipeline.fit(X, y)
-        
         # Save model and preprocessor
         os.makedirs('models', exist_ok=True)
         
         logger.info("Saving model...")
-        joblib.dump(pipeline, 'models/best_model_combined.pkl')
+        joblib.dump(pipeline, MODEL_PATH)
+        
+        # Export the memory-mappable artifact the service loads instead of the pickle
+        logger.info("Exporting model artifact...")
+        export_artifact(pipeline, MODEL_PATH)
+        
+        # Residual distribution sampled by the stock-out simulation, published with the model
+        logger.info(f"Residuals written to {write_residuals(fit_residuals(pipeline, X, y), MODEL_PATH)}")
+        
+        # Publish a new registry version, which running services swap in without a restart
+        ModelRegistry().publish(MODEL_PATH, pipeline=pipeline, source_script='train_combined_model.py')
         
         logger.info("Model saved successfully")
         return pipeline
@@ -134,38 +262,73 @@ def train_model(X, y):
         logger.error(f"Error training model: {str(e)}", exc_info=True)
         raise
 
-def evaluate_model(model, X, y):
+def evaluate_model(model, X, y, cv_folds=0, timestamps=None, n_workers=None):
     try:
         logger.info("Evaluating model...")
         
-        # Make predictions
-        y_pred = model.predict(X)
+        # Predict once and compute the metrics of all drug types together
+        report = {'in_sample': evaluate_predictions(model, X, y)}
+        log_metrics(report['in_sample'], logger)
+        
+        # Refit on expanding time-based folds to measure out-of-sample accuracy
+        if cv_folds:
+            report['cross_validation'] = cross_validate(model, X, y, timestamps, cv_folds, n_workers)
+            for drug_type, values in report['cross_validation']['mean_per_drug'].items():
+                logger.info(f"{drug_type} cross-validated: MSE {values['mse']:.4f}, MAE {values['mae']:.4f}, R2 {values['r2']:.4f}")
         
-        # Calculate metrics for each drug type
-        for i, drug_type in enumerate(DRUG_TYPES):
-            mse = np.mean((y.iloc[:, i] - y_pred[:, i]) ** 2)
-            mae = np.mean(np.abs(y.iloc[:, i] - y_pred[:, i]))
-            r2 = model.score(X, y.iloc[:, i])
-            
-            logger.info(f"\nMetrics for {drug_type}:")
-            logger.info(f"Mean Squared Error: {mse:.4f}")
-            logger.info(f"Mean Absolute Error: {mae:.4f}")
-            logger.info(f"R2 Score: {r2:.4f}")
+        logger.info(f"Metrics written to {write_metrics(report, MODEL_PATH)}")
+        return report
         
     except Exception as e:
         logger.error(f"Error evaluating model: {str(e)}", exc_info=True)
         raise
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Train the combined multi-output drug sales model')
+    parser.add_argument('--workers', type=int, default=int(os.getenv('TRAIN_WORKERS', os.cpu_count() or 1)),
+                        help='Processes used to fit the per-drug estimators')
+    parser.add_argument('--streaming', action='store_true',
+                        help='Read the CSVs in typed chunks instead of loading them whole')
+    parser.add_argument('--chunksize', type=int, default=DEFAULT_CHUNKSIZE,
+                        help='Rows per chunk when streaming')
+    parser.add_argument('--feature-store', action='store_true',
+                        help='Read features from the columnar cache, only parsing new CSV rows')
+    parser.add_argument('--rollup', action='store_true',
+                        help='Parse only saleshourly.csv and derive the daily, weekly and monthly rows from it')
+    parser.add_argument('--cv-folds', type=int, default=0,
+                        help='Time-based cross-validation folds run after training, 0 disables')
+    args = parser.parse_args()
+
     try:
         # Load and preprocess data
-        X, y = load_and_preprocess_data()
+        if args.rollup:
+            X, y = load_and_preprocess_data_rollup(args.chunksize)
+        elif args.feature_store:
+            X, y = load_and_preprocess_data_cached(args.chunksize)
+        elif args.streaming:
+            X, y = load_and_preprocess_data_streaming(args.chunksize)
+        else:
+            X, y = load_and_preprocess_data()
         
         # Train model
-        model = train_model(X, y)
+        model = train_model(X, y, n_workers=args.workers)
+        
+        # Record what the model was trained on so retrain.py can pick up only new rows; every
+        # loader reads the same CSV rows the feature store caches
+        store = FeatureStore()
+        if not args.feature_store:
+            store.refresh(args.chunksize)
+        save_training_state(store.source_rows())
         
-        # Evaluate model
-        evaluate_model(model, X, y)
+        # Evaluate model, ordering cross-validation folds by the cached sales timestamps
+        timestamps = None
+        if args.cv_folds and args.rollup:
+            timestamps = RollupStore().load_columns()['datum']
+        elif args.cv_folds:
+            store = FeatureStore()
+            store.refresh(args.chunksize)
+            timestamps = store.load_columns()['datum']
+        evaluate_model(model, X, y, args.cv_folds, timestamps, args.workers)
         
         logger.info("Training completed successfully")
         
@@ -66,7 +66,8 @@ def train_model():
         
         # Save pipeline and scaler
         logger.info("Saving model...")
-        joblib.dump(pipeline, 'models/best_model_combined.pkl')
+        # Kept apart from best_model_combined.pkl, the regression model the service publishes
+        joblib.dump(pipeline, 'models/best_model_classifier.pkl')
         
         logger.info("Saving scaler...")
         joblib.dump(scaler, 'models/scaler.pkl')
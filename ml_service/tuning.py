@@ -0,0 +1,373 @@
+"""Hyperparameter search for the combined model with time-based cross-validation.
+
+Candidates are per-drug GradientBoostingRegressor and
+HistGradientBoostingRegressor configurations. The preprocessor is fitted once
+per fold and its transformed matrices are shared by every candidate; the
+(candidate, fold) fits run in a process pool.
+
+Each candidate is scored on its mean out-of-sample MSE over the folds. On the
+model of the last fold, it is also scored on its serving latency and pickled
+size. Latency is measured with the backend the service would use: the
+compiled artifact for gradient boosting, sklearn otherwise. The leaderboard is
+written to models/best_model_combined.leaderboard.json. The winner is the
+fastest candidate within --mse-tolerance of the best MSE that fits the latency
+and size budgets. It is refitted on all rows and published; no other
+candidate is.
+
+    python tuning.py --learners gbr,hgb --folds 3
+    python tuning.py --learners hgb --max-candidates 4 --dry-run
+"""
+import os
+import json
+import time
+import pickle
+import random
+import logging
+import argparse
+import itertools
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from evaluation import regression_metrics, time_series_folds
+
+logger = logging.getLogger(__name__)
+
+SERVICE_DIR = os.path.dirname(os.path.abspath(__file__))
+MODEL_PATH = os.path.join(SERVICE_DIR, 'models', 'best_model_combined.pkl')
+
+# Parameter grids per learner; the first gbr entry is the configuration train_combined_model.py uses
+SEARCH_SPACE = {
+    'gbr': {
+        'n_estimators': [100, 200],
+        'learning_rate': [0.1, 0.05],
+        'max_depth': [4, 3, 5]
+    },
+    'hgb': {
+        'max_iter': [100, 200],
+        'learning_rate': [0.1, 0.05],
+        'max_leaf_nodes': [31, 15]
+    }
+}
+
+
+def make_estimator(learner, params):
+    from sklearn.ensemble import GradientBoostingRegressor, HistGradientBoostingRegressor
+
+    if learner == 'gbr':
+        return GradientBoostingRegressor(random_state=42, **params)
+    if learner == 'hgb':
+        # Early stopping would hold out a random, not time-ordered, validation split
+        return HistGradientBoostingRegressor(random_state=42, early_stopping=False, **params)
+    raise ValueError(f"Unknown learner: {learner}")
+
+
+def make_preprocessor(columns):
+    from sklearn.compose import ColumnTransformer
+    from sklearn.preprocessing import StandardScaler
+
+    return ColumnTransformer(transformers=[('num', StandardScaler(), list(columns))])
+
+
+def candidate_grid(learners, max_candidates=None, seed=0):
+    """(learner, params) pairs; a random subset of max_candidates keeps the first, baseline, one"""
+    candidates = []
+    for learner in learners:
+        space = SEARCH_SPACE[learner]
+        for values in itertools.product(*space.values()):
+            candidates.append((learner, dict(zip(space.keys(), values))))
+    if max_candidates and len(candidates) > max_candidates:
+        rest = random.Random(seed).sample(candidates[1:], max_candidates - 1)
+        candidates = [candidates[0]] + rest
+    return candidates
+
+
+def candidate_name(learner, params):
+    return learner + '(' + ', '.join(f'{key}={value}' for key, value in params.items()) + ')'
+
+
+def prepare_folds(X, y, timestamps, n_folds):
+    """Fit the preprocessor once per fold and keep its transformed train and test matrices"""
+    folds = []
+    for train_index, test_index in time_series_folds(timestamps, n_folds):
+        preprocessor = make_preprocessor(X.columns).fit(X.iloc[train_index])
+        folds.append({
+            'preprocessor': preprocessor,
+            'X_train': preprocessor.transform(X.iloc[train_index]),
+            'y_train': y.iloc[train_index].to_numpy(dtype=np.float64),
+            'X_test': preprocessor.transform(X.iloc[test_index]),
+            'y_test': y.iloc[test_index].to_numpy(dtype=np.float64),
+            'X_test_raw': X.iloc[test_index]
+        })
+    return folds
+
+
+def fit_multi_output(learner, params, X, y):
+    """One fitted estimator per target column, as MultiOutputRegressor would fit them"""
+    return [make_estimator(learner, params).fit(X, y[:, i]) for i in range(y.shape[1])]
+
+
+def build_pipeline(preprocessor, estimators, learner, params):
+    from sklearn.multioutput import MultiOutputRegressor
+    from sklearn.pipeline import Pipeline
+
+    regressor = MultiOutputRegressor(make_estimator(learner, params))
+    regressor.estimators_ = estimators
+    regressor.n_features_in_ = estimators[0].n_features_in_
+    return Pipeline([('preprocessor', preprocessor), ('model', regressor)])
+
+
+def measure_serving(pipeline, X_raw, repeats=200, batch_rows=1000):
+    """Single-row latency, per-row batch latency and size with the backend the service would use"""
+    from compiled_model import CompiledModel
+
+    if CompiledModel.supports(pipeline):
+        backend, model = 'compiled', CompiledModel.from_pipeline(pipeline)
+        rows = X_raw[model.feature_names].to_numpy(dtype=np.float64)
+        predict = model.predict
+    else:
+        backend, rows, predict = 'sklearn', X_raw, pipeline.predict
+
+    single = rows[:1]
+    batch = rows[:batch_rows]
+    predict(single)
+    latencies = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        predict(single)
+        latencies.append(time.perf_counter() - start)
+    start = time.perf_counter()
+    predict(batch)
+    batch_seconds = time.perf_counter() - start
+
+    return {
+        'backend': backend,
+        'latency_ms_p50': float(np.percentile(latencies, 50) * 1000),
+        'latency_ms_p95': float(np.percentile(latencies, 95) * 1000),
+        'batch_us_per_row': batch_seconds / len(batch) * 1e6,
+        'size_mb': len(pickle.dumps(pipeline, protocol=pickle.HIGHEST_PROTOCOL)) / 1e6
+    }
+
+
+# Fold matrices set by _init_worker, so tasks only carry a candidate and a fold index
+_folds = None
+
+
+def _init_worker(folds):
+    global _folds
+    _folds = folds
+
+
+def evaluate_candidate_fold(candidate, fold_index, measure):
+    # Runs in a worker process; returns the fold metrics and, for the last fold, serving costs
+    learner, params = candidate
+    fold = _folds[fold_index]
+    start = time.perf_counter()
+    estimators = fit_multi_output(learner, params, fold['X_train'], fold['y_train'])
+    fit_seconds = time.perf_counter() - start
+
+    y_pred = np.column_stack([est.predict(fold['X_test']) for est in estimators])
+    metrics = regression_metrics(fold['y_test'], y_pred, [str(i) for i in range(y_pred.shape[1])])
+    result = {'mse': metrics['overall']['mse'], 'mae': metrics['overall']['mae'],
+              'r2': metrics['overall']['r2'], 'fit_seconds': fit_seconds}
+    if measure:
+        pipeline = build_pipeline(fold['preprocessor'], estimators, learner, params)
+        result['serving'] = measure_serving(pipeline, fold['X_test_raw'])
+    return result
+
+
+def run_search(candidates, folds, n_workers=None):
+    """Cross-validate every candidate; returns one leaderboard entry per candidate"""
+    tasks = [(candidate, k, k == len(folds) - 1) for candidate in candidates for k in range(len(folds))]
+    n_workers = max(1, min(n_workers or os.cpu_count() or 1, len(tasks)))
+
+    start = time.perf_counter()
+    if n_workers == 1:
+        _init_worker(folds)
+        results = [evaluate_candidate_fold(*task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker, initargs=(folds,)) as executor:
+            results = list(executor.map(evaluate_candidate_fold, *zip(*tasks)))
+    logger.info(f"Evaluated {len(candidates)} candidates x {len(folds)} folds with {n_workers} workers "
+                f"in {time.perf_counter() - start:.2f}s")
+
+    entries = []
+    for i, (learner, params) in enumerate(candidates):
+        fold_results = results[i * len(folds):(i + 1) * len(folds)]
+        entries.append({
+            'name': candidate_name(learner, params),
+            'learner': learner,
+            'params': params,
+            'cv_mse': float(np.mean([r['mse'] for r in fold_results])),
+            'cv_mae': float(np.mean([r['mae'] for r in fold_results])),
+            'cv_r2': float(np.mean([r['r2'] for r in fold_results])),
+            'fold_mse': [r['mse'] for r in fold_results],
+            'fit_seconds': float(sum(r['fit_seconds'] for r in fold_results)),
+            **fold_results[-1]['serving']
+        })
+    return entries
+
+
+def rank(entries, mse_tolerance=0.0, max_latency_ms=None, max_size_mb=None):
+    """Sort the leaderboard by CV MSE, mark the Pareto front and pick the winner.
+
+    The winner is the lowest-latency candidate within mse_tolerance (relative)
+    of the best MSE among those inside the latency and size budgets.
+    """
+    entries = sorted(entries, key=lambda e: e['cv_mse'])
+    for entry in entries:
+        entry['pareto'] = not any(
+            other is not entry
+            and other['cv_mse'] <= entry['cv_mse']
+            and other['latency_ms_p50'] <= entry['latency_ms_p50']
+            and other['size_mb'] <= entry['size_mb']
+            and (other['cv_mse'], other['latency_ms_p50'], other['size_mb'])
+            != (entry['cv_mse'], entry['latency_ms_p50'], entry['size_mb'])
+            for other in entries
+        )
+        entry['within_budget'] = ((max_latency_ms is None or entry['latency_ms_p50'] <= max_latency_ms)
+                                  and (max_size_mb is None or entry['size_mb'] <= max_size_mb))
+        entry['winner'] = False
+
+    eligible = [entry for entry in entries if entry['within_budget']]
+    if not eligible:
+        return entries, None
+    best_mse = eligible[0]['cv_mse']
+    close = [entry for entry in eligible if entry['cv_mse'] <= best_mse * (1 + mse_tolerance)]
+    winner = min(close, key=lambda e: (e['latency_ms_p50'], e['cv_mse']))
+    winner['winner'] = True
+    return entries, winner
+
+
+def leaderboard_path(model_path):
+    return os.path.splitext(model_path)[0] + '.leaderboard.json'
+
+
+def write_leaderboard(report, model_path):
+    path = leaderboard_path(model_path)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    os.replace(tmp_path, path)
+    return path
+
+
+def log_leaderboard(entries):
+    logger.info(f"{'':2}{'candidate':58}{'cv mse':>12}{'cv r2':>10}{'p50 ms':>9}{'us/row':>9}{'MB':>8}  backend")
+    for entry in entries:
+        mark = '*' if entry['winner'] else ('p' if entry['pareto'] else ' ')
+        logger.info(f"{mark:2}{entry['name']:58}{entry['cv_mse']:>12.4f}{entry['cv_r2']:>10.3f}"
+                    f"{entry['latency_ms_p50']:>9.3f}{entry['batch_us_per_row']:>9.2f}{entry['size_mb']:>8.2f}"
+                    f"  {entry['backend']}")
+
+
+def permutation_importances(estimators, X, y, n_rows=5000, seed=0):
+    """Per-target permutation importances, normalised to sum to 1 like impurity importances"""
+    from sklearn.inspection import permutation_importance
+
+    rows = np.random.default_rng(seed).permutation(len(X))[:n_rows]
+    importances = []
+    for i, est in enumerate(estimators):
+        result = permutation_importance(est, X[rows], y[rows, i], n_repeats=3, random_state=seed)
+        values = np.clip(result.importances_mean, 0, None)
+        importances.append(values / values.sum() if values.sum() > 0 else values)
+    return importances
+
+
+def publish_winner(winner, X, y, model_path=MODEL_PATH, n_workers=None):
+    """Refit the winner on all rows and publish it like train_combined_model.py does"""
+    import joblib
+    from compiled_model import export_artifact
+    from model_registry import ModelRegistry
+    from simulation import fit_residuals, write_residuals
+    from train_combined_model import fit_estimators_in_pool
+
+    learner, params = winner['learner'], winner['params']
+    preprocessor = make_preprocessor(X.columns)
+    X_scaled = preprocessor.fit_transform(X)
+    estimators = fit_estimators_in_pool([make_estimator(learner, params) for _ in y.columns], X_scaled, y, n_workers)
+
+    # /model/info reads feature_importances_, which histogram gradient boosting does not provide
+    if not all(hasattr(est, 'feature_importances_') for est in estimators):
+        y_values = y.to_numpy(dtype=np.float64)
+        for est, values in zip(estimators, permutation_importances(estimators, X_scaled, y_values)):
+            est.feature_importances_ = values
+
+    pipeline = build_pipeline(preprocessor, estimators, learner, params)
+    tmp_path = model_path + '.tmp'
+    joblib.dump(pipeline, tmp_path)
+    os.replace(tmp_path, model_path)
+    export_artifact(pipeline, model_path)
+    write_residuals(fit_residuals(pipeline, X, y), model_path)
+    return ModelRegistry().publish(model_path, pipeline=pipeline, source_script='tuning.py',
+                                   learner=learner, params=params, cv_mse=winner['cv_mse'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Search model configurations and publish the best one')
+    parser.add_argument('--learners', default='gbr,hgb', help=f"Comma-separated learners from {sorted(SEARCH_SPACE)}")
+    parser.add_argument('--folds', type=int, default=3, help='Time-based cross-validation folds')
+    parser.add_argument('--max-candidates', type=int, help='Evaluate a random subset of the grid')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--mse-tolerance', type=float, default=0.01,
+                        help='Relative CV MSE above the best still eligible when picking the fastest model')
+    parser.add_argument('--max-latency-ms', type=float, help='Single-row latency budget')
+    parser.add_argument('--max-size-mb', type=float, help='Pickled model size budget')
+    parser.add_argument('--workers', type=int, default=int(os.getenv('TRAIN_WORKERS', os.cpu_count() or 1)))
+    parser.add_argument('--dry-run', action='store_true', help='Write the leaderboard without publishing')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    try:
+        from feature_store import FeatureStore
+        from ingest import to_training_frame
+        from train_combined_model import save_training_state
+
+        learners = [learner.strip() for learner in args.learners.split(',') if learner.strip()]
+        unknown = set(learners) - set(SEARCH_SPACE)
+        if unknown:
+            raise ValueError(f"Unknown learners: {sorted(unknown)}")
+
+        store = FeatureStore()
+        store.refresh()
+        columns = store.load_columns()
+        X, y = to_training_frame(columns)
+
+        candidates = candidate_grid(learners, args.max_candidates, args.seed)
+        logger.info(f"Searching {len(candidates)} candidates with {args.folds} time-based folds on {len(X)} rows")
+        folds = prepare_folds(X, y, columns['datum'], args.folds)
+        entries, winner = rank(run_search(candidates, folds, args.workers),
+                               args.mse_tolerance, args.max_latency_ms, args.max_size_mb)
+        log_leaderboard(entries)
+
+        report = {
+            'created_at': datetime.now().isoformat(timespec='seconds'),
+            'rows': len(X),
+            'folds': args.folds,
+            'mse_tolerance': args.mse_tolerance,
+            'max_latency_ms': args.max_latency_ms,
+            'max_size_mb': args.max_size_mb,
+            'winner': winner['name'] if winner else None,
+            'published_version': None,
+            'leaderboard': entries
+        }
+        if winner is None:
+            logger.warning("No candidate fits the latency and size budgets, nothing published")
+        elif args.dry_run:
+            logger.info(f"Dry run, not publishing the winner {winner['name']}")
+        else:
+            report['published_version'] = publish_winner(winner, X, y, MODEL_PATH, args.workers)
+            # Record the trained rows so retrain.py continues from this model
+            save_training_state(store.source_rows(), learner=winner['learner'], params=winner['params'])
+            logger.info(f"Published {winner['name']} as version {report['published_version']}")
+        logger.info(f"Leaderboard written to {write_leaderboard(report, MODEL_PATH)}")
+
+    except Exception as e:
+        logger.error(f"Error in hyperparameter search: {str(e)}", exc_info=True)
+        raise
+
+
+if __name__ == '__main__':
+    main()